@@ -1,3 +1,111 @@
+import asyncio
+import threading
+from typing import TYPE_CHECKING
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:
+    import aiohttp
+
 USER_AGENT_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36"
 }
+
+HTTP_TIMEOUT = (5, 30)
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET", "HEAD"),
+    respect_retry_after_header=True,
+)
+
+_http_session: requests.Session | None = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Returns the shared HTTP session, so requests to the same host reuse pooled keep-alive connections.
+    Failed connections and 429/5xx responses are retried with exponential backoff.
+    """
+
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=HTTP_RETRIES,
+            )
+            session = requests.Session()
+            session.headers.update(USER_AGENT_HEADERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def create_async_http_session() -> "aiohttp.ClientSession":
+    """
+    Creates an aiohttp session with the same headers, pool size and timeouts as the shared session.
+    Must be created and closed inside the running event loop, e.g. `async with create_async_http_session()`.
+    """
+
+    import aiohttp
+
+    connect_timeout, read_timeout = HTTP_TIMEOUT
+    return aiohttp.ClientSession(
+        headers=USER_AGENT_HEADERS,
+        connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout),
+    )
+
+
+async def get_with_retries(
+    session: "aiohttp.ClientSession",
+    url: str,
+    retry_statuses: tuple[int, ...] = HTTP_RETRIES.status_forcelist,
+    **kwargs,
+) -> "aiohttp.ClientResponse":
+    """
+    GET with the same retry policy as the shared session, see `request_with_retries`.
+    """
+
+    return await request_with_retries(session, "GET", url, retry_statuses, **kwargs)
+
+
+async def request_with_retries(
+    session: "aiohttp.ClientSession",
+    method: str,
+    url: str,
+    retry_statuses: tuple[int, ...] = HTTP_RETRIES.status_forcelist,
+    **kwargs,
+) -> "aiohttp.ClientResponse":
+    """
+    Request with the same retry policy as the shared session: failed connections and 429/5xx
+    responses are retried with exponential backoff, honouring Retry-After in seconds.
+    Callers that handle some statuses themselves pass the remaining ones as retry_statuses.
+    Use the response as `async with` so it is released.
+    """
+
+    import aiohttp
+
+    for attempt in range(HTTP_RETRIES.total + 1):
+        delay = HTTP_RETRIES.backoff_factor * 2**attempt
+        try:
+            response = await session.request(method, url, **kwargs)
+        except (TimeoutError, aiohttp.ClientError):
+            if attempt == HTTP_RETRIES.total:
+                raise
+        else:
+            if response.status not in retry_statuses or attempt == HTTP_RETRIES.total:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = int(retry_after)
+            response.release()
+        await asyncio.sleep(delay)
@@ -0,0 +1,302 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import PIL
+from image import generator
+from PIL import Image, ImageDraw
+
+CORPUS_GLOB = "./memes/reddit/*/original_todays_*"
+
+SHORT_TITLE = "When the code works on the first try"
+LONG_TITLE = (
+    "Supercalifragilisticexpialidocious_unbroken_word_that_never_ends "
+    "when the build is green but production is on fire and nobody knows why "
+    "Pneumonoultramicroscopicsilicovolcanoconiosis_again_and_again_and_again "
+    "and the standup is in five minutes so we ship it anyway and hope for the best"
+)
+
+# add_title_above_file's defaults, for the layout-only cases
+LAYOUT_OPTIONS = {
+    "bar_height_ratio": 0.12,
+    "bar_height_px": None,
+    "padding_x_px": 24,
+    "padding_y_px": 16,
+    "font_path": None,
+    "min_font_px": 14,
+    "wrap_text": True,
+    "bar_color": "white",
+    "text_color": "black",
+}
+
+
+@dataclass
+class BenchmarkResult:
+    """
+    Measurements of one benchmark case, taken in a fresh process so caches start cold.
+    `peak_rss_kb` is the peak resident set size of that process.
+    """
+
+    wall_s: float
+    peak_rss_kb: int
+    font_loads: int
+    measure_calls: int
+    output_bytes: int
+
+
+def _peak_rss_kb() -> int:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss
+
+
+def _make_large_png(path: str) -> None:
+    noise = Image.effect_noise((4000, 3000), 64)
+    gradient = Image.linear_gradient("L").resize((4000, 3000))
+    Image.merge(
+        "RGB", (noise, gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT))
+    ).save(path)
+
+
+def _make_gif(path: str, frames: int, size: tuple[int, int], transparent: bool) -> None:
+    gif_frames = []
+    for frame_index in range(frames):
+        frame = Image.new("P", size, 0)
+        frame.putpalette([value for i in range(256) for value in (i, 255 - i, i // 2)])
+        draw = ImageDraw.Draw(frame)
+        x = frame_index * 7 % size[0]
+        draw.rectangle(
+            (x, 20, x + size[0] // 4, size[1] - 20), fill=frame_index % 255 + 1
+        )
+        # Every fourth frame repeats the one before it
+        gif_frames.append(gif_frames[-1] if frame_index % 4 == 3 else frame)
+    options: dict[str, Any] = {"transparency": 0, "disposal": 2} if transparent else {}
+    gif_frames[0].save(
+        path,
+        save_all=True,
+        append_images=gif_frames[1:],
+        duration=40,
+        loop=0,
+        **options,
+    )
+
+
+def make_fixtures(directory: str) -> dict[str, str]:
+    """
+    Generates the synthetic inputs into directory and returns their paths by name.
+    """
+
+    fixtures = {
+        "large_png": os.path.join(directory, "large.png"),
+        "long_gif": os.path.join(directory, "long.gif"),
+        "transparent_gif": os.path.join(directory, "transparent.gif"),
+    }
+    _make_large_png(fixtures["large_png"])
+    _make_gif(fixtures["long_gif"], 400, (480, 360), transparent=False)
+    _make_gif(fixtures["transparent_gif"], 60, (320, 240), transparent=True)
+    return fixtures
+
+
+def _run_case(
+    input_path: str | None, title: str, output_dir: str, options: dict[str, Any]
+) -> BenchmarkResult:
+    """
+    Renders one case, or only lays out the title when input_path is None, and measures it.
+    """
+
+    measure_calls = 0
+    measure = generator._measure
+
+    def counting_measure(*args, **kwargs):
+        nonlocal measure_calls
+        measure_calls += 1
+        return measure(*args, **kwargs)
+
+    generator._measure = counting_measure
+    output_bytes = 0
+    start = time.perf_counter()
+    if input_path is None:
+        for width in range(200, 2001, 50):
+            generator._prepare_layout(
+                (width, width), title, **{**LAYOUT_OPTIONS, **options}
+            )
+    else:
+        extension = os.path.splitext(input_path)[1]
+        output_path = os.path.join(output_dir, f"output{extension}")
+        file_sizes = generator.add_title_above_file(
+            input_path, title, output_path, **options
+        )
+        output_bytes = sum(file_sizes.values())
+    wall_s = time.perf_counter() - start
+
+    return BenchmarkResult(
+        wall_s=wall_s,
+        peak_rss_kb=_peak_rss_kb(),
+        font_loads=generator._load_font.cache_info().misses,
+        measure_calls=measure_calls,
+        output_bytes=output_bytes,
+    )
+
+
+def benchmark_cases(
+    fixtures: dict[str, str], corpus: list[str]
+) -> dict[str, tuple[str | None, str, dict[str, Any]]]:
+    """
+    All cases by name, as (input path or None for layout only, title, options).
+    """
+
+    cases: dict[str, tuple[str | None, str, dict[str, Any]]] = {
+        "layout_short_title": (None, SHORT_TITLE, {}),
+        "layout_long_title": (None, LONG_TITLE, {}),
+        "large_png": (fixtures["large_png"], SHORT_TITLE, {}),
+        "large_png_long_title": (fixtures["large_png"], LONG_TITLE, {}),
+        "large_png_max_dimension": (
+            fixtures["large_png"],
+            SHORT_TITLE,
+            {"max_dimension": 1080},
+        ),
+        "long_gif": (fixtures["long_gif"], SHORT_TITLE, {}),
+        "long_gif_budget": (
+            fixtures["long_gif"],
+            SHORT_TITLE,
+            {"gif_max_bytes": 100 * 1024},
+        ),
+        "transparent_gif": (fixtures["transparent_gif"], LONG_TITLE, {}),
+    }
+    for path in corpus:
+        source = os.path.basename(os.path.dirname(path))
+        name = os.path.splitext(os.path.basename(path))[0].removeprefix("original_")
+        cases[f"corpus_{source}_{name}"] = (path, SHORT_TITLE, {})
+    return cases
+
+
+def run_benchmarks(
+    cases: dict[str, tuple[str | None, str, dict[str, Any]]],
+    output_dir: str,
+    repeat: int = 1,
+) -> dict[str, BenchmarkResult]:
+    """
+    Runs every case `repeat` times, each in its own spawned process, keeping the fastest run.
+    """
+
+    results: dict[str, BenchmarkResult] = {}
+    with ProcessPoolExecutor(
+        1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1
+    ) as pool:
+        for name, (input_path, title, options) in cases.items():
+            runs = [
+                pool.submit(_run_case, input_path, title, output_dir, options).result()
+                for _ in range(repeat)
+            ]
+            results[name] = min(runs, key=lambda result: result.wall_s)
+            _write_line(f"{name}: {results[name].wall_s:.3f}s")
+    return results
+
+
+def _write_line(line: str) -> None:
+    sys.stderr.write(line + "\n")
+
+
+def format_table(
+    results: dict[str, BenchmarkResult],
+    baseline: dict[str, BenchmarkResult] | None = None,
+) -> str:
+    """
+    Formats the results as a table, with the change against baseline when given.
+    """
+
+    columns = list(BenchmarkResult.__dataclass_fields__)
+    rows = [["case", *columns]]
+    for name, result in results.items():
+        row = [name]
+        for column in columns:
+            value = getattr(result, column)
+            cell = f"{value:.3f}" if isinstance(value, float) else str(value)
+            previous = getattr(baseline.get(name), column, None) if baseline else None
+            if previous:
+                cell += f" ({(value - previous) / previous:+.0%})"
+            row.append(cell)
+        rows.append(row)
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+def load_results(path: str) -> dict[str, BenchmarkResult]:
+    with open(path, encoding="utf-8") as f:
+        return {
+            name: BenchmarkResult(**result)
+            for name, result in json.load(f)["cases"].items()
+        }
+
+
+def save_results(path: str, results: dict[str, BenchmarkResult]) -> None:
+    payload = {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "machine": platform.machine(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "cases": {name: asdict(result) for name, result in results.items()},
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2)
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Benchmarks the title generator on synthetic fixtures and the memes corpus.
+    Run from the repository root: python python-memer/benchmark.py --output results.json
+    """
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument(
+        "--compare", help="JSON results of an earlier run to compare to"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per case, fastest is kept"
+    )
+    parser.add_argument(
+        "--filter", default="", help="only run cases containing this text"
+    )
+    parser.add_argument(
+        "--no-corpus", action="store_true", help=f"skip the {CORPUS_GLOB} files"
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated in another process, so their memory doesn't count towards the
+        # peak RSS the case processes inherit from this one
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            fixtures = pool.submit(make_fixtures, directory).result()
+        corpus = [] if args.no_corpus else sorted(glob.glob(CORPUS_GLOB))
+        cases: dict[str, Any] = {
+            name: case
+            for name, case in benchmark_cases(fixtures, corpus).items()
+            if args.filter in name
+        }
+        results = run_benchmarks(cases, directory, args.repeat)
+
+    if args.output:
+        save_results(args.output, results)
+    baseline = load_results(args.compare) if args.compare else None
+    sys.stdout.write(format_table(results, baseline) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from dataclasses import asdict, dataclass
+
+logger = logging.getLogger(__name__)
+
+CACHE_MANIFEST_PATH = "./memes/.cache/manifest.json"
+
+
+@dataclass
+class CacheEntry:
+    """
+    What was published for a media url: the HTTP validators and content hash of the original,
+    and the render signature of the edited file.
+    """
+
+    og_path: str
+    edited_path: str
+    etag: str | None = None
+    last_modified: str | None = None
+    content_hash: str | None = None
+    render_hash: str | None = None
+    # Unix time the files were last written
+    published_at: float | None = None
+
+
+class CacheManifest:
+    """
+    On-disk manifest keyed by media url, used to skip downloads and renders of unchanged memes.
+    The manifest is committed together with the memes, so an entry describes the files in the repo
+    even when they are not checked out locally.
+    """
+
+    def __init__(self, path: str, entries: dict[str, CacheEntry] | None = None):
+        self.path = path
+        self.entries = entries or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str | None = None) -> "CacheManifest | None":
+        """
+        Loads the manifest from `path`, `MEME_CACHE_MANIFEST` or the default location.
+        Returns None when caching is disabled with an empty `MEME_CACHE_MANIFEST`.
+        """
+
+        if path is None:
+            path = os.environ.get("MEME_CACHE_MANIFEST", CACHE_MANIFEST_PATH)
+        if not path:
+            return None
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                raw_entries = json.load(f)
+        except FileNotFoundError:
+            raw_entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable cache manifest %s: %s", path, e)
+            raw_entries = {}
+
+        return cls(
+            path, {url: CacheEntry(**entry) for url, entry in raw_entries.items()}
+        )
+
+    def lookup(self, url: str, og_path: str, edited_path: str) -> CacheEntry | None:
+        """
+        Returns the entry for `url` if it was published to the same paths.
+        """
+
+        with self._lock:
+            entry = self.entries.get(url)
+        if entry is None or (entry.og_path, entry.edited_path) != (
+            og_path,
+            edited_path,
+        ):
+            return None
+        return entry
+
+    def store(self, url: str, entry: CacheEntry) -> None:
+        """
+        Records `entry` for `url` and drops entries of older memes published to the same paths.
+        """
+
+        with self._lock:
+            self.entries = {
+                other_url: other_entry
+                for other_url, other_entry in self.entries.items()
+                if other_entry.og_path != entry.og_path
+                and other_entry.edited_path != entry.edited_path
+            }
+            self.entries[url] = entry
+
+    def rerendered(self, og_path: str, render_hash: str) -> bool:
+        """
+        Records that the edited file of the original at og_path was rendered again with other settings.
+        Returns False when there is no entry for og_path.
+        """
+
+        found = False
+        with self._lock:
+            for entry in self.entries.values():
+                if os.path.normpath(entry.og_path) == os.path.normpath(og_path):
+                    entry.render_hash = render_hash
+                    found = True
+        return found
+
+    def published_at(self, source: str) -> float | None:
+        """
+        When `source` last published a file, None when it never did.
+        """
+
+        prefix = f"./memes/{source}/"
+        with self._lock:
+            return max(
+                (
+                    entry.published_at
+                    for entry in self.entries.values()
+                    if entry.published_at is not None
+                    and entry.og_path.startswith(prefix)
+                ),
+                default=None,
+            )
+
+    def save(self) -> None:
+        """
+        Writes the manifest atomically, sorted so the git diff only shows real changes.
+        """
+
+        with self._lock:
+            raw_entries = {url: asdict(entry) for url, entry in self.entries.items()}
+
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(raw_entries, f, indent=2, sort_keys=True)
+            f.write("\n")
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+from urllib.parse import urlsplit
+
+from image.fingerprint import hash_distance
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PATH = "./memes/.cache/history.jsonl"
+# How long a published meme counts as a duplicate
+HISTORY_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+# Perceptual hashes at most this many bits apart are the same picture
+DUPLICATE_DISTANCE = 10
+
+
+def url_hash(url: str) -> str:
+    """
+    Short hash of a media url without its query, which only selects a size or carries a signature.
+    """
+
+    url = urlsplit(url)._replace(query="", fragment="").geturl()
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class HistoryRecord:
+    """
+    A published meme: the hash of its media url, the perceptual hash of its picture as hex and
+    the unix time it was published.
+    """
+
+    url: str
+    perceptual_hash: str | None
+    source: str
+    published_at: float
+
+    def matches(self, url: str, perceptual_hash: int | None) -> bool:
+        if self.url == url:
+            return True
+        return (
+            perceptual_hash is not None
+            and self.perceptual_hash is not None
+            and hash_distance(int(self.perceptual_hash, 16), perceptual_hash)
+            <= DUPLICATE_DISTANCE
+        )
+
+
+class HistoryIndex:
+    """
+    Append-only index of the memes published over the last HISTORY_MAX_AGE_SECONDS, used to skip
+    memes that already went out, whether from the same source, another source or an earlier day.
+    Within a run, the pipeline claims the memes the listings picked, so two sources never publish
+    the same one.
+    The file is committed together with the memes, one JSON record per line.
+    """
+
+    def __init__(self, path: str, records: list[HistoryRecord] | None = None):
+        self.path = path
+        self.records = records or []
+        self._loaded_records = len(self.records)
+        # Memes picked in this run by source, keyed by url hash
+        self._claims: dict[str, HistoryRecord] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str | None = None) -> "HistoryIndex | None":
+        """
+        Loads the index from `path`, `MEME_HISTORY` or the default location.
+        Returns None when deduplication is disabled with an empty `MEME_HISTORY`.
+        """
+
+        if path is None:
+            path = os.environ.get("MEME_HISTORY", HISTORY_PATH)
+        if not path:
+            return None
+
+        records = []
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        records.append(HistoryRecord(**json.loads(line)))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning("Ignoring unreadable history %s: %s", path, e)
+            records = []
+        return cls(path, records)
+
+    def _duplicate_of(
+        self, key: str, source: str, perceptual_hash: int | None
+    ) -> HistoryRecord | None:
+        oldest = time.time() - HISTORY_MAX_AGE_SECONDS
+        own_claim = self._claims.get(key)
+        others = [
+            claim
+            for claim in self._claims.values()
+            if claim is not own_claim or claim.source != source
+        ]
+        for record in [*self.records, *others]:
+            if record.published_at >= oldest and record.matches(key, perceptual_hash):
+                return record
+        return None
+
+    def is_duplicate(
+        self, media_url: str, source: str, perceptual_hash: int | None = None
+    ) -> bool:
+        """
+        Checks a candidate like `claim` without reserving it.
+        """
+
+        with self._lock:
+            return (
+                self._duplicate_of(url_hash(media_url), source, perceptual_hash)
+                is not None
+            )
+
+    def claim(
+        self, media_url: str, source: str, perceptual_hash: int | None = None
+    ) -> bool:
+        """
+        Reserves a meme for `source` unless it was published recently or claimed by another source
+        in this run. Claiming again with the perceptual hash, e.g. once the picture is downloaded,
+        also checks the picture. Returns False for a duplicate.
+        """
+
+        key = url_hash(media_url)
+        with self._lock:
+            duplicate_of = self._duplicate_of(key, source, perceptual_hash)
+            if duplicate_of is not None:
+                logger.info(
+                    "Skipping %s for %s, already published by %s",
+                    media_url,
+                    source,
+                    duplicate_of.source,
+                )
+                return False
+
+            self._claims[key] = HistoryRecord(
+                key, _hex(perceptual_hash), source, time.time()
+            )
+            return True
+
+    def record(
+        self, media_url: str, source: str, perceptual_hash: int | None = None
+    ) -> None:
+        """
+        Adds a published meme, to be written on `save`.
+        """
+
+        key = url_hash(media_url)
+        with self._lock:
+            claim = self._claims.get(key)
+            hex_hash = _hex(perceptual_hash)
+            if hex_hash is None and claim is not None:
+                hex_hash = claim.perceptual_hash
+            self.records.append(HistoryRecord(key, hex_hash, source, time.time()))
+
+    def save(self) -> None:
+        """
+        Appends the records added in this run. Once most of the file has expired it is rewritten
+        with the records that still count. Ends the run, so the next one starts without claims.
+        """
+
+        oldest = time.time() - HISTORY_MAX_AGE_SECONDS
+        with self._lock:
+            self._claims.clear()
+            new_records = self.records[self._loaded_records :]
+            live_records = [
+                record for record in self.records if record.published_at >= oldest
+            ]
+            compact = len(live_records) * 2 < len(self.records)
+            if compact:
+                self.records = live_records
+            self._loaded_records = len(self.records)
+
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        if not compact:
+            if new_records:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.writelines(_record_line(record) for record in new_records)
+            return
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.writelines(_record_line(record) for record in live_records)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, self.path)
+
+
+def _hex(perceptual_hash: int | None) -> str | None:
+    return None if perceptual_hash is None else f"{perceptual_hash:016x}"
+
+
+def _record_line(record: HistoryRecord) -> str:
+    return json.dumps(asdict(record), sort_keys=True) + "\n"
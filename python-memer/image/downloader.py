@@ -1,18 +1,500 @@
+import functools
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+import instrumentation
 import requests
-from base import USER_AGENT_HEADERS
+from base import HTTP_TIMEOUT, get_http_session, get_with_retries
+from PIL import Image
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+MAX_DOWNLOAD_BYTES = 50 * 1024 * 1024
+ALLOWED_CONTENT_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+CHUNK_SIZE = 64 * 1024
+SNIFF_BYTES = 16
+MAX_THUMBNAIL_BYTES = 512 * 1024
+# Smallest width and height of a downloaded image that is worth a title
+MIN_IMAGE_SIDE = 32
+# Bodies up to this size are kept in memory for the renderer, larger ones are read from their file
+MAX_IN_MEMORY_BYTES = 8 * 1024 * 1024
+
+# Leading bytes of the formats we can tell apart, as (offset, magic, content type)
+MAGIC_NUMBERS = (
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (4, b"ftyp", "video/mp4"),
+)
+
+
+@dataclass
+class Download:
+    """
+    Result of a download. `not_modified` is set when the server answered a conditional GET with 304,
+    or when the body hashed the same as `known_hash`; in both cases `path` was left untouched.
+    `body` is the downloaded file when it was small enough to keep in memory, see `image`.
+    """
+
+    path: str
+    content_hash: str | None
+    etag: str | None = None
+    last_modified: str | None = None
+    not_modified: bool = False
+    body: bytes | None = field(default=None, repr=False)
+
+    @property
+    def image(self) -> str | bytes:
+        """
+        What to decode the image from: the body kept in memory, or else the file at `path`.
+        """
+
+        return self.body if self.body is not None else self.path
+
+
+class SpeculativeBudget:
+    """
+    Caps the bytes fetched by speculative downloads, the candidates downloaded in case the ones
+    ranked above them fail. Shared by all downloads of a run and thread safe.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.fetched_bytes = 0
+        self.wasted_bytes = 0
+        self._lock = threading.Lock()
+
+    def spend(self, size: int) -> bool:
+        """
+        Charges `size` bytes, False when they don't fit in the budget any more.
+        """
+
+        with self._lock:
+            if self.fetched_bytes + size > self.max_bytes:
+                return False
+            self.fetched_bytes += size
+            return True
+
+    def waste(self, size: int) -> None:
+        """
+        Records bytes fetched speculatively for a candidate that was not used.
+        """
+
+        with self._lock:
+            self.wasted_bytes += size
+
+    def exhausted(self) -> bool:
+        with self._lock:
+            return self.fetched_bytes >= self.max_bytes
+
+
+class DownloadTicket:
+    """
+    Handle on one running download. `cancel` stops it at its next chunk, and while it is
+    speculative every chunk is charged to the budget, which stops it once the budget is spent.
+    `stopped` tells a stopped download apart from a failed one.
+    """
+
+    def __init__(self, budget: SpeculativeBudget | None = None):
+        self.budget = budget
+        self.speculative_bytes = 0
+        self.cancelled = False
+        self.stopped = False
+
+    def promote(self) -> None:
+        """
+        The download is needed after all, its remaining chunks are no longer speculative.
+        """
+
+        self.budget = None
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def allow(self, size: int) -> bool:
+        if self.cancelled or (self.budget is not None and not self.budget.spend(size)):
+            self.stopped = True
+            return False
+        if self.budget is not None:
+            self.speculative_bytes += size
+        return True
+
+
+def _conditional_headers(etag: str | None, last_modified: str | None) -> dict[str, str]:
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def _is_acceptable(
+    url: str,
+    headers: Mapping[str, str],
+    max_bytes: int,
+    allowed_content_types: tuple[str, ...],
+) -> bool:
+    """
+    Checks the Content-Type and Content-Length of a response before its body is read.
+    """
+
+    content_type = headers.get("Content-Type", "")
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type not in allowed_content_types:
+        logger.warning("Skipping %s with content type %r", url, content_type)
+        return False
+
+    content_length = headers.get("Content-Length")
+    if content_length and int(content_length) > max_bytes:
+        logger.warning("Skipping %s of %s bytes", url, content_length)
+        return False
+    return True
+
+
+def _not_modified(
+    str_path: str,
+    headers: Mapping[str, str],
+    etag: str | None,
+    last_modified: str | None,
+    known_hash: str | None,
+) -> Download:
+    return Download(
+        path=str_path,
+        content_hash=known_hash,
+        etag=headers.get("ETag", etag),
+        last_modified=headers.get("Last-Modified", last_modified),
+        not_modified=True,
+    )
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _PartialFile:
+    """
+    Temp file next to `str_path` that receives the body while hashing it, and is renamed
+    into place on `publish`. It is removed when the download does not complete.
+    Bodies of at most `keep_bytes` are also kept in memory, so they are not read back from disk.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        str_path: str,
+        max_bytes: int,
+        ticket: DownloadTicket | None = None,
+        keep_bytes: int = 0,
+    ):
+        self.url = url
+        self.str_path = str_path
+        self.max_bytes = max_bytes
+        self.ticket = ticket
+        self.keep_bytes = keep_bytes
+        self.content_hash = hashlib.sha256()
+        self.written_bytes = 0
+        self.body = io.BytesIO() if keep_bytes > 0 else None
+
+    def __enter__(self) -> "_PartialFile":
+        fd, self.temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.str_path) or ".", prefix=".", suffix=".part"
+        )
+        self.file = os.fdopen(fd, "wb")
+        return self
 
+    def write(self, chunk: bytes) -> None:
+        self.written_bytes += len(chunk)
+        if self.written_bytes > self.max_bytes:
+            logger.warning(
+                "Skipping %s, body exceeds %d bytes", self.url, self.max_bytes
+            )
+            raise _BodyTooLarge
+        if self.ticket is not None and not self.ticket.allow(len(chunk)):
+            logger.info("Stopped downloading %s", self.url)
+            raise _Stopped
+        self.content_hash.update(chunk)
+        self.file.write(chunk)
+        if self.body is not None:
+            if self.written_bytes > self.keep_bytes:
+                # Too large to keep, the renderer maps the file instead
+                self.body = None
+            else:
+                self.body.write(chunk)
 
-def download_image(url: str, str_path: str):
+    def publish(self, headers: Mapping[str, str], known_hash: str | None) -> Download:
+        """
+        Moves the body into place, unless it hashed the same as the file already there.
+        """
+
+        self.file.close()
+        instrumentation.count("download.bytes", self.written_bytes)
+        download = Download(
+            path=self.str_path,
+            content_hash=self.content_hash.hexdigest(),
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            body=self.body.getvalue() if self.body is not None else None,
+        )
+        if download.content_hash == known_hash and os.path.exists(self.str_path):
+            # Byte-identical to what we already have, keep the old file untouched
+            download.not_modified = True
+        else:
+            os.chmod(self.temp_path, 0o644)
+            os.replace(self.temp_path, self.str_path)
+        return download
+
+    def __exit__(self, *exc_info) -> bool:
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.unlink(self.temp_path)
+        # An oversized or stopped body is a rejected download, not an error
+        return exc_info[0] in (_BodyTooLarge, _Stopped)
+
+
+def fetch_image(
+    url: str,
+    str_path: str,
+    *,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    known_hash: str | None = None,
+    max_bytes: int = MAX_DOWNLOAD_BYTES,
+    allowed_content_types: tuple[str, ...] = ALLOWED_CONTENT_TYPES,
+    timeout: float | tuple[float, float] = HTTP_TIMEOUT,
+    ticket: DownloadTicket | None = None,
+    keep_bytes: int = 0,
+) -> Download | None:
+    """
+    Downloads the image from a url, revalidating with `etag`/`last_modified` when given.
+    The body is streamed into a temp file next to `str_path` and renamed into place once complete,
+    so `str_path` never holds a partial download. Returns None when the download is rejected, fails
+    or is stopped by its `ticket`. A body of at most `keep_bytes` is also returned in memory.
+    """
+
+    try:
+        with get_http_session().get(
+            url,
+            headers=_conditional_headers(etag, last_modified),
+            stream=True,
+            timeout=timeout,
+        ) as response:
+            if response.status_code == 304:
+                return _not_modified(
+                    str_path, response.headers, etag, last_modified, known_hash
+                )
+            if not response.ok or not _is_acceptable(
+                url, response.headers, max_bytes, allowed_content_types
+            ):
+                return None
+
+            with _PartialFile(
+                url, str_path, max_bytes, ticket, keep_bytes
+            ) as partial_file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    partial_file.write(chunk)
+                return partial_file.publish(response.headers, known_hash)
+    except requests.RequestException as e:
+        logger.warning("Could not download %s: %s", url, e)
+    return None
+
+
+async def fetch_image_async(
+    session: "aiohttp.ClientSession",
+    url: str,
+    str_path: str,
+    *,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    known_hash: str | None = None,
+    max_bytes: int = MAX_DOWNLOAD_BYTES,
+    allowed_content_types: tuple[str, ...] = ALLOWED_CONTENT_TYPES,
+    ticket: DownloadTicket | None = None,
+    keep_bytes: int = 0,
+) -> Download | None:
+    """
+    Async variant of `fetch_image` on an aiohttp session, with the same checks and results.
+    """
+
+    import aiohttp
+
+    try:
+        async with await get_with_retries(
+            session, url, headers=_conditional_headers(etag, last_modified)
+        ) as response:
+            if response.status == 304:
+                return _not_modified(
+                    str_path, response.headers, etag, last_modified, known_hash
+                )
+            if not response.ok or not _is_acceptable(
+                url, response.headers, max_bytes, allowed_content_types
+            ):
+                return None
+
+            with _PartialFile(
+                url, str_path, max_bytes, ticket, keep_bytes
+            ) as partial_file:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    partial_file.write(chunk)
+                return partial_file.publish(response.headers, known_hash)
+    except (TimeoutError, aiohttp.ClientError) as e:
+        logger.warning("Could not download %s: %s", url, e)
+    return None
+
+
+def validate_image(image: str | bytes) -> str | None:
+    """
+    Reads the header of a downloaded image file or body, and the frame table of an animation,
+    without decoding the pixels. Returns why it can't be rendered, or None when it looks fine.
+    """
+
+    try:
+        with Image.open(
+            io.BytesIO(image) if isinstance(image, bytes) else image
+        ) as image:
+            width, height = image.size
+            if min(width, height) < MIN_IMAGE_SIDE:
+                return f"{width}x{height} is too small"
+            if Image.MAX_IMAGE_PIXELS and width * height > Image.MAX_IMAGE_PIXELS:
+                return f"{width}x{height} is too large"
+            # Walks the frames, so a truncated animation fails here instead of in the renderer
+            if getattr(image, "n_frames", 1) < 1:
+                return "no frames"
+    except (OSError, ValueError, EOFError, Image.DecompressionBombError) as e:
+        return str(e) or type(e).__name__
+    return None
+
+
+def download_image(url: str, str_path: str, **kwargs) -> str | None:
     """
     Function for downloading the image from a url.
     Supports the normal .jpeg, .jpg, .png, .gif urls.
     """
 
-    image_response = requests.get(url, headers=USER_AGENT_HEADERS)
-    if not image_response.ok:
+    download = fetch_image(url, str_path, **kwargs)
+    return download.path if download is not None else None
+
+
+def fetch_thumbnail(
+    url: str, *, timeout: float | tuple[float, float] = HTTP_TIMEOUT
+) -> bytes | None:
+    """
+    Downloads a small preview image into memory, None when it fails or exceeds MAX_THUMBNAIL_BYTES.
+    """
+
+    try:
+        with get_http_session().get(url, stream=True, timeout=timeout) as response:
+            if not response.ok:
+                return None
+            body = response.raw.read(MAX_THUMBNAIL_BYTES + 1, decode_content=True)
+    except requests.RequestException as e:
+        logger.warning("Could not download thumbnail %s: %s", url, e)
         return None
+    return body if len(body) <= MAX_THUMBNAIL_BYTES else None
+
+
+async def fetch_thumbnail_async(
+    session: "aiohttp.ClientSession", url: str
+) -> bytes | None:
+    """
+    Async variant of `fetch_thumbnail` on an aiohttp session.
+    """
+
+    import aiohttp
+
+    try:
+        async with await get_with_retries(session, url) as response:
+            if not response.ok:
+                return None
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                body += chunk
+                if len(body) > MAX_THUMBNAIL_BYTES:
+                    return None
+    except (TimeoutError, aiohttp.ClientError) as e:
+        logger.warning("Could not download thumbnail %s: %s", url, e)
+        return None
+    return bytes(body)
+
+
+def _content_type_from_magic(head: bytes, content_type: str) -> str | None:
+    for offset, magic, magic_content_type in MAGIC_NUMBERS:
+        if head[offset : offset + len(magic)] == magic:
+            return magic_content_type
+    return content_type.split(";")[0].strip().lower() or None
+
+
+@functools.lru_cache(maxsize=1024)
+def sniff_content_type(
+    url: str, *, timeout: float | tuple[float, float] = HTTP_TIMEOUT
+) -> str | None:
+    """
+    Works out the content type of a url from its magic bytes, requesting only the first SNIFF_BYTES
+    with a Range header. Falls back to the Content-Type header when the bytes are not recognised.
+    Results are cached per url; returns None when the request fails.
+    """
+
+    try:
+        with get_http_session().get(
+            url,
+            headers={"Range": f"bytes=0-{SNIFF_BYTES - 1}"},
+            stream=True,
+            timeout=timeout,
+        ) as response:
+            if not response.ok:
+                return None
+            head = response.raw.read(SNIFF_BYTES, decode_content=True)
+            content_type = response.headers.get("Content-Type", "")
+    except requests.RequestException as e:
+        logger.warning("Could not sniff %s: %s", url, e)
+        return None
+
+    return _content_type_from_magic(head, content_type)
+
+
+_sniffed_content_types: dict[str, str | None] = {}
+
+
+async def sniff_content_type_async(
+    session: "aiohttp.ClientSession", url: str
+) -> str | None:
+    """
+    Async variant of `sniff_content_type` on an aiohttp session, also cached per url.
+    """
+
+    import aiohttp
+
+    if url in _sniffed_content_types:
+        return _sniffed_content_types[url]
 
-    with open(str_path, "wb") as f:
-        f.write(image_response.content)
+    content_type = None
+    try:
+        async with await get_with_retries(
+            session, url, headers={"Range": f"bytes=0-{SNIFF_BYTES - 1}"}
+        ) as response:
+            if response.ok:
+                head = await response.content.read(SNIFF_BYTES)
+                content_type = _content_type_from_magic(
+                    head, response.headers.get("Content-Type", "")
+                )
+    except (TimeoutError, aiohttp.ClientError) as e:
+        logger.warning("Could not sniff %s: %s", url, e)
 
-    return str_path
+    _sniffed_content_types[url] = content_type
+    return content_type
@@ -0,0 +1,48 @@
+import io
+
+from PIL import Image
+
+# dHash compares each pixel with its right neighbour on a (HASH_SIZE + 1) x HASH_SIZE grayscale frame
+HASH_SIZE = 8
+
+
+def perceptual_hash(image: str | bytes) -> int:
+    """
+    64 bit difference hash (dHash) of the first frame of an image file path or encoded image.
+    It only depends on the rough gradients, so rescaled, recompressed and thumbnail copies of
+    the same picture hash to the same or a nearby value.
+    """
+
+    with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as img:
+        # JPEGs are decoded at a fraction of their size, we only need a tiny frame
+        img.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        frame = img.convert("L").resize(
+            (HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX
+        )
+
+    pixels = list(frame.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            value = value << 1 | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+    return value
+
+
+def hash_distance(first: int, second: int) -> int:
+    """
+    Number of differing bits, 0 for identical pictures.
+    """
+
+    return (first ^ second).bit_count()
+
+
+def try_perceptual_hash(image: str | bytes) -> int | None:
+    """
+    `perceptual_hash`, or None when the image can't be read.
+    """
+
+    try:
+        return perceptual_hash(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
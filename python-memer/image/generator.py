@@ -1,13 +1,104 @@
+import functools
+import hashlib
+import inspect
+import io
+import json
+import logging
 import os
-from typing import Any
+import tempfile
+import time
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from typing import IO, Any, TypeVar
 
-from PIL import Image, ImageDraw, ImageFont
-from pygifsicle import gifsicle
+import instrumentation
+from PIL import GifImagePlugin, Image, ImageChops, ImageDraw, ImageFont
 
+logger = logging.getLogger(__name__)
 
-def _candidate_fonts() -> list[str]:
-    """Return a list of existing font file paths to try in order."""
-    return [
+T = TypeVar("T")
+
+GIF_MAX_BYTES = 30 * 1024 * 1024
+RENDITION_MIN_QUALITY = 30
+# Frames kept for the animated renditions of a GIF, counting their RGB(A) copies
+RENDITION_FRAMES_MAX_BYTES = 64 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Rendition:
+    """
+    Extra encoding written next to the main output, at the output path with its extension replaced by `suffix`.
+    Animated GIFs get an animated rendition. `max_height` downscales, and when the encoded file is over
+    `max_bytes` the quality is stepped down until it fits or reaches RENDITION_MIN_QUALITY.
+    """
+
+    suffix: str = ".webp"
+    format: str = "WEBP"
+    quality: int = 80
+    lossless: bool = False
+    max_height: int | None = None
+    max_bytes: int | None = None
+
+    def path_for(self, output_path: str) -> str:
+        return os.path.splitext(output_path)[0] + self.suffix
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """
+    How a static PNG output is encoded. `compress_level` and `optimize` go to Pillow's PNG encoder.
+    An image with at most `palette_colors` distinct colors is stored as a palette PNG, which is
+    lossless for it. When the file is over `max_bytes`, the search tries the strongest compression,
+    then adaptive palettes of QUANTIZE_STEPS colors down to `min_colors`, and keeps the first that fits.
+    """
+
+    compress_level: int = 6
+    optimize: bool = False
+    palette_colors: int = 0
+    max_bytes: int | None = None
+    min_colors: int = 64
+
+
+# Named profiles for the `encoding` render option, from the quickest to encode to the smallest file
+ENCODING_PROFILES = {
+    "fast": EncodingProfile(compress_level=1),
+    "balanced": EncodingProfile(compress_level=6, palette_colors=256),
+    "smallest": EncodingProfile(
+        compress_level=9, optimize=True, palette_colors=256, max_bytes=1024 * 1024
+    ),
+}
+QUANTIZE_STEPS = (256, 128, 64, 32)
+
+
+@dataclass
+class EncodeStats:
+    """
+    How a written file was encoded: the settings the search settled on and the seconds it took.
+    """
+
+    settings: str
+    seconds: float
+
+
+class RenderedFiles(dict[str, int]):
+    """
+    Size in bytes of every file written by `add_title_above_file`, by path.
+    `encodings` has the `EncodeStats` of the same files.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encodings: dict[str, EncodeStats] = {}
+
+    def add(self, path: str, size: int, settings: str, seconds: float) -> None:
+        self[path] = size
+        self.encodings[path] = EncodeStats(settings, seconds)
+
+
+@functools.cache
+def _candidate_fonts() -> tuple[str, ...]:
+    """Return the existing font file paths to try in order, resolved once per process."""
+    return tuple(
         p
         for p in [
             "DejaVuSans.ttf",
@@ -19,11 +110,15 @@ def _candidate_fonts() -> list[str]:
             "/System/Library/Fonts/Supplemental/Arial.ttf",
         ]
         if os.path.exists(p)
-    ]
+    )
 
 
+@functools.lru_cache(maxsize=512)
 def _load_font(font_size_px: int, font_path: str | None) -> ImageFont.ImageFont:
-    """Load a truetype font, falling back to common system fonts, then default."""
+    """
+    Load a truetype font, falling back to common system fonts, then default.
+    Cached per (size, path), so `_load_font.cache_info().misses` counts the font files parsed.
+    """
     if font_path:
         try:
             return ImageFont.truetype(font_path, font_size_px)
@@ -50,6 +145,33 @@ def _measure(
         return draw_ctx.multiline_textsize(text, font=font, spacing=4)
 
 
+def _width_tolerance(font: ImageFont.ImageFont) -> float:
+    """
+    Upper bound on how far summed advance widths can be from the measured bbox width.
+    Bearings and kerning stay well within a quarter em, so half an em plus a little is safe.
+    """
+    return getattr(font, "size", 10) / 2 + 2
+
+
+def _fits(
+    draw_ctx: ImageDraw.ImageDraw,
+    text: str,
+    font: ImageFont.ImageFont,
+    estimated_width: float,
+    max_width_px: int,
+) -> bool:
+    """
+    Decide whether text fits max_width_px from its summed advance width,
+    only falling back to a full measure when the estimate is too close to call.
+    """
+    tolerance = _width_tolerance(font)
+    if estimated_width + tolerance <= max_width_px:
+        return True
+    if estimated_width - tolerance > max_width_px:
+        return False
+    return _measure(draw_ctx, text, font)[0] <= max_width_px
+
+
 def _break_word(
     draw_ctx: ImageDraw.ImageDraw,
     word: str,
@@ -59,14 +181,19 @@ def _break_word(
     """Break an overlong word into pieces that fit within max_width_px."""
     segments: list[str] = []
     current_segment = ""
+    segment_width = 0.0
     for ch in word:
+        ch_width = font.getlength(ch)
         candidate = current_segment + ch
-        width, _ = _measure(draw_ctx, candidate, font)
-        if width <= max_width_px or not current_segment:
+        if not current_segment or _fits(
+            draw_ctx, candidate, font, segment_width + ch_width, max_width_px
+        ):
             current_segment = candidate
+            segment_width += ch_width
         else:
             segments.append(current_segment)
             current_segment = ch
+            segment_width = ch_width
     if current_segment:
         segments.append(current_segment)
     return segments
@@ -78,26 +205,40 @@ def _wrap(
     font: ImageFont.ImageFont,
     max_width_px: int,
 ) -> str:
-    """Soft-wrap text to fit max_width_px, breaking long words as needed."""
+    """
+    Soft-wrap text to fit max_width_px, breaking long words as needed.
+    Lines are packed from per-word advance widths, so wrapping stays near-linear in the title length.
+    """
     words = text.split()
     if not words:
         return ""
+    space_width = font.getlength(" ")
     lines: list[str] = []
     current_line = ""
+    line_width = 0.0
     for word in words:
+        word_width = font.getlength(word)
         parts = (
             [word]
-            if _measure(draw_ctx, word, font)[0] <= max_width_px
+            if _fits(draw_ctx, word, font, word_width, max_width_px)
             else _break_word(draw_ctx, word, font, max_width_px)
         )
         for part in parts:
-            candidate_line = (current_line + " " + part) if current_line else part
-            if _measure(draw_ctx, candidate_line, font)[0] <= max_width_px:
+            part_width = word_width if part is word else font.getlength(part)
+            if current_line:
+                candidate_line = current_line + " " + part
+                candidate_width = line_width + space_width + part_width
+            else:
+                candidate_line = part
+                candidate_width = part_width
+            if _fits(draw_ctx, candidate_line, font, candidate_width, max_width_px):
                 current_line = candidate_line
+                line_width = candidate_width
             else:
                 if current_line:
                     lines.append(current_line)
                 current_line = part
+                line_width = part_width
     if current_line:
         lines.append(current_line)
     return "\n".join(lines)
@@ -138,33 +279,24 @@ def _fit(
     return fallback_font, _wrap(draw_ctx, text, fallback_font, max_width_px)
 
 
-def _prepare_layout(
-    frame_size: tuple[int, int],
+@functools.lru_cache(maxsize=256)
+def _fit_layout(
     title_text: str,
-    *,
-    bar_height_ratio: float,
-    bar_height_px: int | None,
+    frame_width: int,
+    bar_height: int,
     padding_x_px: int,
     padding_y_px: int,
     font_path: str | None,
     min_font_px: int,
     wrap_text: bool,
-    bar_color: str,
-    text_color: str,
-) -> dict[str, Any]:
+) -> tuple[int, ImageFont.ImageFont, str, tuple[int, int]]:
     """
-    Compute the title bar layout and text placement.
-    Returns a dict with explicit keys used by the compositor.
+    Fit the title into the bar, growing the bar if the text doesn't fit.
+    Cached, so batch renders of the same title and frame width reuse the wrap and font size.
+    Returns the final bar height, the font, the wrapped text and the text position.
     """
-    frame_width, frame_height = frame_size
-    bar_height = (
-        bar_height_px
-        if bar_height_px is not None
-        else max(1, int(frame_height * bar_height_ratio))
-    )
-
     # Use a scratch canvas to measure text
-    scratch_canvas = Image.new("RGB", (frame_width, frame_height), bar_color)
+    scratch_canvas = Image.new("RGB", (1, 1))
     draw_ctx = ImageDraw.Draw(scratch_canvas)
 
     text_max_width = max(1, frame_width - 2 * padding_x_px)
@@ -200,12 +332,51 @@ def _prepare_layout(
 
     text_x = (frame_width - text_width) // 2
     text_y = (bar_height - text_height) // 2
+    return bar_height, font, wrapped_text, (text_x, text_y)
+
+
+def _prepare_layout(
+    frame_size: tuple[int, int],
+    title_text: str,
+    *,
+    bar_height_ratio: float,
+    bar_height_px: int | None,
+    padding_x_px: int,
+    padding_y_px: int,
+    font_path: str | None,
+    min_font_px: int,
+    wrap_text: bool,
+    bar_color: str,
+    text_color: str,
+) -> dict[str, Any]:
+    """
+    Compute the title bar layout and text placement.
+    Returns a dict with explicit keys used by the compositor.
+    """
+    frame_width, frame_height = frame_size
+    bar_height = (
+        bar_height_px
+        if bar_height_px is not None
+        else max(1, int(frame_height * bar_height_ratio))
+    )
+
+    with instrumentation.span("layout"):
+        bar_height, font, wrapped_text, text_xy = _fit_layout(
+            title_text,
+            frame_width,
+            bar_height,
+            padding_x_px,
+            padding_y_px,
+            font_path,
+            min_font_px,
+            wrap_text,
+        )
 
     return {
         "bar_height": bar_height,
         "font": font,
         "wrapped_text": wrapped_text,
-        "text_xy": (text_x, text_y),
+        "text_xy": text_xy,
         "bar_color": bar_color,
         "text_color": text_color,
     }
@@ -237,6 +408,344 @@ def _compose_with_title(frame_rgb: Image.Image, layout: dict[str, Any]) -> Image
     return output_img
 
 
+def _render_title_bar(
+    frame_width: int, layout: dict[str, Any]
+) -> tuple[Image.Image, Image.Image | None]:
+    """
+    Rasterize the title bar once, so animated frames don't redraw the text.
+    Returns the bar and, when glyphs reach below the bar, the text mask for the frame rows they cover.
+    Pasting the text color through the mask gives the same pixels as drawing the text.
+    """
+    bar_height: int = layout["bar_height"]
+    text_kwargs = {"font": layout["font"], "spacing": 4, "align": "center"}
+
+    scratch_draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+    _, _, _, text_bottom = scratch_draw.multiline_textbbox(
+        layout["text_xy"], layout["wrapped_text"], **text_kwargs
+    )
+    text_mask = Image.new("L", (frame_width, max(bar_height, text_bottom)), 0)
+    ImageDraw.Draw(text_mask).multiline_text(
+        layout["text_xy"], layout["wrapped_text"], fill=255, **text_kwargs
+    )
+
+    title_bar = Image.new("RGB", (frame_width, bar_height), layout["bar_color"])
+    title_bar.paste(
+        layout["text_color"],
+        (0, 0),
+        text_mask.crop((0, 0, frame_width, bar_height)),
+    )
+
+    overflow_mask = None
+    if text_mask.height > bar_height:
+        overflow_mask = text_mask.crop((0, bar_height, frame_width, text_mask.height))
+    return title_bar, overflow_mask
+
+
+def _scaled_size(size: tuple[int, int], max_dimension: int | None) -> tuple[int, int]:
+    """Size with the longest side shrunk to max_dimension, keeping the aspect ratio."""
+    width, height = size
+    if max_dimension is None or max(width, height) <= max_dimension:
+        return size
+    scale = max_dimension / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _gif_working_set_bytes(
+    source_size: tuple[int, int], frame_size: tuple[int, int], bar_height: int
+) -> int:
+    """
+    Rough peak memory of rendering one GIF frame at a time. Frames are decoded and deduped at
+    source_size: the decoder's frame, the RGB frame and the previous one, and the diff image.
+    They are scaled to frame_size before the palettized canvas, frame and pending frame.
+    """
+    source_width, source_height = source_size
+    width, height = frame_size
+    scaled_bytes = 3 * width * height if frame_size != source_size else 0
+    return (
+        source_width * source_height * (4 + 3 + 3 + 3)
+        + scaled_bytes
+        + 3 * width * (height + bar_height)
+    )
+
+
+def _iter_titled_gif_frames(
+    input_img: Image.Image,
+    layout: dict[str, Any],
+    base_palette_img: Image.Image,
+    frame_step: int = 1,
+    frame_size: tuple[int, int] | None = None,
+) -> Iterator[tuple[Image.Image, int]]:
+    """
+    Decode, title and quantize the frames of input_img one at a time.
+    Yields every distinct palettized frame with its duration, duplicates extend the frame before them.
+    With frame_step > 1 only every frame_step-th frame is kept, the others extend the kept frame.
+    Frames are scaled to frame_size when it differs from the input size.
+    """
+    gif_width, gif_height = frame_size or input_img.size
+    num_frames: int = getattr(input_img, "n_frames", 1)
+
+    # Title bar is rasterized and quantized once, every frame only quantizes its image region
+    bar_height: int = layout["bar_height"]
+    title_bar, overflow_mask = _render_title_bar(gif_width, layout)
+    palettized_canvas = Image.new("P", (gif_width, gif_height + bar_height))
+    palettized_canvas.paste(
+        title_bar.quantize(palette=base_palette_img, dither=Image.NONE), (0, 0)
+    )
+
+    previous_frame_rgb: Image.Image | None = None
+    pending_frame: Image.Image | None = None
+    pending_duration_ms = 0
+
+    for frame_index in range(num_frames):
+        input_img.seek(frame_index)
+        frame_duration_ms = int(input_img.info.get("duration", 40))
+        if frame_index % frame_step:
+            pending_duration_ms += frame_duration_ms
+            continue
+
+        frame_rgb = input_img.convert("RGB")
+
+        # Collapse exact duplicates to reduce size, comparing only the image region
+        # and before paying for quantization
+        if (
+            previous_frame_rgb is not None
+            and ImageChops.difference(frame_rgb, previous_frame_rgb).getbbox() is None
+        ):
+            pending_duration_ms += frame_duration_ms
+            continue
+        previous_frame_rgb = frame_rgb
+        if frame_rgb.size != (gif_width, gif_height):
+            frame_rgb = frame_rgb.resize(
+                (gif_width, gif_height), Image.Resampling.LANCZOS, reducing_gap=2.0
+            )
+
+        palettized_frame = palettized_canvas.copy()
+        palettized_frame.paste(
+            frame_rgb.quantize(palette=base_palette_img, dither=Image.NONE),
+            (0, bar_height),
+        )
+        if overflow_mask is not None:
+            # Glyphs reaching below the bar are drawn over the top rows of the frame
+            overflow_rows = frame_rgb.crop((0, 0, gif_width, overflow_mask.height))
+            overflow_rows.paste(layout["text_color"], (0, 0), overflow_mask)
+            palettized_frame.paste(
+                overflow_rows.quantize(palette=base_palette_img, dither=Image.NONE),
+                (0, bar_height),
+            )
+
+        # Different frames can still quantize to the same pixels
+        if (
+            pending_frame is not None
+            and ImageChops.subtract_modulo(palettized_frame, pending_frame).getbbox(
+                alpha_only=False
+            )
+            is None
+        ):
+            pending_duration_ms += frame_duration_ms
+            continue
+
+        if pending_frame is not None:
+            yield pending_frame, pending_duration_ms
+        pending_frame = palettized_frame
+        pending_duration_ms = frame_duration_ms
+
+    if pending_frame is not None:
+        yield pending_frame, pending_duration_ms
+
+
+# (colors, frame_step) tried in order until the GIF fits its byte budget
+GIF_BUDGET_STEPS: tuple[tuple[int, int], ...] = (
+    (256, 1),
+    (128, 1),
+    (128, 2),
+    (64, 2),
+    (64, 3),
+    (32, 4),
+)
+
+
+PALETTE_SAMPLE_WIDTH = 320
+
+
+class _GifOverBudget(Exception):
+    pass
+
+
+def _build_adaptive_palette(
+    input_img: Image.Image, title_bar: Image.Image, colors: int, samples: int = 8
+) -> Image.Image:
+    """
+    Build one palette for the whole GIF from the title bar and up to `samples` evenly spaced frames.
+    """
+    num_frames: int = getattr(input_img, "n_frames", 1)
+    sample_indexes = sorted(
+        {i * num_frames // samples for i in range(min(samples, num_frames))}
+    )
+
+    # Nearest-neighbour downscaling keeps the sample small without inventing new colors
+    sample_width = min(title_bar.width, PALETTE_SAMPLE_WIDTH)
+    sample_height = max(1, input_img.height * sample_width // input_img.width)
+    bar_height = max(1, title_bar.height * sample_width // title_bar.width)
+    strip = Image.new(
+        "RGB", (sample_width, bar_height + sample_height * len(sample_indexes))
+    )
+    strip.paste(
+        title_bar.resize((sample_width, bar_height), Image.Resampling.NEAREST), (0, 0)
+    )
+    for position, frame_index in enumerate(sample_indexes):
+        input_img.seek(frame_index)
+        strip.paste(
+            input_img.convert("RGB").resize(
+                (sample_width, sample_height), Image.Resampling.NEAREST
+            ),
+            (0, bar_height + position * sample_height),
+        )
+    input_img.seek(0)
+    return strip.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+
+
+def _gif_frame_writer() -> (
+    Callable[[IO[bytes], Image.Image, tuple[int, int], dict], None] | None
+):
+    """
+    Pillow's encoder of a single GIF frame, the only private Pillow API used here. It exists with
+    this signature since Pillow 9; None when it changed, then `_write_gif` falls back to save_all.
+    """
+    write_frame_data = getattr(GifImagePlugin, "_write_frame_data", None)
+    if write_frame_data is None or list(
+        inspect.signature(write_frame_data).parameters
+    ) != ["fp", "im_frame", "offset", "params"]:
+        return None
+    return write_frame_data
+
+
+def _write_gif(
+    fp: IO[bytes],
+    frames: Iterable[tuple[Image.Image, int]],
+    *,
+    palette: list[int],
+    loop: int,
+    transparency: int | None,
+    background: int | None,
+    max_bytes: int | None = None,
+) -> None:
+    """
+    Encode palettized frames as they are produced, so only the current and previous frame are held.
+    Every frame shares the global palette. Without transparency, frames after the first are cropped
+    to the rectangle that changed and drawn over the previous one; with transparency every frame is
+    written whole and disposed to the background, so transparent pixels stay transparent.
+    Raises _GifOverBudget as soon as more than max_bytes were written.
+    """
+    write_frame_data = _gif_frame_writer()
+    if write_frame_data is None:
+        _save_all_gif(
+            fp,
+            frames,
+            palette=palette,
+            loop=loop,
+            transparency=transparency,
+            background=background,
+            max_bytes=max_bytes,
+        )
+        return
+
+    header_info: dict[str, Any] = {"optimize": False, "loop": loop}
+    if transparency is not None:
+        header_info["transparency"] = transparency
+    if background is not None:
+        header_info["background"] = background
+
+    previous_frame: Image.Image | None = None
+    for frame, duration_ms in frames:
+        frame.putpalette(palette)
+        offset = (0, 0)
+        frame_data = frame
+        if previous_frame is None:
+            header, _ = GifImagePlugin.getheader(frame, None, header_info)
+            fp.writelines(header)
+        elif transparency is None:
+            changed_box = ImageChops.subtract_modulo(frame, previous_frame).getbbox(
+                alpha_only=False
+            ) or (0, 0, 1, 1)
+            frame_data = frame.crop(changed_box)
+            offset = changed_box[:2]
+
+        # Straight to fp: the public getdata() collects the frame in a class it defines on every
+        # call, and those only go away with the cyclic garbage collector
+        write_frame_data(
+            fp,
+            frame_data,
+            offset,
+            {
+                "duration": duration_ms,
+                "disposal": 1 if transparency is None else 2,
+                "transparency": transparency,
+            },
+        )
+        if max_bytes is not None and fp.tell() > max_bytes:
+            raise _GifOverBudget
+        previous_frame = frame
+    fp.write(b";")
+
+
+def _save_all_gif(
+    fp: IO[bytes],
+    frames: Iterable[tuple[Image.Image, int]],
+    *,
+    palette: list[int],
+    loop: int,
+    transparency: int | None,
+    background: int | None,
+    max_bytes: int | None = None,
+) -> None:
+    """
+    `_write_gif` on Pillow's public save_all. The frames are still produced one at a time, but
+    Pillow holds all of them until the last one is in, so memory grows with the frame count.
+    """
+
+    def palettized(frames: Iterator[tuple[Image.Image, int]]) -> Iterator[Image.Image]:
+        for frame, duration_ms in frames:
+            frame.putpalette(palette)
+            frame.info["duration"] = duration_ms
+            yield frame
+
+    frame_iter = palettized(iter(frames))
+    save_options: dict[str, Any] = {
+        "optimize": False,
+        "loop": loop,
+        "disposal": 1 if transparency is None else 2,
+    }
+    if transparency is not None:
+        save_options["transparency"] = transparency
+    if background is not None:
+        save_options["background"] = background
+    next(frame_iter).save(
+        fp, format="GIF", save_all=True, append_images=frame_iter, **save_options
+    )
+    if max_bytes is not None and fp.tell() > max_bytes:
+        raise _GifOverBudget
+
+
+def _write_atomically(output_path: str, write: Callable[[IO[bytes]], T]) -> T:
+    """
+    Write the file next to output_path and rename it into place once complete.
+    Returns what `write` returns.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(output_path) or ".", prefix=".", suffix=".part"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            result = write(f)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return result
+
+
 def is_file_over_mb(filepath, mb_limit):
     """Check if file is larger than mb_limit MB."""
     file_size_bytes = os.path.getsize(filepath)
@@ -244,8 +753,151 @@ def is_file_over_mb(filepath, mb_limit):
     return file_size_mb > mb_limit
 
 
+def _save_rendition(
+    output_path: str,
+    rendition: Rendition,
+    frames: list[Image.Image],
+    durations: list[int] | None = None,
+    loop: int = 0,
+) -> tuple[int, str]:
+    """
+    Encode the composited frames (one for a static image) as `rendition` and return its size in bytes
+    and the settings it ended up with.
+    """
+    path = rendition.path_for(output_path)
+    frames = [
+        frame.convert("RGBA" if "transparency" in frame.info else "RGB")
+        for frame in frames
+    ]
+    width, height = frames[0].size
+    if rendition.max_height is not None and height > rendition.max_height:
+        size = (max(1, width * rendition.max_height // height), rendition.max_height)
+        frames = [frame.resize(size, Image.Resampling.LANCZOS) for frame in frames]
+
+    save_options: dict[str, Any] = {"format": rendition.format}
+    if len(frames) > 1:
+        save_options.update(
+            save_all=True, append_images=frames[1:], duration=durations, loop=loop
+        )
+
+    quality, lossless = rendition.quality, rendition.lossless
+    encoded = io.BytesIO()
+    with instrumentation.span("rendition", format=rendition.format):
+        while True:
+            encoded.seek(0)
+            encoded.truncate()
+            frames[0].save(encoded, quality=quality, lossless=lossless, **save_options)
+            if rendition.max_bytes is None or encoded.tell() <= rendition.max_bytes:
+                break
+            if lossless:
+                lossless = False
+            elif quality > RENDITION_MIN_QUALITY:
+                quality = max(RENDITION_MIN_QUALITY, quality - 10)
+            else:
+                logger.warning(
+                    "%s is %d bytes, over the %d byte limit",
+                    path,
+                    encoded.tell(),
+                    rendition.max_bytes,
+                )
+                break
+
+    _write_atomically(path, lambda f: f.write(encoded.getbuffer()))
+    settings = f"{rendition.format} " + (
+        "lossless" if lossless else f"quality {quality}"
+    )
+    return encoded.tell(), settings
+
+
+def _add_rendition(
+    file_sizes: RenderedFiles,
+    output_path: str,
+    rendition: Rendition,
+    frames: list[Image.Image],
+    *args,
+) -> None:
+    start = time.perf_counter()
+    size, settings = _save_rendition(output_path, rendition, frames, *args)
+    file_sizes.add(
+        rendition.path_for(output_path), size, settings, time.perf_counter() - start
+    )
+
+
+def _resolve_profile(encoding: str | EncodingProfile) -> EncodingProfile:
+    if isinstance(encoding, EncodingProfile):
+        return encoding
+    try:
+        return ENCODING_PROFILES[encoding]
+    except KeyError:
+        raise ValueError(
+            f"Unknown encoding {encoding!r}, expected one of {', '.join(ENCODING_PROFILES)}"
+        ) from None
+
+
+def _exact_palette(image: Image.Image, colors: list[tuple[int, Any]]) -> Image.Image:
+    """
+    The image as a palette image of exactly `colors`, as returned by `Image.getcolors`.
+    """
+
+    palette_img = Image.new("P", (1, 1))
+    palette_img.putpalette([channel for _, color in colors for channel in color[:3]])
+    return image.quantize(palette=palette_img, dither=Image.Dither.NONE)
+
+
+def _encode_png(image: Image.Image, profile: EncodingProfile) -> tuple[io.BytesIO, str]:
+    """
+    Encodes a static image as PNG with `profile`, returns the file and a description of the
+    settings the search ended up with.
+    """
+
+    lossless, kind = image, image.mode
+    if profile.palette_colors and image.mode == "RGB":
+        colors = image.getcolors(profile.palette_colors)
+        if colors is not None:
+            lossless, kind = _exact_palette(image, colors), f"{len(colors)} colors"
+
+    # (adaptive palette colors or None for lossless, compress level, optimize)
+    attempts: list[tuple[int | None, int, bool]] = [
+        (None, profile.compress_level, profile.optimize)
+    ]
+    if profile.max_bytes is not None:
+        if (profile.compress_level, profile.optimize) != (9, True):
+            attempts.append((None, 9, True))
+        if lossless.mode == "RGB":
+            attempts.extend(
+                (colors, 9, True)
+                for colors in QUANTIZE_STEPS
+                if colors >= profile.min_colors
+            )
+
+    smallest: tuple[io.BytesIO, str] | None = None
+    for colors, compress_level, optimize in attempts:
+        if colors is None:
+            candidate, settings = lossless, kind
+        else:
+            candidate = image.quantize(colors, method=Image.Quantize.MEDIANCUT)
+            settings = f"{colors} color adaptive palette"
+        encoded = io.BytesIO()
+        candidate.save(
+            encoded, format="PNG", compress_level=compress_level, optimize=optimize
+        )
+        settings += f", level {compress_level}" + (", optimize" if optimize else "")
+        if smallest is None or encoded.tell() < smallest[0].tell():
+            smallest = encoded, settings
+        if profile.max_bytes is None or encoded.tell() <= profile.max_bytes:
+            return encoded, settings
+
+    logger.warning(
+        "PNG is %d bytes with %s, over the %d byte budget",
+        smallest[0].tell(),
+        smallest[1],
+        profile.max_bytes,
+    )
+    return smallest
+
+
 def add_title_above_file(
-    input_path: str,
+    input_path: str | bytes,
     title: str,
     output_path: str,
     *,
@@ -258,18 +910,47 @@ def add_title_above_file(
     wrap_text: bool = True,
     bar_color: str = "white",
     text_color: str = "black",
-) -> None:
+    gif_memory_limit_mb: int | None = 512,
+    gif_max_bytes: int | None = GIF_MAX_BYTES,
+    gif_optimizer: str = "builtin",
+    renditions: tuple[Rendition, ...] = (),
+    max_dimension: int | None = None,
+    encoding: str | EncodingProfile = "balanced",
+) -> RenderedFiles:
     """
     Append a title bar on top of an image or animated GIF without cropping the original.
     The output is taller by the title bar height; GIFs preserve timing/palette and dedupe identical frames.
+    GIF frames are rendered and encoded one at a time; inputs whose per-frame working set exceeds
+    gif_memory_limit_mb are rejected with a ValueError. Colors and frame rate are stepped down
+    until the GIF fits gif_max_bytes. gif_optimizer="gifsicle" uses the previous gifsicle backend instead.
+    Every rendition is encoded from the same composited frames. Animated renditions are skipped when
+    those frames are over RENDITION_FRAMES_MAX_BYTES. Returns the size of each written file by path.
+    With max_dimension the original is shrunk while decoding so its longest side is at most max_dimension,
+    and the title bar is laid out for the shrunk size.
+    PNG outputs are encoded with `encoding`, a name in ENCODING_PROFILES or an `EncodingProfile`.
+    The returned sizes also carry how each file was encoded and how long it took.
+    input_path may also be the encoded image itself, e.g. a download that was kept in memory.
     """
-    with Image.open(input_path) as input_img:
+    profile = _resolve_profile(encoding)
+    file_sizes = RenderedFiles()
+    with Image.open(
+        io.BytesIO(input_path) if isinstance(input_path, bytes) else input_path
+    ) as input_img:
         is_gif = (
             input_img.format == "GIF" and getattr(input_img, "is_animated", False)
         ) or output_path.lower().endswith(".gif")
 
         if not is_gif:
+            target_size = _scaled_size(input_img.size, max_dimension)
+            if target_size != input_img.size:
+                # JPEGs are decoded at 1/2, 1/4 or 1/8 scale, no-op for other formats
+                input_img.draft("RGB", target_size)
             base_rgb = input_img.convert("RGB")
+            if base_rgb.size != target_size:
+                # reduce() by integer factors first, then resample the rest
+                base_rgb = base_rgb.resize(
+                    target_size, Image.Resampling.LANCZOS, reducing_gap=2.0
+                )
             img_width, img_height = base_rgb.size
             layout = _prepare_layout(
                 (img_width, img_height),
@@ -285,13 +966,28 @@ def add_title_above_file(
                 text_color=text_color,
             )
             output_img = _compose_with_title(base_rgb, layout)
-            if output_path.lower().endswith((".jpg", ".jpeg")):
-                output_img = output_img.convert("RGB")
-            output_img.save(output_path)
-            return
+            start = time.perf_counter()
+            if output_path.lower().endswith(".png"):
+                with instrumentation.span("encode"):
+                    encoded, settings = _encode_png(output_img, profile)
+                _write_atomically(output_path, lambda f: f.write(encoded.getbuffer()))
+            else:
+                if output_path.lower().endswith((".jpg", ".jpeg")):
+                    output_img = output_img.convert("RGB")
+                output_img.save(output_path)
+                settings = "Pillow defaults"
+            file_sizes.add(
+                output_path,
+                os.path.getsize(output_path),
+                settings,
+                time.perf_counter() - start,
+            )
+            for rendition in renditions:
+                _add_rendition(file_sizes, output_path, rendition, [output_img])
+            return file_sizes
 
         # Animated GIF path
-        gif_width, gif_height = input_img.size
+        gif_width, gif_height = _scaled_size(input_img.size, max_dimension)
         layout = _prepare_layout(
             (gif_width, gif_height),
             title,
@@ -306,83 +1002,221 @@ def add_title_above_file(
             text_color=text_color,
         )
 
-        num_frames: int = getattr(input_img, "n_frames", 1)
-        frame_durations_ms: list[int] = []
-        gif_loop_count = int(input_img.info.get("loop", 0))
-        pending_duration_ms = 0
+        working_set_bytes = _gif_working_set_bytes(
+            input_img.size, (gif_width, gif_height), layout["bar_height"]
+        )
+        if (
+            gif_memory_limit_mb is not None
+            and working_set_bytes > gif_memory_limit_mb * 1024 * 1024
+        ):
+            raise ValueError(
+                f"Rendering {output_path} needs about {working_set_bytes // (1024 * 1024)} MB, "
+                f"over the {gif_memory_limit_mb} MB limit"
+            )
 
-        # Establish a base palette to reuse (helps keep size stable)
         input_img.seek(0)
-        base_palette_img = Image.new("P", (1, 1))
-        if input_img.getpalette():
-            base_palette_img.putpalette(input_img.getpalette())
-        else:
-            base_palette_img = input_img.convert("P")
+        gif_options = {
+            "loop": int(input_img.info.get("loop", 0)),
+            "transparency": input_img.info.get("transparency"),
+            "background": input_img.info.get("background"),
+        }
+
+        start = time.perf_counter()
+        if gif_optimizer == "gifsicle":
+            _save_gif_with_gifsicle(
+                input_img, layout, output_path, gif_options, (gif_width, gif_height)
+            )
+            file_sizes.add(
+                output_path,
+                os.path.getsize(output_path),
+                "gifsicle",
+                time.perf_counter() - start,
+            )
+            return file_sizes
 
-        palettized_frames: list[Image.Image] = []
-        previous_palettized_frame: Image.Image | None = None
+        # Pillow's encoders take animated renditions as a list of frames, so the frames are only
+        # kept while they fit RENDITION_FRAMES_MAX_BYTES, the renditions are skipped otherwise
+        kept_frames: list[tuple[Image.Image, int]] | None = None
 
-        for frame_index in range(num_frames):
-            input_img.seek(frame_index)
-            frame_duration_ms = int(input_img.info.get("duration", 40))
-            pending_duration_ms += frame_duration_ms
+        def teed_frames(
+            palette_img: Image.Image, frame_step: int
+        ) -> Iterator[tuple[Image.Image, int]]:
+            nonlocal kept_frames
+            kept_frames = [] if renditions else None
+            kept_bytes = 0
+            for frame, duration_ms in _iter_titled_gif_frames(
+                input_img, layout, palette_img, frame_step, (gif_width, gif_height)
+            ):
+                if kept_frames is not None:
+                    # The palettized frame and its RGBA copy in _save_rendition
+                    kept_bytes += frame.width * frame.height * (1 + 4)
+                    if kept_bytes > RENDITION_FRAMES_MAX_BYTES:
+                        kept_frames = None
+                    else:
+                        if gif_options["transparency"] is not None:
+                            frame.info["transparency"] = gif_options["transparency"]
+                        kept_frames.append((frame, duration_ms))
+                yield frame, duration_ms
 
-            frame_rgb = input_img.convert("RGB")
-            frame_with_title_rgb = _compose_with_title(frame_rgb, layout)
-            palettized_frame = frame_with_title_rgb.quantize(
-                palette=base_palette_img, dither=Image.NONE
+        title_bar, _ = _render_title_bar(gif_width, layout)
+        budget_steps = GIF_BUDGET_STEPS if gif_max_bytes is not None else ((256, 1),)
+        transparent = gif_options["transparency"] is not None
+        if transparent:
+            # Transparency indexes the source palette, so it is kept whole and only the
+            # frame steps of the budget are tried
+            source_palette = _source_palette(input_img)
+            source_colors = len(source_palette.getpalette()) // 3
+            budget_steps = tuple(
+                dict.fromkeys(
+                    (source_colors, frame_step) for _, frame_step in budget_steps
+                )
             )
 
-            # Collapse exact duplicates to reduce size
-            if (
-                previous_palettized_frame is not None
-                and palettized_frame.tobytes() == previous_palettized_frame.tobytes()
-            ):
-                continue
+        def write_within_budget(f: IO[bytes]) -> tuple[int, str]:
+            """
+            Encodes each attempt straight into the file, which is emptied again when it goes
+            over the budget. Returns the size and settings of the attempt that was kept.
+            """
+            for colors, frame_step in budget_steps:
+                if transparent:
+                    palette_img = source_palette
+                else:
+                    palette_img = _build_adaptive_palette(input_img, title_bar, colors)
 
-            palettized_frames.append(palettized_frame)
-            frame_durations_ms.append(pending_duration_ms)
-            pending_duration_ms = 0
-            previous_palettized_frame = palettized_frame
+                f.seek(0)
+                f.truncate()
+                try:
+                    with instrumentation.span(
+                        "gif.frames", colors=colors, frame_step=frame_step
+                    ):
+                        _write_gif(
+                            f,
+                            teed_frames(palette_img, frame_step),
+                            palette=palette_img.getpalette(),
+                            max_bytes=gif_max_bytes,
+                            **gif_options,
+                        )
+                    break
+                except _GifOverBudget:
+                    logger.info(
+                        "%s is over %d bytes with %d colors and every %d. frame",
+                        output_path,
+                        gif_max_bytes,
+                        colors,
+                        frame_step,
+                    )
+            else:
+                # Nothing fit, keep the smallest settings without a budget
+                f.seek(0)
+                f.truncate()
+                with instrumentation.span(
+                    "gif.frames", colors=colors, frame_step=frame_step
+                ):
+                    _write_gif(
+                        f,
+                        teed_frames(palette_img, frame_step),
+                        palette=palette_img.getpalette(),
+                        **gif_options,
+                    )
+                logger.warning(
+                    "%s is %d bytes, over the %d byte budget",
+                    output_path,
+                    f.tell(),
+                    gif_max_bytes,
+                )
+            return f.tell(), f"GIF {colors} colors, every {frame_step}. frame"
 
-        if pending_duration_ms and palettized_frames:
-            frame_durations_ms[-1] += pending_duration_ms
+        size, settings = _write_atomically(output_path, write_within_budget)
+        # Includes rendering the frames, which happens while they are encoded
+        file_sizes.add(output_path, size, settings, time.perf_counter() - start)
+        if renditions and kept_frames is None:
+            logger.warning(
+                "Skipping renditions of %s, its frames are over the %d MB limit",
+                output_path,
+                RENDITION_FRAMES_MAX_BYTES // (1024 * 1024),
+            )
+        elif kept_frames:
+            for rendition in renditions:
+                _add_rendition(
+                    file_sizes,
+                    output_path,
+                    rendition,
+                    [frame for frame, _ in kept_frames],
+                    [duration_ms for _, duration_ms in kept_frames],
+                    gif_options["loop"],
+                )
+        return file_sizes
 
-        try:
-            first_frame_pal = palettized_frames[0]
-        except IndexError:
-            # Degenerate case: fallback to a single frame
-            first_frame_pal = input_img.convert("P")
-            palettized_frames = [first_frame_pal]
-            frame_durations_ms = [int(input_img.info.get("duration", 40))]
-
-        # Ensure all frames share the same palette
-        for frame in palettized_frames:
-            frame.putpalette(base_palette_img.getpalette())
-
-        save_kwargs = {
-            "save_all": True,
-            "append_images": palettized_frames[1:]
-            if len(palettized_frames) > 1
-            else [],
-            "duration": frame_durations_ms
-            if frame_durations_ms
-            else [int(input_img.info.get("duration", 40))],
-            "loop": gif_loop_count,
-            "optimize": True,
-            "disposal": 2,
-        }
 
-        if "transparency" in input_img.info:
-            save_kwargs["transparency"] = input_img.info["transparency"]
-        if "background" in input_img.info:
-            save_kwargs["background"] = input_img.info["background"]
+def _source_palette(input_img: Image.Image) -> Image.Image:
+    """
+    Palette image carrying the source GIF's own palette.
+    """
+    input_img.seek(0)
+    if input_img.getpalette():
+        palette_img = Image.new("P", (1, 1))
+        palette_img.putpalette(input_img.getpalette())
+        return palette_img
+    return input_img.convert("P")
 
-        first_frame_pal.save(output_path, **save_kwargs)
-        if is_file_over_mb(output_path, 30):
+
+def _save_gif_with_gifsicle(
+    input_img: Image.Image,
+    layout: dict[str, Any],
+    output_path: str,
+    gif_options: dict[str, Any],
+    frame_size: tuple[int, int],
+) -> None:
+    """
+    Previous GIF backend: encode with the source palette, then run gifsicle when the file is over 30 MB.
+    Needs the pygifsicle package and the gifsicle binary.
+    """
+    from pygifsicle import gifsicle
+
+    palette_img = _source_palette(input_img)
+    _write_atomically(
+        output_path,
+        lambda f: _write_gif(
+            f,
+            _iter_titled_gif_frames(input_img, layout, palette_img, 1, frame_size),
+            palette=palette_img.getpalette(),
+            **gif_options,
+        ),
+    )
+    if is_file_over_mb(output_path, 30):
+        with instrumentation.span("gifsicle"):
             gifsicle(
                 sources=[output_path],
                 optimize=True,
                 colors=128,
                 options=["--verbose", "--lossy=50"],
             )
+
+
+# Bump when a generator change alters the rendered output for the same inputs
+RENDER_VERSION = 3
+
+
+def render_signature(title: str, **options: Any) -> str:
+    """
+    Hash of everything that decides the output of `add_title_above_file` apart from the input image:
+    the title, the bar/text settings (defaults merged with `options`) and the resolved font.
+    """
+    params = {
+        name: parameter.default
+        for name, parameter in inspect.signature(
+            add_title_above_file
+        ).parameters.items()
+        if parameter.kind is inspect.Parameter.KEYWORD_ONLY
+    }
+    params.update(options)
+    candidate_fonts = _candidate_fonts()
+    params["font_path"] = params["font_path"] or (
+        candidate_fonts[0] if candidate_fonts else "default"
+    )
+    payload = json.dumps(
+        {"version": RENDER_VERSION, "title": title, **params},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -0,0 +1,236 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT_ENV = "MEME_INSTRUMENT"
+TRACE_FILE_ENV = "MEME_TRACE_FILE"
+
+
+@dataclass
+class SpanRecord:
+    """
+    One finished span. `start` is a wall clock timestamp so spans from render processes line up.
+    """
+
+    name: str
+    tags: dict[str, str]
+    start: float
+    duration_s: float
+    pid: int = field(default_factory=os.getpid)
+    thread: str = field(default_factory=lambda: threading.current_thread().name)
+
+
+_enabled = bool(os.environ.get(INSTRUMENT_ENV) or os.environ.get(TRACE_FILE_ENV))
+_lock = threading.Lock()
+_spans: list[SpanRecord] = []
+_counters: defaultdict[tuple[str, tuple[tuple[str, str], ...]], int] = defaultdict(int)
+# Context variable rather than thread-local, so asyncio tasks keep their own tags
+_tags: contextvars.ContextVar[dict[str, str]] = contextvars.ContextVar(
+    "instrumentation_tags", default={}
+)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def configure_from_env() -> None:
+    """
+    Enables instrumentation when `MEME_INSTRUMENT` or `MEME_TRACE_FILE` is set, e.g. from a .env file.
+    """
+
+    if os.environ.get(INSTRUMENT_ENV) or os.environ.get(TRACE_FILE_ENV):
+        enable()
+
+
+def enable() -> None:
+    """
+    Turns instrumentation on for this process and the render processes it spawns later.
+    """
+
+    global _enabled
+    _enabled = True
+    os.environ[INSTRUMENT_ENV] = "1"
+
+
+def _current_tags(tags: dict[str, Any]) -> dict[str, str]:
+    return {**_tags.get(), **{k: str(v) for k, v in tags.items()}}
+
+
+@contextlib.contextmanager
+def tagged(**tags: Any) -> Iterator[None]:
+    """
+    Adds tags to every span and counter recorded by this thread or task inside the block.
+    """
+
+    if not _enabled:
+        yield
+        return
+
+    token = _tags.set(_current_tags(tags))
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+@contextlib.contextmanager
+def _recording_span(name: str, tags: dict[str, Any]) -> Iterator[None]:
+    span_tags = _current_tags(tags)
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = SpanRecord(name, span_tags, start, time.perf_counter() - start_counter)
+        with _lock:
+            _spans.append(record)
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def span(name: str, **tags: Any) -> contextlib.AbstractContextManager:
+    """
+    Times the block as a span. When instrumentation is off this returns a shared no-op context.
+    """
+
+    if not _enabled:
+        return _NO_SPAN
+    return _recording_span(name, tags)
+
+
+def count(name: str, value: int = 1, **tags: Any) -> None:
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(_current_tags(tags).items())))
+    with _lock:
+        _counters[key] += value
+
+
+def drain() -> tuple[list[SpanRecord], dict]:
+    """
+    Returns and clears everything recorded in this process.
+    """
+
+    with _lock:
+        spans = list(_spans)
+        counters = dict(_counters)
+        _spans.clear()
+        _counters.clear()
+    return spans, counters
+
+
+def merge(spans: list[SpanRecord], counters: dict) -> None:
+    """
+    Adds records drained in another process, e.g. a render worker.
+    """
+
+    with _lock:
+        _spans.extend(spans)
+        for key, value in counters.items():
+            _counters[key] += value
+
+
+def run_collected(
+    name: str, tags: dict[str, Any], function: Callable, *args, **kwargs
+) -> tuple[Any, tuple[list[SpanRecord], dict]]:
+    """
+    Runs function in a worker process under a span called name tagged with tags, and returns
+    its result together with the records to `merge` into the parent.
+    """
+
+    with tagged(**tags), span(name):
+        result = function(*args, **kwargs)
+    return result, drain()
+
+
+def _tags_label(tags: tuple[tuple[str, str], ...] | dict[str, str]) -> str:
+    items = tags.items() if isinstance(tags, dict) else tags
+    return ",".join(f"{key}={value}" for key, value in items)
+
+
+def summary_table() -> str:
+    """
+    Spans grouped by name and tags with their count, total, mean and max time, slowest first,
+    followed by the counters.
+    """
+
+    groups: defaultdict[tuple[str, str], list[float]] = defaultdict(list)
+    with _lock:
+        for record in _spans:
+            groups[(record.name, _tags_label(record.tags))].append(record.duration_s)
+        counters = sorted(_counters.items())
+
+    rows = [["span", "tags", "count", "total_s", "mean_s", "max_s"]]
+    for (name, tags), durations in sorted(
+        groups.items(), key=lambda item: -sum(item[1])
+    ):
+        rows.append(
+            [
+                name,
+                tags,
+                str(len(durations)),
+                f"{sum(durations):.3f}",
+                f"{sum(durations) / len(durations):.3f}",
+                f"{max(durations):.3f}",
+            ]
+        )
+    for (name, tags), value in counters:
+        rows.append([name, _tags_label(tags), str(value), "", "", ""])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+def write_trace(path: str) -> None:
+    """
+    Writes the spans in the Trace Event Format (chrome://tracing, Perfetto) plus the counters.
+    """
+
+    with _lock:
+        events = [
+            {
+                "name": record.name,
+                "ph": "X",
+                "ts": record.start * 1_000_000,
+                "dur": record.duration_s * 1_000_000,
+                "pid": record.pid,
+                "tid": record.thread,
+                "args": record.tags,
+            }
+            for record in _spans
+        ]
+        counters = [
+            {"name": name, "tags": dict(tags), "value": value}
+            for (name, tags), value in _counters.items()
+        ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "counters": counters}, f)
+
+
+def report() -> None:
+    """
+    Logs the summary table and writes the JSON trace when `MEME_TRACE_FILE` is set.
+    """
+
+    if not _enabled:
+        return
+    logger.info("Timing summary:\n%s", summary_table())
+    trace_file = os.environ.get(TRACE_FILE_ENV)
+    if trace_file:
+        write_trace(trace_file)
+        logger.info("Wrote trace to %s", trace_file)
@@ -1,45 +1,72 @@
+import argparse
+import asyncio
+import logging
+import os
+
+import instrumentation
+from cache import CacheManifest
 from dotenv import load_dotenv
-from sources.base import MediaType
-from sources.programmerhumor import ProgrammerHumorMeme
-from sources.reddit import RedditMeme
+from history import HistoryIndex
+from pipeline import PipelineConfig, run_pipeline, run_pipeline_async
+from scheduler import run_daemon
+from sources.registry import build_sources, load_config
 
 load_dotenv()
 
-REDDIT_SUBREDDITS = [
-    "blunderyears",
-    "BreadStapledToTrees",
-    "cringepics",
-    "CrappyDesign",
-    "dankmemes",
-    "disneyvacation",
-    "facepalm",
-    "funny",
-    "gifs",
-    "holdmybeer",
-    "iamverysmart",
-    "Jokes",
-    "memes",
-    "MildlyVandalised",
-    "nocontextpics",
-    "PerfectTiming",
-    "ProgrammerHumor",
-    "programminghumor",
-    "trippinthroughtime",
-]
-
-REDDIT_MEDIA_TYPES = [MediaType.IMAGE, MediaType.GIF]
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.toml")
 
 
 def main(*args, **kwargs):
     """
-    The main function that should contain all sources, and download memes for all sources.
+    The main function that builds the configured sources, and download memes for all of them.
     """
 
-    programmer_humor = ProgrammerHumorMeme()
-    reddit = RedditMeme(subreddits=REDDIT_SUBREDDITS, media_types=REDDIT_MEDIA_TYPES)
+    parser = argparse.ArgumentParser(description="Fetch and caption today's memes.")
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        help="only run these sources, by their name in the config (default: all enabled)",
+    )
+    parser.add_argument(
+        "--config",
+        default=os.environ.get("MEME_CONFIG", CONFIG_PATH),
+        help="TOML config with the sources and render options",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and list every feed on its own schedule until SIGTERM or SIGINT",
+    )
+    arguments = parser.parse_args(*args)
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
+    instrumentation.configure_from_env()
 
-    reddit.fetch_and_download_memes()
-    programmer_humor.fetch_and_download_memes()
+    try:
+        sources = build_sources(load_config(arguments.config), arguments.sources)
+    except ValueError as e:
+        parser.error(str(e))
+    config = PipelineConfig.from_env()
+    cache = CacheManifest.load()
+    history = HistoryIndex.load()
+    if arguments.daemon:
+        try:
+            run_daemon(sources, config, cache, history)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        if config.use_asyncio:
+            asyncio.run(
+                run_pipeline_async(list(sources.values()), config, cache, history)
+            )
+        else:
+            run_pipeline(list(sources.values()), config, cache, history)
+        for source in sources.values():
+            source.log_stats()
+    instrumentation.report()
 
 
 if __name__ == "__main__":
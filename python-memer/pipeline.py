@@ -0,0 +1,784 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from collections import Counter, defaultdict
+from collections.abc import Awaitable, Callable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlsplit
+
+import instrumentation
+from base import create_async_http_session
+from cache import CacheManifest
+from history import HistoryIndex
+from image.downloader import (
+    MAX_IN_MEMORY_BYTES,
+    Download,
+    DownloadTicket,
+    SpeculativeBudget,
+    validate_image,
+)
+from image.fingerprint import try_perceptual_hash
+from image.generator import add_title_above_file
+from prefetch import HedgedDownload
+from publish import Transaction
+from sources.base import MediaType, Meme, MemeBase
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int | None) -> int | None:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    return value.lower() in ("1", "true", "yes") if value else default
+
+
+@dataclass
+class PipelineConfig:
+    """
+    Concurrency limits for every stage of the pipeline.
+    `render_workers=None` uses one process per CPU. With `use_asyncio` fetches and downloads
+    run on one event loop (`run_pipeline_async`), where `fetch_workers` does not apply.
+    `error_budget` is how many failures a source may have before its remaining memes are skipped.
+    `prefetch_candidates` is how many ranked candidates of a meme are downloaded at once, and
+    `speculative_bytes` caps the bytes downloaded for candidates that may not be needed.
+    Downloads of at most `in_memory_bytes` are validated and rendered from memory, larger ones
+    from their file.
+    """
+
+    fetch_workers: int = 4
+    download_workers: int = 8
+    render_workers: int | None = None
+    per_host_limit: int = 4
+    use_asyncio: bool = False
+    error_budget: int | None = None
+    prefetch_candidates: int = 2
+    speculative_bytes: int = 32 * 1024 * 1024
+    in_memory_bytes: int = MAX_IN_MEMORY_BYTES
+
+    @classmethod
+    def from_env(cls) -> "PipelineConfig":
+        """
+        Reads the limits from `MEME_FETCH_WORKERS`, `MEME_DOWNLOAD_WORKERS`,
+        `MEME_RENDER_WORKERS`, `MEME_PER_HOST_LIMIT`, `MEME_ASYNC`, `MEME_ERROR_BUDGET`,
+        `MEME_PREFETCH_CANDIDATES`, `MEME_SPECULATIVE_BYTES` and `MEME_IN_MEMORY_BYTES`, falling
+        back to the defaults.
+        """
+
+        return cls(
+            fetch_workers=_env_int("MEME_FETCH_WORKERS", cls.fetch_workers),
+            download_workers=_env_int("MEME_DOWNLOAD_WORKERS", cls.download_workers),
+            render_workers=_env_int("MEME_RENDER_WORKERS", cls.render_workers),
+            per_host_limit=_env_int("MEME_PER_HOST_LIMIT", cls.per_host_limit),
+            use_asyncio=_env_bool("MEME_ASYNC", cls.use_asyncio),
+            error_budget=_env_int("MEME_ERROR_BUDGET", cls.error_budget),
+            prefetch_candidates=_env_int(
+                "MEME_PREFETCH_CANDIDATES", cls.prefetch_candidates
+            ),
+            speculative_bytes=_env_int("MEME_SPECULATIVE_BYTES", cls.speculative_bytes),
+            in_memory_bytes=_env_int("MEME_IN_MEMORY_BYTES", cls.in_memory_bytes),
+        )
+
+
+@dataclass
+class Executors:
+    """
+    Worker pools of the pipeline. A run creates and shuts down its own unless it is given some,
+    which lets a long-running process keep the same pools across runs: the fetch threads keep
+    their Reddit clients and the render processes their fonts and layout caches.
+    """
+
+    fetch: ThreadPoolExecutor
+    download: ThreadPoolExecutor
+    new_render_pool: Callable[[], ProcessPoolExecutor]
+    render: ProcessPoolExecutor = field(init=False)
+
+    def __post_init__(self):
+        self.render = self.new_render_pool()
+
+    @classmethod
+    def create(
+        cls,
+        config: PipelineConfig,
+        render_initializer: Callable[[], None] | None = None,
+    ) -> "Executors":
+        return cls(
+            fetch=ThreadPoolExecutor(config.fetch_workers, "fetch"),
+            download=ThreadPoolExecutor(config.download_workers, "download"),
+            new_render_pool=functools.partial(
+                ProcessPoolExecutor,
+                config.render_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=render_initializer,
+            ),
+        )
+
+    def replace_broken_render_pool(self) -> None:
+        """
+        A render process that dies breaks its pool for good, so pools that outlive a run are
+        checked before the next one and replaced when broken.
+        """
+
+        try:
+            self.render.submit(int).result()
+        except BrokenProcessPool:
+            logger.warning("The render processes died, starting new ones")
+            self.render.shutdown(wait=False)
+            self.render = self.new_render_pool()
+
+    def __enter__(self) -> "Executors":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        for executor in (self.fetch, self.download, self.render):
+            executor.shutdown()
+
+
+@dataclass
+class HostLimiter:
+    """
+    Caps the number of concurrent downloads per host.
+    """
+
+    limit: int
+    _semaphores: dict[str, threading.BoundedSemaphore] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def for_url(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+
+@dataclass
+class Failures:
+    """
+    Failures by stage and by source. A source with more than `budget` failures is given up on:
+    its remaining memes are skipped, while the memes it already finished are still published.
+    """
+
+    budget: int | None = None
+    by_stage: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+    by_source: Counter = field(default_factory=Counter)
+
+    def record(self, stage: str, source: MemeBase) -> None:
+        self.by_stage[stage] += 1
+        self.by_source[source] += 1
+        if self.budget is not None and self.by_source[source] == self.budget + 1:
+            logger.warning(
+                "%s exceeded its error budget of %d, skipping its remaining memes",
+                type(source).__name__,
+                self.budget,
+            )
+
+    def exhausted(self, source: MemeBase) -> bool:
+        return self.budget is not None and self.by_source[source] > self.budget
+
+
+def _checked(
+    meme: Meme, download: Download | None, history: HistoryIndex | None
+) -> Download | None:
+    """
+    Validates a downloaded image without decoding it and fingerprints it for the history,
+    from memory when the body was kept. None when the file can't be rendered.
+    """
+
+    if download is None or download.not_modified:
+        return download
+    if meme.media_type in (MediaType.IMAGE, MediaType.GIF):
+        reason = validate_image(download.image)
+        if reason is not None:
+            logger.warning("Invalid %s from %s: %s", meme, meme.media_url, reason)
+            return None
+    if history is not None and meme.perceptual_hash is None:
+        meme.perceptual_hash = try_perceptual_hash(download.image)
+    return download
+
+
+def _download(
+    meme: Meme,
+    og_path: str,
+    download_path: str,
+    host_limiter: HostLimiter,
+    cache: CacheManifest | None,
+    history: HistoryIndex | None,
+    ticket: DownloadTicket | None = None,
+    keep_bytes: int = 0,
+) -> Download | None:
+    with host_limiter.for_url(meme.media_url):
+        with (
+            instrumentation.tagged(source=meme.source),
+            instrumentation.span("download"),
+        ):
+            download = meme.download_original(
+                og_path, cache, download_path, ticket, keep_bytes
+            )
+    return _checked(meme, download, history)
+
+
+def _is_duplicate(meme: Meme, history: HistoryIndex | None) -> bool:
+    """
+    Checks the downloaded picture against the history, for memes whose listing had no thumbnail.
+    """
+
+    return history is not None and not history.claim(
+        meme.media_url, meme.source, meme.perceptual_hash
+    )
+
+
+def _claim_listings(
+    sources: list[MemeBase],
+    listings: list[tuple[MemeBase, list[Meme]]],
+    history: HistoryIndex | None,
+) -> list[tuple[MemeBase, Meme]]:
+    """
+    Claims the memes of every listing in the history in one pass once all of them are in, in the
+    order of `sources` and then of each source's `feeds`, i.e. the config order. A meme that two
+    listings picked goes to the first one whatever fetch finished first, and the other one falls
+    back to its next candidate that is not claimed, or is dropped when there is none.
+    """
+
+    def config_order(listed: tuple[MemeBase, Meme]) -> tuple[int, int]:
+        source, meme = listed
+        feeds = source.feeds()
+        return sources.index(source), (
+            feeds.index(meme.source) if meme.source in feeds else len(feeds)
+        )
+
+    memes = sorted(
+        ((source, meme) for source, memes in listings for meme in memes),
+        key=config_order,
+    )
+    if history is None:
+        return memes
+
+    claimed = []
+    for source, meme in memes:
+        candidates = [meme, *meme.fallbacks]
+        for rank, candidate in enumerate(candidates):
+            if history.claim(
+                candidate.media_url, candidate.source, candidate.perceptual_hash
+            ):
+                candidate.fallbacks = candidates[rank + 1 :]
+                claimed.append((source, candidate))
+                break
+    return claimed
+
+
+def _saved_bytes(edited_path: str, file_sizes: dict[str, int]) -> dict[str, int]:
+    """
+    Bytes each rendition saves compared to the edited file, keyed by the rendition suffix.
+    """
+
+    stem = os.path.splitext(edited_path)[0]
+    return {
+        path.removeprefix(stem): file_sizes[edited_path] - size
+        for path, size in file_sizes.items()
+        if path != edited_path
+    }
+
+
+def _render_function(meme: Meme) -> Callable[..., Any]:
+    """
+    `add_title_above_file` with the meme's render options, to call in a render process.
+    """
+
+    render = functools.partial(add_title_above_file, **meme.render_options)
+    if instrumentation.enabled():
+        # Spans recorded in the render process come back with the result
+        render = functools.partial(
+            instrumentation.run_collected, "render", {"source": meme.source}, render
+        )
+    return render
+
+
+def _rendered(
+    meme: Meme,
+    download: Download,
+    result: Any,
+    edited_path: str,
+    cache: CacheManifest | None,
+    history: HistoryIndex | None,
+    transaction: Transaction,
+    saved_bytes: defaultdict[str, int],
+) -> None:
+    if instrumentation.enabled():
+        result, records = result
+        instrumentation.merge(*records)
+    metadata_path = transaction.stage(meme.get_metadata_path())
+    meme.write_metadata(metadata_path, result)
+    # An unmodified original is already published, only the new renders are staged
+    transaction.add(
+        [
+            *result,
+            metadata_path,
+            *([] if download.not_modified else [download.path]),
+        ]
+    )
+    meme.remember(download, cache)
+    if history is not None:
+        history.record(meme.media_url, meme.source, meme.perceptual_hash)
+    meme_saved_bytes = _saved_bytes(edited_path, result)
+    for suffix, saved in meme_saved_bytes.items():
+        saved_bytes[suffix] += saved
+    encoding = result.encodings[edited_path]
+    logger.info(
+        "Rendered %s, %d bytes with %s in %.2fs, renditions saved %s bytes",
+        meme,
+        result[edited_path],
+        encoding.settings,
+        encoding.seconds,
+        meme_saved_bytes,
+    )
+
+
+def _finish(
+    cache: CacheManifest | None,
+    history: HistoryIndex | None,
+    transaction: Transaction,
+    saved_bytes: defaultdict[str, int],
+    failures: Failures,
+    speculation: SpeculativeBudget,
+    published: list[tuple[MemeBase, Meme]],
+) -> None:
+    transaction.commit()
+    # The cache, history and picks describe what is published, so they are only kept once the files are in place
+    for source, meme in published:
+        source.published(meme)
+    if cache is not None:
+        cache.save()
+    if history is not None:
+        history.save()
+    if saved_bytes:
+        logger.info("Renditions saved bytes in total: %s", dict(saved_bytes))
+    if speculation.fetched_bytes:
+        instrumentation.count("download.speculative_bytes", speculation.fetched_bytes)
+        instrumentation.count("download.wasted_bytes", speculation.wasted_bytes)
+        logger.info(
+            "Speculative downloads fetched %d of at most %d bytes, %d of them unused",
+            speculation.fetched_bytes,
+            speculation.max_bytes,
+            speculation.wasted_bytes,
+        )
+    if failures.by_stage:
+        logger.warning("Pipeline finished with failures: %s", dict(failures.by_stage))
+
+
+def _executors(
+    config: PipelineConfig, executors: Executors | None
+) -> contextlib.AbstractContextManager[Executors]:
+    """
+    The given pools, left running, or new ones that are shut down after the run.
+    """
+
+    if executors is not None:
+        return contextlib.nullcontext(executors)
+    return Executors.create(config)
+
+
+def run_pipeline(
+    sources: list[MemeBase],
+    config: PipelineConfig,
+    cache: CacheManifest | None = None,
+    history: HistoryIndex | None = None,
+    executors: Executors | None = None,
+) -> None:
+    """
+    Runs the listing fetches, then downloads and title rendering as overlapping stages.
+    Fetches and downloads run in thread pools, rendering runs in a process pool, from `executors`
+    when given and otherwise created for the run.
+    With a cache, unchanged memes skip the download body and the render. With a history,
+    memes that were published recently are skipped, and downloads start once every listing is
+    in and their picks are claimed, see `_claim_listings`. So which source publishes a meme
+    several of them picked only depends on the config order, never on completion order.
+    The fallbacks of a meme are prefetched as a `HedgedDownload`, and the best ranked one that
+    downloads, validates and renders is published.
+    Everything is written to a `Transaction` that is published once every source is done.
+    """
+
+    for source in sources:
+        source.cache = cache
+        source.history = history
+    host_limiter = HostLimiter(config.per_host_limit)
+    failures = Failures(config.error_budget)
+    speculation = SpeculativeBudget(config.speculative_bytes)
+    saved_bytes: defaultdict[str, int] = defaultdict(int)
+    published: list[tuple[MemeBase, Meme]] = []
+
+    with (
+        Transaction() as transaction,
+        _executors(config, executors) as executors,
+    ):
+        fetch_pool, download_pool, render_pool = (
+            executors.fetch,
+            executors.download,
+            executors.render,
+        )
+        fetch_jobs = [
+            (source, job) for source in sources for job in source.fetch_jobs()
+        ]
+        # The memes of every fetch job by its index, the rank of its pending entry
+        listings: dict[int, tuple[MemeBase, list[Meme]]] = {}
+        pending: dict[
+            Future,
+            tuple[str, MemeBase, HedgedDownload | None, int, DownloadTicket | None],
+        ] = {
+            fetch_pool.submit(job): ("fetch", source, None, index, None)
+            for index, (source, job) in enumerate(fetch_jobs)
+        }
+
+        def submit(
+            pool: Executor,
+            stage: str,
+            source: MemeBase,
+            candidates: HedgedDownload,
+            rank: int,
+            ticket: DownloadTicket | None,
+            *args,
+        ) -> None:
+            pending[pool.submit(*args)] = (stage, source, candidates, rank, ticket)
+
+        def advance(source: MemeBase, candidates: HedgedDownload) -> None:
+            """
+            Renders the current candidate once it is downloaded, or starts the downloads it waits for.
+            """
+
+            while not candidates.closed and not failures.exhausted(source):
+                ready = candidates.ready()
+                if ready is None:
+                    for rank, meme, ticket, download_path in candidates.start():
+                        og_path, _ = meme.get_paths()
+                        submit(
+                            download_pool,
+                            "download",
+                            source,
+                            candidates,
+                            rank,
+                            ticket,
+                            _download,
+                            meme,
+                            og_path,
+                            download_path,
+                            host_limiter,
+                            cache,
+                            history,
+                            ticket,
+                            config.in_memory_bytes,
+                        )
+                    if candidates.exhausted():
+                        candidates.close()
+                    return
+
+                meme, download = ready
+                if meme.is_unchanged(download, cache):
+                    logger.info("Unchanged %s", meme)
+                    published.append((source, meme))
+                    break
+                if _is_duplicate(meme, history):
+                    candidates.reject()
+                    continue
+
+                candidates.promote()
+                _, edited_path = meme.get_paths()
+                edited_path = transaction.stage(edited_path)
+                submit(
+                    render_pool,
+                    "render",
+                    source,
+                    candidates,
+                    candidates.current,
+                    None,
+                    _render_function(meme),
+                    download.image,
+                    meme.title,
+                    edited_path,
+                )
+                return
+            candidates.close()
+
+        def listed(index: int, listing: tuple[MemeBase, list[Meme]]) -> None:
+            """
+            Starts the downloads once the last listing is in and the picks are claimed.
+            """
+
+            listings[index] = listing
+            if len(listings) < len(fetch_jobs):
+                return
+            for source, meme in _claim_listings(
+                sources, [listings[index] for index in sorted(listings)], history
+            ):
+                if failures.exhausted(source):
+                    continue
+                og_path, _ = meme.get_paths()
+                advance(
+                    source,
+                    HedgedDownload(
+                        meme,
+                        transaction.stage(og_path),
+                        config.prefetch_candidates,
+                        speculation,
+                    ),
+                )
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, source, candidates, rank, ticket = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.exception(
+                        "%s failed for %s",
+                        stage,
+                        candidates.candidates[rank] if candidates else "listing",
+                    )
+                    # A stopped or cancelled download is not a failure
+                    if stage != "download" or candidates.finish(rank, ticket, None):
+                        failures.record(stage, source)
+                    if stage == "render":
+                        candidates.reject()
+                    if candidates is not None:
+                        advance(source, candidates)
+                    else:
+                        listed(rank, (source, []))
+                    continue
+
+                if stage == "fetch":
+                    listed(rank, (source, result))
+                elif stage == "download":
+                    if candidates.finish(rank, ticket, result) and result is None:
+                        logger.warning(
+                            "Could not download %s", candidates.candidates[rank]
+                        )
+                        failures.record(stage, source)
+                    advance(source, candidates)
+                else:
+                    meme, download = candidates.promoted
+                    _, edited_path = meme.get_paths()
+                    _rendered(
+                        meme,
+                        download,
+                        result,
+                        transaction.stage(edited_path),
+                        cache,
+                        history,
+                        transaction,
+                        saved_bytes,
+                    )
+                    published.append((source, meme))
+                    candidates.close()
+
+        _finish(
+            cache,
+            history,
+            transaction,
+            saved_bytes,
+            failures,
+            speculation,
+            published,
+        )
+
+
+async def run_pipeline_async(
+    sources: list[MemeBase],
+    config: PipelineConfig,
+    cache: CacheManifest | None = None,
+    history: HistoryIndex | None = None,
+    executors: Executors | None = None,
+    session: "aiohttp.ClientSession | None" = None,
+) -> None:
+    """
+    Same stages as `run_pipeline` on one event loop: the listing fetches of all sources and the
+    downloads are coroutines sharing one aiohttp session, so dozens of them overlap. Downloads are
+    capped by `download_workers` and `per_host_limit`, rendering still runs in a process pool.
+    As there, downloads start once every listing is in and their picks are claimed.
+    A `session` given by the caller is used and left open, otherwise one is opened for the run.
+    """
+
+    for source in sources:
+        source.cache = cache
+        source.history = history
+    loop = asyncio.get_running_loop()
+    download_slots = asyncio.Semaphore(config.download_workers)
+    host_slots: defaultdict[str, asyncio.Semaphore] = defaultdict(
+        lambda: asyncio.Semaphore(config.per_host_limit)
+    )
+    failures = Failures(config.error_budget)
+    speculation = SpeculativeBudget(config.speculative_bytes)
+    saved_bytes: defaultdict[str, int] = defaultdict(int)
+    published: list[tuple[MemeBase, Meme]] = []
+
+    async def download(
+        source: MemeBase,
+        candidates: HedgedDownload,
+        rank: int,
+        meme: Meme,
+        ticket: DownloadTicket,
+        download_path: str,
+    ) -> None:
+        og_path, _ = meme.get_paths()
+        try:
+            async with (
+                download_slots,
+                host_slots[urlsplit(meme.media_url).hostname or ""],
+            ):
+                with (
+                    instrumentation.tagged(source=meme.source),
+                    instrumentation.span("download"),
+                ):
+                    result = await meme.download_original_async(
+                        session,
+                        og_path,
+                        cache,
+                        download_path,
+                        ticket,
+                        config.in_memory_bytes,
+                    )
+            result = await asyncio.to_thread(_checked, meme, result, history)
+        except Exception:
+            logger.exception("download failed for %s", meme)
+            result = None
+        if candidates.finish(rank, ticket, result) and result is None:
+            logger.warning("Could not download %s", meme)
+            failures.record("download", source)
+
+    async def download_and_render(source: MemeBase, meme: Meme) -> None:
+        og_path, edited_path = meme.get_paths()
+        edited_path = transaction.stage(edited_path)
+        candidates = HedgedDownload(
+            meme, transaction.stage(og_path), config.prefetch_candidates, speculation
+        )
+        downloads: dict[int, asyncio.Task] = {}
+        try:
+            while not failures.exhausted(source):
+                ready = candidates.ready()
+                if ready is None:
+                    if candidates.exhausted():
+                        return
+                    for rank, candidate, ticket, download_path in candidates.start():
+                        downloads[rank] = asyncio.create_task(
+                            download(
+                                source,
+                                candidates,
+                                rank,
+                                candidate,
+                                ticket,
+                                download_path,
+                            )
+                        )
+                    await asyncio.wait({downloads[candidates.current]})
+                    continue
+
+                meme, result = ready
+                if meme.is_unchanged(result, cache):
+                    logger.info("Unchanged %s", meme)
+                    published.append((source, meme))
+                    return
+                if _is_duplicate(meme, history):
+                    candidates.reject()
+                    continue
+
+                for rank in candidates.promote():
+                    downloads[rank].cancel()
+                try:
+                    rendered = await loop.run_in_executor(
+                        render_pool,
+                        functools.partial(
+                            _render_function(meme),
+                            result.image,
+                            meme.title,
+                            edited_path,
+                        ),
+                    )
+                except Exception:
+                    logger.exception("render failed for %s", meme)
+                    failures.record("render", source)
+                    candidates.reject()
+                    continue
+                _rendered(
+                    meme,
+                    result,
+                    rendered,
+                    edited_path,
+                    cache,
+                    history,
+                    transaction,
+                    saved_bytes,
+                )
+                published.append((source, meme))
+                return
+        finally:
+            cancelled = [downloads[rank] for rank in candidates.close()]
+            for task in cancelled:
+                task.cancel()
+            # Let them unwind before the session closes
+            await asyncio.gather(*cancelled, return_exceptions=True)
+
+    async def fetch(
+        source: MemeBase, job: Awaitable[list[Meme]]
+    ) -> tuple[MemeBase, list[Meme]]:
+        try:
+            return source, await job
+        except Exception:
+            logger.exception("fetch failed for listing")
+            failures.record("fetch", source)
+            return source, []
+
+    with (
+        Transaction() as transaction,
+        _executors(config, executors) as executors,
+    ):
+        render_pool = executors.render
+        async with (
+            contextlib.nullcontext(session)
+            if session is not None
+            else create_async_http_session()
+        ) as session:
+            listings = await asyncio.gather(
+                *(
+                    fetch(source, job)
+                    for source in sources
+                    for job in source.fetch_jobs_async(session)
+                )
+            )
+            await asyncio.gather(
+                *(
+                    download_and_render(source, meme)
+                    for source, meme in _claim_listings(sources, listings, history)
+                )
+            )
+
+        _finish(
+            cache,
+            history,
+            transaction,
+            saved_bytes,
+            failures,
+            speculation,
+            published,
+        )
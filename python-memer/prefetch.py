@@ -0,0 +1,178 @@
+import logging
+import os
+from collections import Counter
+
+from image.downloader import Download, DownloadTicket, SpeculativeBudget
+from sources.base import Meme
+
+logger = logging.getLogger(__name__)
+
+
+class HedgedDownload:
+    """
+    The ranked candidates for one file: a meme followed by its fallbacks. Besides the current
+    candidate, the one that would be published, the next `width - 1` are downloaded speculatively
+    while `budget` lasts, so a failed download, invalid file or duplicate is replaced without
+    waiting for another download.
+
+    The published candidate is always the best ranked one that succeeds, whatever order the
+    downloads finish in. Not thread safe, the pipeline drives it from one thread or event loop.
+    """
+
+    def __init__(
+        self,
+        meme: Meme,
+        download_path: str,
+        width: int,
+        budget: SpeculativeBudget,
+    ):
+        self.candidates = [meme, *meme.fallbacks]
+        self.download_path = download_path
+        self.width = max(width, 1)
+        self.budget = budget
+        self.current = 0
+        self.promoted: tuple[Meme, Download] | None = None
+        self.closed = False
+        self._tickets: dict[int, DownloadTicket] = {}
+        self._downloads: dict[int, Download | None] = {}
+        self._paths: list[str] = []
+        # Bytes each candidate fetched while it was speculative
+        self._speculative_bytes: Counter[int] = Counter()
+
+    def exhausted(self) -> bool:
+        return self.current >= len(self.candidates)
+
+    def start(self) -> list[tuple[int, Meme, DownloadTicket, str]]:
+        """
+        Downloads to start now, as (rank, meme, ticket, download path): the current candidate and,
+        while the budget lasts, the ones ranked after it up to `width`. Nothing once a candidate is
+        promoted, the downloads it cancelled are not started again unless it is rejected.
+        """
+
+        if self.closed or self.promoted is not None:
+            return []
+
+        starts = []
+        for rank in range(
+            self.current, min(self.current + self.width, len(self.candidates))
+        ):
+            if rank in self._tickets or rank in self._downloads:
+                continue
+            speculative = rank > self.current
+            if speculative and self.budget.exhausted():
+                break
+            ticket = DownloadTicket(self.budget if speculative else None)
+            self._tickets[rank] = ticket
+            starts.append((rank, self.candidates[rank], ticket, self._path(rank)))
+        return starts
+
+    def _path(self, rank: int) -> str:
+        """
+        The best ranked candidate downloads straight to the staged original, the others to a path
+        of their own, unique per attempt so a stopped download never overwrites a restarted one.
+        """
+
+        if rank == 0 and not self._paths:
+            path = self.download_path
+        else:
+            stem, extension = os.path.splitext(self.download_path)
+            path = f"{stem}.candidate{len(self._paths)}{extension}"
+        self._paths.append(path)
+        return path
+
+    def finish(
+        self, rank: int, ticket: DownloadTicket, download: Download | None
+    ) -> bool:
+        """
+        Records a finished download, None when it failed or the file is invalid.
+        Returns False when the download was stopped or cancelled, which is not a failure of the
+        candidate: it is downloaded again once it is the current one.
+        """
+
+        if self._tickets.get(rank) is not ticket:
+            # Cancelled, its bytes were counted then
+            return False
+
+        del self._tickets[rank]
+        self._speculative_bytes[rank] += ticket.speculative_bytes
+        if ticket.stopped:
+            return False
+        self._downloads[rank] = download
+        return True
+
+    def ready(self) -> tuple[Meme, Download] | None:
+        """
+        The current candidate once its download succeeded, moving past the ones that failed.
+        None while it is still downloading, once it is promoted, or when no candidate is left.
+        """
+
+        if self.promoted is not None:
+            return None
+        while not self.closed and self.current in self._downloads:
+            download = self._downloads[self.current]
+            if download is not None:
+                return self.candidates[self.current], download
+            self._next()
+        return None
+
+    def reject(self) -> None:
+        """
+        The current candidate can't be published, e.g. it is a duplicate or failed to render.
+        """
+
+        self._next()
+
+    def _next(self) -> None:
+        self.current += 1
+        self.promoted = None
+        ticket = self._tickets.get(self.current)
+        if ticket is not None:
+            # Its remaining bytes are needed now, so the budget no longer stops it
+            self._speculative_bytes[self.current] += ticket.speculative_bytes
+            ticket.speculative_bytes = 0
+            ticket.promote()
+        if not self.exhausted():
+            logger.info("Falling back to %s", self.candidates[self.current])
+
+    def promote(self) -> list[int]:
+        """
+        Settles on the current candidate: moves its file to the staged original and cancels the
+        downloads still running. Returns the ranks of the cancelled downloads.
+        """
+
+        meme, download = self.candidates[self.current], self._downloads[self.current]
+        if not download.not_modified and download.path != self.download_path:
+            os.replace(download.path, self.download_path)
+            download.path = self.download_path
+        self.promoted = meme, download
+        return self._cancel()
+
+    def _cancel(self) -> list[int]:
+        cancelled = list(self._tickets)
+        for rank, ticket in self._tickets.items():
+            ticket.cancel()
+            self._speculative_bytes[rank] += ticket.speculative_bytes
+        self._tickets.clear()
+        return cancelled
+
+    def close(self) -> list[int]:
+        """
+        Cancels the downloads still running and removes the files of the candidates that were not
+        published. Returns the ranks of the cancelled downloads.
+        """
+
+        if self.closed:
+            return []
+
+        self.closed = True
+        cancelled = self._cancel()
+        published = self.current if self.promoted is not None else None
+        wasted = sum(
+            size for rank, size in self._speculative_bytes.items() if rank != published
+        )
+        if wasted:
+            self.budget.waste(wasted)
+        for path in self._paths:
+            if path != self.download_path and os.path.exists(path):
+                os.unlink(path)
+        return cancelled
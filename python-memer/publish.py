@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections.abc import Iterable
+
+logger = logging.getLogger(__name__)
+
+MEMES_ROOT = "./memes"
+PUBLISHED_INDEX_PATH = "./memes/.cache/published.json"
+CHANGES_PATH = "./memes/.cache/changes.txt"
+STAGING_PREFIX = ".staging-"
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class Transaction:
+    """
+    Collects the files written by a run in a scratch directory inside `root` and moves the changed
+    ones into place together on `commit`, so a failed or interrupted run never leaves half-written
+    files or an original without its edited file under `memes/`.
+
+    Only files handed to `add` are published, so a meme is either published completely or not at all.
+    The index at `index_path` records the hash of every published file, which lets files that are
+    byte-identical to the published ones be skipped even when they are not checked out locally.
+    The paths that changed are written to `changes_path`, one per line, for the commit step.
+    """
+
+    def __init__(
+        self,
+        root: str = MEMES_ROOT,
+        index_path: str = PUBLISHED_INDEX_PATH,
+        changes_path: str = CHANGES_PATH,
+    ):
+        self.root = root
+        self.index_path = index_path
+        self.changes_path = changes_path
+        os.makedirs(root, exist_ok=True)
+        # Inside root, so promoting a file is a rename on the same file system
+        self.staging_dir = tempfile.mkdtemp(dir=root, prefix=STAGING_PREFIX)
+        self._staged: list[str] = []
+        # Directories created in the scratch directory, so each is only created once per run
+        self._directories: set[str] = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Transaction":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.rollback()
+
+    def stage(self, path: str) -> str:
+        """
+        Where to write the file that will be published at `path`, which must be inside root.
+        """
+
+        relative_path = os.path.relpath(path, self.root)
+        if relative_path.startswith(os.pardir):
+            raise ValueError(f"{path} is not inside {self.root}")
+        staged_path = os.path.join(self.staging_dir, relative_path)
+        directory = os.path.dirname(staged_path)
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                self._directories.add(directory)
+        return staged_path
+
+    def add(self, staged_paths: Iterable[str]) -> None:
+        """
+        Marks a complete set of staged files, e.g. an original with its edited file and renditions,
+        to be published on `commit`.
+        """
+
+        with self._lock:
+            self._staged.extend(staged_paths)
+
+    def _load_index(self) -> dict[str, str]:
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "Ignoring unreadable publish index %s: %s", self.index_path, e
+            )
+            return {}
+
+    def commit(self) -> list[str]:
+        """
+        Publishes the added files that differ from the published ones and returns their paths.
+        Every file is compared before the first one is renamed into place.
+        """
+
+        index = self._load_index()
+        with self._lock:
+            staged_paths = list(dict.fromkeys(self._staged))
+            self._staged.clear()
+
+        changes: list[tuple[str, str, str]] = []
+        for staged_path in staged_paths:
+            path = os.path.normpath(
+                os.path.join(self.root, os.path.relpath(staged_path, self.staging_dir))
+            )
+            content_hash = file_hash(staged_path)
+            published_hash = index.get(path)
+            if published_hash is None and os.path.exists(path):
+                published_hash = file_hash(path)
+            if content_hash != published_hash:
+                changes.append((staged_path, path, content_hash))
+
+        for staged_path, path, content_hash in changes:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(staged_path, 0o644)
+            os.replace(staged_path, path)
+            index[path] = content_hash
+
+        changed_paths = [path for _, path, _ in changes]
+        _write_atomically(
+            self.index_path, json.dumps(index, indent=2, sort_keys=True) + "\n"
+        )
+        _write_atomically(
+            self.changes_path, "".join(f"{path}\n" for path in changed_paths)
+        )
+        logger.info(
+            "Published %d changed files, skipped %d unchanged",
+            len(changed_paths),
+            len(staged_paths) - len(changed_paths),
+        )
+        return changed_paths
+
+    def rollback(self) -> None:
+        """
+        Drops everything that was staged and not published.
+        """
+
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+def _write_atomically(path: str, content: str) -> None:
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+from collections.abc import Mapping
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every thread and event loop talking to one API.
+    Callers reserve a token and then wait outside the lock, so waiting threads are served in
+    the order they asked. The rate follows what the server reports as remaining, and a pause
+    (e.g. after a 429) holds back every caller until it is over.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.paused_until = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token, going into debt when there is none, and returns how long to wait before using it.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            debt_delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(self.paused_until - now, 0.0) + debt_delay
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Holds back every caller for the next `seconds`.
+        """
+
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, remaining: float, reset_seconds: float) -> None:
+        """
+        Spreads the `remaining` requests of the current window over the `reset_seconds` left in it,
+        never going above the base rate. With nothing remaining everyone waits for the reset.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            reset_seconds = max(reset_seconds, 1.0)
+            if remaining < 1:
+                self.paused_until = max(self.paused_until, now + reset_seconds)
+                self.tokens = min(self.tokens, 0.0)
+                self.rate = self.base_rate
+                return
+
+            self.rate = min(self.base_rate, remaining / reset_seconds)
+            self.tokens = min(self.tokens, remaining)
+
+
+def retry_after_seconds(headers: Mapping[str, str], default: float) -> float:
+    """
+    Seconds to wait from a Retry-After header in seconds, or default when it is missing or a date.
+    """
+
+    retry_after = headers.get("Retry-After", "")
+    return float(retry_after) if retry_after.isdigit() else default
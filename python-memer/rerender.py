@@ -0,0 +1,267 @@
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Any
+
+from cache import CacheManifest
+from image.generator import RenderedFiles, add_title_above_file, render_signature
+from publish import MEMES_ROOT, Transaction
+from sources.base import METADATA_EXTENSION, MediaType, files_metadata
+from sources.registry import build_sources, load_config, render_options_from_config
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.toml")
+ORIGINAL_PREFIX = "original_"
+RENDERED_EXTENSIONS = (MediaType.IMAGE.value, MediaType.GIF.value)
+
+
+@dataclass
+class RenderJob:
+    """
+    An original found on disk, the edited file it renders to, and the title and source from its
+    sidecar. The source is e.g. `reddit/memes`, one of the `feeds` of the source that fetched it.
+    """
+
+    og_path: str
+    edited_path: str
+    title: str
+    source: str
+
+
+def find_jobs(
+    root: str, default_title: str | None = None
+) -> tuple[list[RenderJob], list[str]]:
+    """
+    Walks root for `original_todays_*` files and reads their titles and sources from the sidecars
+    written at fetch time, using default_title and the directory under root when there is none.
+    Returns the jobs and the originals without a title.
+    """
+
+    jobs = []
+    missing = []
+    pattern = os.path.join(root, "**", f"{ORIGINAL_PREFIX}todays_*")
+    for og_path in sorted(glob.glob(pattern, recursive=True)):
+        stem, extension = os.path.splitext(og_path)
+        if extension not in RENDERED_EXTENSIONS:
+            continue
+
+        # Originals are published to <root>/<source>/
+        source = os.path.relpath(os.path.dirname(og_path), root).replace(os.sep, "/")
+        try:
+            with open(stem + METADATA_EXTENSION, encoding="utf-8") as f:
+                metadata = json.load(f)
+            title = metadata["title"]
+            source = metadata.get("source", source)
+        except (OSError, ValueError, KeyError):
+            if default_title is None:
+                missing.append(og_path)
+                continue
+            title = default_title
+
+        edited_name = os.path.basename(og_path).removeprefix(ORIGINAL_PREFIX)
+        jobs.append(
+            RenderJob(
+                og_path,
+                os.path.join(os.path.dirname(og_path), edited_name),
+                title,
+                source,
+            )
+        )
+    return jobs, missing
+
+
+def job_render_options(
+    config: dict[str, Any],
+) -> Callable[[RenderJob], dict[str, Any]]:
+    """
+    Returns the render options of a job: those of the configured source with the job's source as
+    one of its feeds, with that source's `[sources.<name>.render]` overrides as in `build_sources`.
+    Feeds no longer in the config fall back to the source named by their first part, e.g.
+    `reddit`, and then to the `[render]` table.
+    """
+
+    sources = build_sources(config, list(config.get("sources", {})))
+    by_feed = {
+        feed: source.render_options
+        for source in sources.values()
+        for feed in source.feeds()
+    }
+    default_options = render_options_from_config(config)
+
+    def render_options(job: RenderJob) -> dict[str, Any]:
+        if job.source in by_feed:
+            return by_feed[job.source]
+        name = job.source.partition("/")[0]
+        return sources[name].render_options if name in sources else default_options
+
+    return render_options
+
+
+def _stage_metadata(
+    job: RenderJob, file_sizes: RenderedFiles, transaction: Transaction
+) -> str | None:
+    """
+    Stages the sidecar of the job with the encoding of its new files, None when it has no sidecar.
+    """
+
+    path = os.path.splitext(job.og_path)[0] + METADATA_EXTENSION
+    try:
+        with open(path, encoding="utf-8") as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    metadata["files"] = files_metadata(file_sizes)
+    staged_path = transaction.stage(path)
+    with open(staged_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return staged_path
+
+
+def _timed_render(*args, **kwargs) -> tuple[RenderedFiles, float]:
+    start = time.perf_counter()
+    file_sizes = add_title_above_file(*args, **kwargs)
+    return file_sizes, time.perf_counter() - start
+
+
+def rerender(
+    jobs: list[RenderJob],
+    render_options: Callable[[RenderJob], dict[str, Any]],
+    transaction: Transaction,
+    workers: int | None = None,
+) -> list[RenderJob]:
+    """
+    Renders every job with its `render_options` into the transaction on a process pool and logs
+    the progress and throughput.
+    Workers live for the whole batch, so their font and layout caches are reused across files.
+    Returns the jobs that rendered.
+    """
+
+    rendered = []
+    input_bytes = 0
+    render_seconds = 0.0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = {
+            pool.submit(
+                _timed_render,
+                job.og_path,
+                job.title,
+                transaction.stage(job.edited_path),
+                **render_options(job),
+            ): job
+            for job in jobs
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            job = futures[future]
+            try:
+                file_sizes, seconds = future.result()
+            except Exception:
+                logger.exception("Could not render %s", job.og_path)
+                continue
+
+            transaction.add(file_sizes)
+            metadata_path = _stage_metadata(job, file_sizes, transaction)
+            if metadata_path is not None:
+                transaction.add([metadata_path])
+            rendered.append(job)
+            input_bytes += os.path.getsize(job.og_path)
+            render_seconds += seconds
+            elapsed = time.perf_counter() - start
+            logger.info(
+                "[%d/%d] %s in %.2fs, %.1f files/s, %.1f MB/s",
+                done,
+                len(jobs),
+                job.edited_path,
+                seconds,
+                len(rendered) / elapsed,
+                input_bytes / elapsed / 1e6,
+            )
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Rendered %d of %d files in %.1fs: %.1f files/s, %.2fs per file on average",
+        len(rendered),
+        len(jobs),
+        elapsed,
+        len(rendered) / elapsed if elapsed else 0.0,
+        render_seconds / len(rendered) if rendered else 0.0,
+    )
+    return rendered
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Renders the edited files of an existing memes/ tree again from their originals, without
+    fetching anything, e.g. after changing the `[render]` options.
+    Run from the repository root: python python-memer/rerender.py
+    """
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--config",
+        default=os.environ.get("MEME_CONFIG", CONFIG_PATH),
+        help="TOML config with the render options",
+    )
+    parser.add_argument("--root", default=MEMES_ROOT, help="memes tree to render again")
+    parser.add_argument(
+        "--workers", type=int, help="render processes (default: one per CPU)"
+    )
+    parser.add_argument(
+        "--default-title",
+        help="title for originals without a sidecar, e.g. to load test on an older tree",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="render without publishing anything, e.g. to load test the generator",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
+    render_options = job_render_options(load_config(args.config))
+    jobs, missing = find_jobs(args.root, args.default_title)
+    for og_path in missing:
+        logger.warning("Skipping %s without a title sidecar", og_path)
+    if not jobs:
+        logger.warning("Nothing to render under %s", args.root)
+        return
+
+    with Transaction(
+        args.root,
+        os.path.join(args.root, ".cache", "published.json"),
+        os.path.join(args.root, ".cache", "changes.txt"),
+    ) as transaction:
+        rendered = rerender(jobs, render_options, transaction, args.workers)
+        if args.dry_run:
+            return
+        transaction.commit()
+
+    cache = CacheManifest.load(os.path.join(args.root, ".cache", "manifest.json"))
+    if cache is not None and any(
+        [
+            cache.rerendered(
+                job.og_path, render_signature(job.title, **render_options(job))
+            )
+            for job in rendered
+        ]
+    ):
+        cache.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import signal
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable, Mapping
+from dataclasses import dataclass
+from typing import Any
+
+from base import create_async_http_session
+from cache import CacheManifest
+from history import HistoryIndex
+from pipeline import Executors, PipelineConfig, run_pipeline, run_pipeline_async
+from sources.base import MediaType, MemeBase
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RefreshPolicy:
+    """
+    How often a feed is listed, in seconds. Starting at `interval`, it is halved down to
+    `min_interval` after a run that published a new meme of the feed and doubled up to
+    `max_interval` after one that did not, so every feed settles near how often it actually changes.
+    """
+
+    interval: float = 6 * 60 * 60
+    min_interval: float = 60 * 60
+    max_interval: float = 24 * 60 * 60
+
+    def __post_init__(self):
+        if not 0 < self.min_interval <= self.interval <= self.max_interval:
+            raise ValueError(
+                "Refresh intervals must be 0 < min_interval <= interval <= max_interval, "
+                f"got {self.min_interval}, {self.interval} and {self.max_interval}"
+            )
+
+    @classmethod
+    def from_config(cls, options: Mapping[str, Any]) -> "RefreshPolicy":
+        """
+        Builds the policy from a `[schedule]` table merged with a `[sources.<name>.schedule]` one.
+        """
+
+        try:
+            return cls(**options)
+        except TypeError as e:
+            raise ValueError(f"Invalid schedule options {dict(options)}: {e}") from e
+
+    def adapt(self, interval: float, changed: bool) -> float:
+        if changed:
+            return max(self.min_interval, interval / 2)
+        return min(self.max_interval, interval * 2)
+
+
+class Clock:
+    """
+    Time of the scheduler. A fake clock for tests returns its own time from `now` and moves it
+    forward in `sleep` instead of waiting.
+    """
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float, stop: threading.Event) -> bool:
+        """
+        Waits `seconds` or until `stop` is set, and returns whether it is set.
+        """
+
+        return stop.wait(seconds)
+
+
+@dataclass(eq=False)
+class Feed:
+    """
+    Schedule of one feed of a source, see `MemeBase.feeds`.
+    """
+
+    source: MemeBase
+    name: str
+    policy: RefreshPolicy
+    interval: float
+    due_at: float
+
+
+class Scheduler:
+    """
+    Lists every feed of long-lived sources when it is due. `run` is called with the sources that
+    have due feeds, and their `due_feeds` tells them which listings to fetch. The sources keep
+    the `published_picks` of their feeds between runs, which both skips a media type whose pick
+    did not change and adapts the feed's interval, see `RefreshPolicy`. A run that fails to publish
+    counts as unchanged, so a failing feed is retried less and less often.
+    """
+
+    def __init__(
+        self,
+        sources: Mapping[str, MemeBase],
+        run: Callable[[list[MemeBase]], None],
+        clock: Clock | None = None,
+    ):
+        self.run = run
+        self.clock = clock or Clock()
+        self.feeds: list[Feed] = []
+        now = self.clock.now()
+        for source in sources.values():
+            policy = RefreshPolicy.from_config(source.schedule_options)
+            if source.published_picks is None:
+                source.published_picks = {}
+            self.feeds.extend(
+                Feed(source, name, policy, policy.interval, due_at=now)
+                for name in source.feeds()
+            )
+        if not self.feeds:
+            raise ValueError("No feeds to schedule")
+
+    def run_due(self) -> float:
+        """
+        Runs the feeds that are due, and returns how long until the next one is.
+        """
+
+        due = [feed for feed in self.feeds if feed.due_at <= self.clock.now()]
+        if due:
+            self._run(due)
+        return max(min(feed.due_at for feed in self.feeds) - self.clock.now(), 0.0)
+
+    def _run(self, due: list[Feed]) -> None:
+        due_feeds: defaultdict[MemeBase, set[str]] = defaultdict(set)
+        for feed in due:
+            due_feeds[feed.source].add(feed.name)
+        previous_picks = {feed: self._picks(feed) for feed in due}
+
+        for source, names in due_feeds.items():
+            source.due_feeds = names
+        try:
+            self.run(list(due_feeds))
+        except Exception:
+            logger.exception("Run of %s failed", ", ".join(feed.name for feed in due))
+        finally:
+            for source in due_feeds:
+                source.due_feeds = None
+
+        finished_at = self.clock.now()
+        for feed in due:
+            previous, picks = previous_picks[feed], self._picks(feed)
+            # Until a meme of the feed is published its changes say nothing about how often it changes
+            if previous and picks:
+                feed.interval = feed.policy.adapt(feed.interval, picks != previous)
+                logger.info(
+                    "%s %s, next listing in %.0f minutes",
+                    feed.name,
+                    "changed" if picks != previous else "is unchanged",
+                    feed.interval / 60,
+                )
+            feed.due_at = finished_at + feed.interval
+
+    @staticmethod
+    def _picks(feed: Feed) -> dict[MediaType, str]:
+        return dict(feed.source.published_picks.get(feed.name, {}))
+
+    def run_forever(self, stop: threading.Event) -> None:
+        """
+        Runs the due feeds and sleeps until the next one is due, until `stop` is set. A run that
+        started is always finished, so it is published completely.
+        """
+
+        while not stop.is_set():
+            delay = self.run_due()
+            if delay > 0 and self.clock.sleep(delay, stop):
+                break
+
+
+def _ignore_stop_signals() -> None:
+    """
+    Render processes leave SIGINT and SIGTERM to the daemon, which stops them once its run is done.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _stop_on_signals(stop: threading.Event) -> None:
+    def handle(signum: int, frame: Any) -> None:
+        logger.info(
+            "Received %s, stopping after the current run", signal.Signals(signum).name
+        )
+        stop.set()
+
+    signal.signal(signal.SIGINT, handle)
+    signal.signal(signal.SIGTERM, handle)
+
+
+async def _open_session():
+    return create_async_http_session()
+
+
+def run_daemon(
+    sources: Mapping[str, MemeBase],
+    config: PipelineConfig,
+    cache: CacheManifest | None = None,
+    history: HistoryIndex | None = None,
+    stop: threading.Event | None = None,
+    clock: Clock | None = None,
+) -> None:
+    """
+    Keeps running the pipeline for the feeds that are due until `stop` is set, by default on
+    SIGTERM or SIGINT. What is costly to set up lives as long as the process: the sources with
+    their Reddit clients and tokens, the worker pools, the render processes with their fonts and
+    layout caches, the HTTP sessions, the cache manifest and the history index.
+    Each run publishes through its own `Transaction`, so unchanged files are never written.
+    """
+
+    if stop is None:
+        stop = threading.Event()
+        _stop_on_signals(stop)
+
+    # One event loop for every run, so the aiohttp session outlives them
+    with (
+        Executors.create(config, render_initializer=_ignore_stop_signals) as executors,
+        asyncio.Runner() as runner,
+    ):
+        session = runner.run(_open_session()) if config.use_asyncio else None
+
+        def run(due_sources: list[MemeBase]) -> None:
+            executors.replace_broken_render_pool()
+            if session is not None:
+                runner.run(
+                    run_pipeline_async(
+                        due_sources, config, cache, history, executors, session
+                    )
+                )
+            else:
+                run_pipeline(due_sources, config, cache, history, executors)
+            for source in due_sources:
+                source.log_stats()
+
+        try:
+            Scheduler(sources, run, clock).run_forever(stop)
+        finally:
+            if session is not None:
+                runner.run(session.close())
+    logger.info("Stopped")
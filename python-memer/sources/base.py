@@ -1,10 +1,50 @@
+import asyncio
+import json
+import logging
+import os
 import re
+import time
 import unicodedata
+from collections.abc import Awaitable, Callable
 from enum import Enum
 from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
-from image.downloader import download_image
-from image.generator import add_title_above_file
+from base import create_async_http_session
+from cache import CacheEntry, CacheManifest
+from history import HistoryIndex
+from image.downloader import (
+    MAX_IN_MEMORY_BYTES,
+    Download,
+    DownloadTicket,
+    fetch_image,
+    fetch_image_async,
+)
+from image.generator import RenderedFiles, add_title_above_file, render_signature
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Sidecar with the title of an original, e.g. original_todays_png.json
+METADATA_EXTENSION = ".json"
+
+
+def files_metadata(files: RenderedFiles) -> dict[str, dict[str, Any]]:
+    """
+    Size, encoding settings and encode time of every rendered file by file name, for the sidecar.
+    """
+
+    metadata = {}
+    for path, size in files.items():
+        metadata[os.path.basename(path)] = {"bytes": size}
+        if path in files.encodings:
+            metadata[os.path.basename(path)].update(
+                settings=files.encodings[path].settings,
+                encode_seconds=round(files.encodings[path].seconds, 3),
+            )
+    return metadata
 
 
 class MediaType(Enum):
@@ -29,12 +69,31 @@ class Meme:
     source: str
 
     media_type: MediaType
+    render_options: dict[str, Any]
+    # dHash of the picture, from the listing's thumbnail or the download, see `HistoryIndex`
+    perceptual_hash: int | None
+    # Ranked candidates for the same file, tried when this one can't be downloaded or rendered
+    fallbacks: list["Meme"]
+    # Post its listing led with for the media type, shared with the fallbacks, see `MemeBase.pick_unchanged`
+    pick: str | None
 
-    def __init__(self, media_url: str, media_type: str, source: str, title: str = ""):
+    def __init__(
+        self,
+        media_url: str,
+        media_type: str,
+        source: str,
+        title: str = "",
+        render_options: dict[str, Any] | None = None,
+        perceptual_hash: int | None = None,
+    ):
         self.title = title
         self.media_url = media_url
         self.media_type = MediaType(media_type)
         self.source = source
+        self.render_options = render_options or {}
+        self.perceptual_hash = perceptual_hash
+        self.fallbacks = []
+        self.pick = None
 
     def __str__(self) -> str:
         return f"Meme | {self.title} | {self.source}"
@@ -62,51 +121,374 @@ class Meme:
         path = Path(path)
         path.mkdir(parents=True, exist_ok=True)
 
-    def download_image(self, og_path: str, edited_path: str) -> str:
+    def get_paths(self) -> tuple[str, str]:
         """
-        Creates both og path and edited path, and downloads the media + edits with the title on top.
+        Returns the path of the original media and the path of the edited media.
         """
 
-        self.create_path(og_path)
-        self.create_path(edited_path)
+        image_extension = self.get_extension()
+        file_name = f"todays_{image_extension.replace('.', '')}{image_extension}"
+
+        og_path = f"./memes/{self.source}/original_{file_name}"
+        edited_path = f"./memes/{self.source}/{file_name}"
+        return og_path, edited_path
+
+    def get_metadata_path(self) -> str:
+        """
+        Returns the path of the sidecar next to the original, see `write_metadata`.
+        """
+
+        og_path, _ = self.get_paths()
+        return os.path.splitext(og_path)[0] + METADATA_EXTENSION
+
+    def write_metadata(self, path: str, files: RenderedFiles | None = None) -> None:
+        """
+        Writes what was fetched for the original, so its edited file can be rendered again offline,
+        and how the rendered `files` were encoded.
+        """
+
+        metadata = {
+            "title": self.title,
+            "media_url": self.media_url,
+            "media_type": self.media_type.name,
+            "source": self.source,
+        }
+        if files is not None:
+            metadata["files"] = files_metadata(files)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+            f.write("\n")
 
-        image = download_image(self.media_url, og_path)
-        if image is None:
+    def get_cache_entry(self, cache: CacheManifest | None) -> CacheEntry | None:
+        """
+        Returns what was published last time for this meme's url and paths.
+        """
+
+        if cache is None:
             return None
+        return cache.lookup(self.media_url, *self.get_paths())
+
+    def _revalidation_options(
+        self, og_path: str, cache: CacheManifest | None
+    ) -> dict[str, Any]:
+        """
+        Conditional GET options against what was published last time, empty when there is nothing to revalidate.
+        """
+
+        entry = self.get_cache_entry(cache)
+        if entry is None or (
+            # The body is needed for a re-render but isn't on disk, so don't revalidate
+            entry.render_hash != render_signature(self.title, **self.render_options)
+            and not os.path.exists(og_path)
+        ):
+            return {}
 
-        add_title_above_file(image, self.title, edited_path)
+        return {
+            "etag": entry.etag,
+            "last_modified": entry.last_modified,
+            "known_hash": entry.content_hash,
+        }
 
-    def download_image_and_convert(self):
+    def download_original(
+        self,
+        og_path: str,
+        cache: CacheManifest | None = None,
+        download_path: str | None = None,
+        ticket: DownloadTicket | None = None,
+        keep_bytes: int = 0,
+    ) -> Download | None:
+        """
+        Creates the og path and downloads the media into it, or into download_path when the
+        original is staged elsewhere before it is published to og_path, whose directory the
+        caller already created.
+        With a cache, the download is a conditional GET against what was published last time.
+        A `ticket` lets the caller stop the download and a body of at most `keep_bytes` is also
+        returned in memory, see `fetch_image`.
+        """
+
+        if download_path is None:
+            self.create_path(og_path)
+        download = fetch_image(
+            self.media_url,
+            download_path or og_path,
+            ticket=ticket,
+            keep_bytes=keep_bytes,
+            **self._revalidation_options(og_path, cache),
+        )
+        return self._published_if_not_modified(download, og_path)
+
+    async def download_original_async(
+        self,
+        session: "aiohttp.ClientSession",
+        og_path: str,
+        cache: CacheManifest | None = None,
+        download_path: str | None = None,
+        ticket: DownloadTicket | None = None,
+        keep_bytes: int = 0,
+    ) -> Download | None:
+        """
+        Async variant of `download_original` on an aiohttp session.
+        """
+
+        if download_path is None:
+            self.create_path(og_path)
+        download = await fetch_image_async(
+            session,
+            self.media_url,
+            download_path or og_path,
+            ticket=ticket,
+            keep_bytes=keep_bytes,
+            **self._revalidation_options(og_path, cache),
+        )
+        return self._published_if_not_modified(download, og_path)
+
+    def _published_if_not_modified(
+        self, download: Download | None, og_path: str
+    ) -> Download | None:
+        """
+        An unmodified original was not written anywhere, so its body is the published og path.
+        """
+
+        if download is not None and download.not_modified:
+            download.path = og_path
+        return download
+
+    def is_unchanged(self, download: Download, cache: CacheManifest | None) -> bool:
+        """
+        Checks whether the published edited file was rendered from the same original and title.
+        """
+
+        entry = self.get_cache_entry(cache)
+        return (
+            entry is not None
+            and download.content_hash is not None
+            and download.content_hash == entry.content_hash
+            and entry.render_hash == render_signature(self.title, **self.render_options)
+        )
+
+    def remember(self, download: Download, cache: CacheManifest | None) -> None:
+        """
+        Records the published original and edited file in the cache.
+        """
+
+        if cache is None:
+            return
+
+        og_path, edited_path = self.get_paths()
+        cache.store(
+            self.media_url,
+            CacheEntry(
+                og_path=og_path,
+                edited_path=edited_path,
+                etag=download.etag,
+                last_modified=download.last_modified,
+                content_hash=download.content_hash,
+                render_hash=render_signature(self.title, **self.render_options),
+                published_at=time.time(),
+            ),
+        )
+
+    def download_image(
+        self, og_path: str, edited_path: str, cache: CacheManifest | None = None
+    ) -> str:
+        """
+        Creates both og path and edited path, and downloads the media + edits with the title on top.
+        Unchanged memes are neither downloaded nor rendered again when a cache is given.
+        """
+
+        download = self.download_original(
+            og_path, cache, keep_bytes=MAX_IN_MEMORY_BYTES
+        )
+        if download is None:
+            return None
+        if self.is_unchanged(download, cache):
+            return edited_path
+
+        self.create_path(edited_path)
+        add_title_above_file(
+            download.image, self.title, edited_path, **self.render_options
+        )
+        self.remember(download, cache)
+        return edited_path
+
+    def download_image_and_convert(self, cache: CacheManifest | None = None):
         """
         Base function for downloading the media and converts it.
         """
 
-        image_extension = self.get_extension()
+        og_path, edited_path = self.get_paths()
+        self.download_image(og_path, edited_path, cache)
 
-        og_path = f"./memes/{self.source}/original_todays_{image_extension.replace('.', '')}{image_extension}"
-        edited_path = f"./memes/{self.source}/todays_{image_extension.replace('.', '')}{image_extension}"
+    async def download_image_and_convert_async(
+        self, session: "aiohttp.ClientSession", cache: CacheManifest | None = None
+    ) -> str | None:
+        """
+        Async variant of `download_image_and_convert`, rendering in a worker thread.
+        """
 
-        self.download_image(og_path, edited_path)
+        og_path, edited_path = self.get_paths()
+        download = await self.download_original_async(
+            session, og_path, cache, keep_bytes=MAX_IN_MEMORY_BYTES
+        )
+        if download is None:
+            return None
+        if self.is_unchanged(download, cache):
+            return edited_path
+
+        self.create_path(edited_path)
+        await asyncio.to_thread(
+            add_title_above_file,
+            download.image,
+            self.title,
+            edited_path,
+            **self.render_options,
+        )
+        self.remember(download, cache)
+        return edited_path
 
 
 class MemeBase:
     """
     Base class for sources, contains all functions that should be available to the function.
+    `render_options` are passed to `add_title_above_file` for every meme of the source, and
+    `schedule_options` build the `RefreshPolicy` of its feeds in a long-running process.
+    `cache` and `history` are the manifest and history index of the current run, set by the pipeline
+    before `fetch_jobs` is called.
+    `due_feeds` and `published_picks` are set by the scheduler of a long-running process, see `feeds`.
     """
 
+    render_options: dict[str, Any] = {}
+    schedule_options: dict[str, Any] = {}
+    cache: CacheManifest | None = None
+    history: HistoryIndex | None = None
+    # Feeds that `fetch_jobs` lists, None for all of them
+    due_feeds: set[str] | None = None
+    # Picks of every feed by media type when their memes were last published, None when nobody keeps track
+    published_picks: dict[str, dict[MediaType, str]] | None = None
+
+    @classmethod
+    def from_config(cls, options: dict[str, Any]) -> "MemeBase":
+        """
+        Builds the source from its `[sources.<name>]` table in the config file.
+        """
+
+        return cls(**options)
+
     def convert_to_object(
-        self, media_url: str, media_type: str, source: str, title: str = ""
+        self,
+        media_url: str,
+        media_type: str,
+        source: str,
+        title: str = "",
+        perceptual_hash: int | None = None,
     ):
         """
         Helper function for converting the media into a meme class.
         """
 
         return Meme(
-            title=title, media_url=media_url, media_type=media_type, source=source
+            title=title,
+            media_url=media_url,
+            media_type=media_type,
+            source=source,
+            render_options=self.render_options,
+            perceptual_hash=perceptual_hash,
         )
 
-    def fetch_and_download_memes(self):
+    def feeds(self) -> list[str]:
         """
-        Helper function for downloading the meme and in the way the source requires, and calls `donwload_image_and_convert()` from the Meme class.
+        Names of the listings of the source that are refreshed on their own schedule, the `source`
+        of the memes they return, e.g. `reddit/<subreddit>`. Sources with more than one feed only
+        fetch the `due_feeds` in `fetch_jobs`.
+        """
+
+        return [type(self).__name__]
+
+    def is_due(self, feed: str) -> bool:
+        return self.due_feeds is None or feed in self.due_feeds
+
+    def pick_unchanged(self, feed: str, media_type: MediaType, pick: str) -> bool:
+        """
+        Whether `pick`, the post a feed's listing leads with for a media type before the history
+        is checked, is the one the published meme of that media type came from. Then the meme is
+        still current and the listing returns none for the media type.
+        Always False unless `published_picks` is kept.
+        """
+
+        if self.published_picks is None:
+            return False
+        if self.published_picks.get(feed, {}).get(media_type) != pick:
+            return False
+        logger.info(
+            "%s %s is unchanged, keeping the published meme",
+            feed,
+            media_type.name.lower(),
+        )
+        return True
+
+    def published(self, meme: Meme) -> None:
+        """
+        Called once the files of `meme` are published, or found unchanged, to record its pick.
+        A meme that failed is not recorded, so the next listing tries it again.
+        """
+
+        if self.published_picks is not None and meme.pick is not None:
+            self.published_picks.setdefault(meme.source, {})[meme.media_type] = (
+                meme.pick
+            )
+
+    def fetch_jobs(self) -> list[Callable[[], list[Meme]]]:
+        """
+        Returns the independent listing fetches of the source, in the order they should start.
+        Their memes are claimed in the order of `feeds`, whichever fetch finishes first.
+        Each job is called without arguments and returns the memes it selected, so the pipeline can run them concurrently.
         """
         raise NotImplementedError
+
+    def fetch_jobs_async(
+        self, session: "aiohttp.ClientSession"
+    ) -> list[Awaitable[list[Meme]]]:
+        """
+        Async variant of `fetch_jobs`, the listing fetches to await on one event loop.
+        Sources without an async backend run their `fetch_jobs` in worker threads.
+        """
+
+        return [asyncio.to_thread(job) for job in self.fetch_jobs()]
+
+    async def fetch_memes(self, session: "aiohttp.ClientSession") -> list[Meme]:
+        """
+        Runs all listing fetches of the source concurrently and returns the memes in pick order.
+        """
+
+        results = await asyncio.gather(*self.fetch_jobs_async(session))
+        return [meme for memes in results for meme in memes]
+
+    async def fetch_and_download_memes_async(
+        self, cache: CacheManifest | None = None
+    ) -> None:
+        """
+        Fetches the memes of the source and downloads and converts all of them concurrently.
+        """
+
+        async with create_async_http_session() as session:
+            memes = await self.fetch_memes(session)
+            await asyncio.gather(
+                *(
+                    meme.download_image_and_convert_async(session, cache)
+                    for meme in memes
+                )
+            )
+        self.log_stats()
+
+    def fetch_and_download_memes(self, cache: CacheManifest | None = None):
+        """
+        Helper function for downloading the meme and in the way the source requires, and calls `donwload_image_and_convert()` from the Meme class.
+        Blocking wrapper around `fetch_and_download_memes_async`.
+        """
+
+        asyncio.run(self.fetch_and_download_memes_async(cache))
+
+    def log_stats(self) -> None:
+        """
+        Logs what the source cost at the end of a run, if it keeps track.
+        """
@@ -1,32 +1,186 @@
-import requests
-from base import USER_AGENT_HEADERS
-from bs4 import BeautifulSoup
+import codecs
+from collections.abc import Awaitable, Callable
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING
+
+import instrumentation
+from base import HTTP_TIMEOUT, get_http_session, get_with_retries
 from sources.base import MediaType, Meme, MemeBase
 
+if TYPE_CHECKING:
+    import aiohttp
+
+# The page is parsed while it downloads, in chunks of this size
+CHUNK_SIZE = 16 * 1024
+
+
+class _EnoughPosts(Exception):
+    pass
+
+
+class PostImageParser(HTMLParser):
+    """
+    Incremental parser for the image url and alt title of each `div.post-image` in `div.posts`.
+    It stops after `limit` images or at the end of the post list, so the rest of the page is
+    neither parsed nor, when streaming, downloaded.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.candidates: list[tuple[str, str]] = []
+        self.done = False
+        self._div_depth = 0
+        self._posts_depth: int | None = None
+        self._post_image_depth: int | None = None
+
+    def parse(self, text: str) -> bool:
+        """
+        Feeds the next part of the page, returns True once no more is needed.
+        """
+
+        if not self.done:
+            try:
+                self.feed(text)
+            except _EnoughPosts:
+                self.done = True
+        return self.done
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag == "div":
+            self._div_depth += 1
+            classes = (dict(attrs).get("class") or "").split()
+            if self._posts_depth is None and "posts" in classes:
+                self._posts_depth = self._div_depth
+            elif self._posts_depth is not None and "post-image" in classes:
+                self._post_image_depth = self._div_depth
+        elif tag == "img" and self._post_image_depth is not None:
+            image = dict(attrs)
+            self._post_image_depth = None
+            if image.get("src"):
+                self.candidates.append((image["src"], image.get("alt") or ""))
+            if len(self.candidates) == self.limit:
+                raise _EnoughPosts
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag != "div":
+            return
+        if self._div_depth == self._post_image_depth:
+            self._post_image_depth = None
+        if self._div_depth == self._posts_depth:
+            raise _EnoughPosts
+        self._div_depth -= 1
+
+
+def _charset(content_type: str) -> str:
+    """
+    Charset of a Content-Type header, UTF-8 when it has none or an unknown one.
+    """
+
+    for parameter in content_type.split(";")[1:]:
+        key, _, value = parameter.strip().partition("=")
+        if key.lower() == "charset" and value:
+            try:
+                return codecs.lookup(value.strip('"')).name
+            except LookupError:
+                break
+    return "utf-8"
+
 
 class ProgrammerHumorMeme(MemeBase):
     MEME_URL = "https://programmerhumor.io/hot"
+    # Posts of the hot page considered, the first is published and the others are fallbacks
+    CANDIDATE_COUNT = 5
 
-    def fetch_meme(self) -> list[Meme]:
-        response = requests.get(self.MEME_URL, headers=USER_AGENT_HEADERS)
-        if not response.ok:
-            return []
+    def parse_candidates(self, html: bytes | str) -> list[tuple[str, str]]:
+        """
+        Image urls and alt titles of the first CANDIDATE_COUNT posts with an image, in page order.
+        """
 
-        soup = BeautifulSoup(response.content, features="html.parser")
-        posts = soup.find("div", {"class": "posts"})
-        post = posts.find("div", {"class": "post"})
-        post_image = post.find("div", {"class": "post-image"})
-        image = post_image.img
-        image_src = image.attrs["src"]
-        image_title = image.attrs["alt"]
+        parser = PostImageParser(self.CANDIDATE_COUNT)
+        parser.parse(
+            html.decode("utf-8", "replace") if isinstance(html, bytes) else html
+        )
+        return parser.candidates
 
-        return [
+    def convert_candidates(self, candidates: list[tuple[str, str]]) -> list[Meme]:
+        """
+        Picks the first candidate that wasn't published recently, with the ones after it as
+        fallbacks, for the pipeline to claim. Nothing when the first post is still the one whose
+        meme was published, see `pick_unchanged`.
+        """
+
+        pick = candidates[0][0] if candidates else None
+        if pick is not None and self.pick_unchanged(
+            "programmerhumorio", MediaType.IMAGE, pick
+        ):
+            return []
+        memes = [
             self.convert_to_object(
                 image_src, MediaType.IMAGE, "programmerhumorio", image_title
             )
+            for image_src, image_title in candidates
+            if self.history is None
+            or not self.history.is_duplicate(image_src, "programmerhumorio")
         ]
+        if not memes:
+            return []
+
+        for meme in memes:
+            meme.pick = pick
+        memes[0].fallbacks = memes[1:]
+        return memes[:1]
+
+    def parse_memes(self, html: bytes | str) -> list[Meme]:
+        return self.convert_candidates(self.parse_candidates(html))
+
+    def fetch_meme(self) -> list[Meme]:
+        """
+        Streams the hot page and stops downloading it once CANDIDATE_COUNT posts are parsed.
+        """
+
+        parser = PostImageParser(self.CANDIDATE_COUNT)
+        with (
+            instrumentation.span("programmerhumor.listing", source="programmerhumorio"),
+            get_http_session().get(
+                self.MEME_URL, timeout=HTTP_TIMEOUT, stream=True
+            ) as response,
+        ):
+            if not response.ok:
+                return []
+            decoder = codecs.getincrementaldecoder(
+                _charset(response.headers.get("Content-Type", ""))
+            )("replace")
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if parser.parse(decoder.decode(chunk)):
+                    break
+
+        return self.convert_candidates(parser.candidates)
+
+    async def fetch_meme_async(self, session: "aiohttp.ClientSession") -> list[Meme]:
+        parser = PostImageParser(self.CANDIDATE_COUNT)
+        with instrumentation.span(
+            "programmerhumor.listing", source="programmerhumorio"
+        ):
+            async with await get_with_retries(session, self.MEME_URL) as response:
+                if not response.ok:
+                    return []
+                decoder = codecs.getincrementaldecoder(
+                    _charset(response.headers.get("Content-Type", ""))
+                )("replace")
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    if parser.parse(decoder.decode(chunk)):
+                        break
+
+        return self.convert_candidates(parser.candidates)
+
+    def feeds(self) -> list[str]:
+        return ["programmerhumorio"]
+
+    def fetch_jobs(self) -> list[Callable[[], list[Meme]]]:
+        return [self.fetch_meme]
 
-    def fetch_and_download_memes(self) -> None:
-        programmer_humor_memes = self.fetch_meme()
-        for meme in programmer_humor_memes:
-            meme.download_image_and_convert()
+    def fetch_jobs_async(
+        self, session: "aiohttp.ClientSession"
+    ) -> list[Awaitable[list[Meme]]]:
+        return [self.fetch_meme_async(session)]
@@ -1,73 +1,766 @@
+import asyncio
+import base64
+import contextlib
+import html
+import itertools
+import logging
 import os
+import threading
+import time
+from collections import Counter
+from collections.abc import AsyncIterator, Awaitable, Callable, Mapping
+from functools import partial
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlsplit
 
+import instrumentation
 import praw
+from base import HTTP_RETRIES, request_with_retries
+from image.downloader import (
+    fetch_thumbnail,
+    fetch_thumbnail_async,
+    sniff_content_type,
+    sniff_content_type_async,
+)
+from image.fingerprint import try_perceptual_hash
 from praw.models import Submission
+from prawcore import Requestor
+from ratelimit import TokenBucket, retry_after_seconds
 from sources.base import MediaType, Meme, MemeBase
 
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+REDDIT_TOKEN_URL = "https://www.reddit.com/api/v1/access_token"
+REDDIT_OAUTH_URL = "https://oauth.reddit.com"
+LISTING_PAGE_SIZE = 100
+RETRY_STATUSES = tuple(
+    status for status in HTTP_RETRIES.status_forcelist if status != 429
+)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+CONTENT_TYPE_MEDIA_TYPES = {
+    "image/jpeg": MediaType.IMAGE,
+    "image/png": MediaType.IMAGE,
+    "image/webp": MediaType.IMAGE,
+    "image/gif": MediaType.GIF,
+    "video/mp4": MediaType.VIDEO,
+}
+
+
+def _basic_authorization(client_id: str, client_secret: str) -> str:
+    """
+    HTTP Basic `Authorization` header value of the app credentials, for the OAuth token request.
+    """
+
+    credentials = f"{client_id}:{client_secret}".encode("latin1")
+    return "Basic " + base64.b64encode(credentials).decode("ascii")
+
+
+class CountingRequestor(Requestor):
+    """
+    Requestor that counts every HTTP request PRAW sends to Reddit and paces them with the
+    rate limiter shared by all threads. Throttled requests are retried once the limiter allows.
+    """
+
+    def __init__(
+        self,
+        *args,
+        counter: Counter,
+        rate_limiter: TokenBucket,
+        observe: Callable[[int, Mapping[str, str], int], bool],
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.counter = counter
+        self.rate_limiter = rate_limiter
+        self.observe = observe
+
+    def request(self, *args, **kwargs):
+        for attempt in itertools.count():
+            self.rate_limiter.acquire()
+            self.counter["requests"] += 1
+            response = super().request(*args, **kwargs)
+            if not self.observe(response.status_code, response.headers, attempt):
+                return response
+
 
 class RedditMeme(MemeBase):
     SUBREDDITS = []
     MEDIA_TYPES = []
+    LISTING_LIMIT = 500
+    # Reddit allows 100 requests per minute per OAuth client, shared by every thread and listing
+    REQUESTS_PER_MINUTE = 100
+    REQUEST_BURST = 10
+    RATE_LIMIT_RETRIES = 3
+    # Smallest preview width that is still downloaded instead of the original, None always uses originals
+    PREVIEW_TARGET_WIDTH: int | None = 640
+    # Smallest preview width compared with the history before a download
+    THUMBNAIL_MIN_WIDTH = 320
+    # Ranked posts kept per media type, the best is published and the others are its fallbacks
+    CANDIDATE_COUNT = 3
 
-    def __init__(self, subreddits: list[str], media_types: list[MediaType]):
+    def __init__(
+        self,
+        subreddits: list[str],
+        media_types: list[MediaType],
+        time_filter: str = "day",
+        listing_limit: int | None = None,
+    ):
         self.SUBREDDITS = subreddits
         self.MEDIA_TYPES = media_types
+        self.time_filter = time_filter
+        if listing_limit is not None:
+            self.LISTING_LIMIT = listing_limit
+        self._local = threading.local()
+        self._api_call_counters: list[Counter] = []
+        self._api_call_counters_lock = threading.Lock()
+        # The async client runs on one event loop, so a single counter and token are enough
+        self._async_api_calls = Counter()
+        self._api_call_counters.append(self._async_api_calls)
+        self._access_token: tuple[str, float] | None = None
+        self.rate_limiter = TokenBucket(
+            self.REQUESTS_PER_MINUTE / 60, self.REQUEST_BURST
+        )
+
+    @classmethod
+    def from_config(cls, options: dict[str, Any]) -> "RedditMeme":
+        """
+        Media types are given by name in the config, e.g. `media_types = ["IMAGE", "GIF"]`.
+        """
+
+        options = dict(options)
+        options["media_types"] = [
+            MediaType[media_type] for media_type in options.get("media_types", [])
+        ]
+        return cls(**options)
+
+    @property
+    def reddit_client(self) -> praw.Reddit:
+        """
+        PRAW is not thread safe, so every thread gets its own client.
+        """
+
+        reddit_client = getattr(self._local, "reddit_client", None)
+        if reddit_client is None:
+            self._local.api_calls = Counter()
+            with self._api_call_counters_lock:
+                self._api_call_counters.append(self._local.api_calls)
+
+            reddit_client = praw.Reddit(
+                client_id=os.environ.get("REDDIT_CLIENT_ID"),
+                client_secret=os.environ.get("REDDIT_CLIENT_SECRET"),
+                user_agent=os.environ.get("REDDIT_USER_AGENT"),
+                requestor_class=CountingRequestor,
+                requestor_kwargs={
+                    "counter": self._local.api_calls,
+                    "rate_limiter": self.rate_limiter,
+                    "observe": self._observe_rate_limit,
+                },
+            )
+            self._local.reddit_client = reddit_client
+        return reddit_client
+
+    @property
+    def api_calls(self) -> int:
+        """
+        Total number of Reddit API calls made by all threads.
+        """
+
+        with self._api_call_counters_lock:
+            return sum(counter["requests"] for counter in self._api_call_counters)
+
+    def _observe_rate_limit(
+        self, status: int, headers: Mapping[str, str], attempt: int
+    ) -> bool:
+        """
+        Feeds the rate limit headers of a response to the shared limiter. On a 429 every worker
+        is paused until Reddit's window resets; returns True when the request should be retried.
+        """
+
+        remaining = headers.get("X-Ratelimit-Remaining")
+        reset = headers.get("X-Ratelimit-Reset")
+        with contextlib.suppress(ValueError):
+            if remaining is not None and reset is not None:
+                self.rate_limiter.update(float(remaining), float(reset))
+        if status != 429:
+            return False
+
+        backoff = retry_after_seconds(
+            headers, float(reset) if reset and reset.isdigit() else 2.0**attempt
+        )
+        self.rate_limiter.pause(backoff)
+        instrumentation.count("reddit.throttled")
+        logger.warning("Reddit rate limit hit, pausing requests for %.0fs", backoff)
+        return attempt < self.RATE_LIMIT_RETRIES
+
+    def subreddits_by_age(self) -> list[str]:
+        """
+        Subreddits whose files were published longest ago first, so they are fetched before the
+        rate limit gets tight. Subreddits that never published come first, ties keep the config order.
+        """
 
-        self.reddit_client = praw.Reddit(
-            client_id=os.environ.get("REDDIT_CLIENT_ID"),
-            client_secret=os.environ.get("REDDIT_CLIENT_SECRET"),
-            user_agent=os.environ.get("REDDIT_USER_AGENT"),
+        if self.cache is None:
+            return list(self.SUBREDDITS)
+        return sorted(
+            self.SUBREDDITS,
+            key=lambda subreddit: self.cache.published_at(f"reddit/{subreddit}") or 0.0,
         )
 
     def get_media_type(self, post: Submission) -> MediaType:
-        if (
-            post.url.endswith(".jpg")
-            or post.url.endswith(".jpeg")
-            or post.url.endswith(".png")
+        media_type, _ = self.resolve_media(post)
+        return media_type
+
+    def resolve_media(self, post: Submission | dict) -> tuple[MediaType, str | None]:
+        """
+        Works out what a post links to and the url to download it from.
+        Galleries, previews and videos are resolved from the listing payload; only posts without
+        any media metadata fall back to sniffing the first bytes of their url.
+        """
+
+        post_data = post if isinstance(post, dict) else vars(post)
+        resolved = self._resolve_from_metadata(post_data)
+        if resolved is not None:
+            return resolved
+
+        content_type = sniff_content_type(post_data["url"])
+        return CONTENT_TYPE_MEDIA_TYPES.get(content_type, MediaType.UNKNOWN), post_data[
+            "url"
+        ]
+
+    async def resolve_media_async(
+        self, session: "aiohttp.ClientSession", post_data: dict
+    ) -> tuple[MediaType, str | None]:
+        """
+        Async variant of `resolve_media`, sniffing on the event loop.
+        """
+
+        resolved = self._resolve_from_metadata(post_data)
+        if resolved is not None:
+            return resolved
+
+        content_type = await sniff_content_type_async(session, post_data["url"])
+        return CONTENT_TYPE_MEDIA_TYPES.get(content_type, MediaType.UNKNOWN), post_data[
+            "url"
+        ]
+
+    def _resolve_from_metadata(
+        self, post_data: dict[str, Any]
+    ) -> tuple[MediaType, str | None] | None:
+        """
+        Resolves the post from the listing payload alone, None when it has to be sniffed.
+        """
+
+        url = post_data["url"]
+        if post_data.get("is_self"):
+            return MediaType.UNKNOWN, None
+        if post_data.get("is_gallery"):
+            return self._resolve_gallery(post_data)
+
+        preview_images = (post_data.get("preview") or {}).get("images") or []
+        preview_image = preview_images[0] if preview_images else None
+        extension = os.path.splitext(urlsplit(url).path)[1].lower()
+
+        gif_variant = (preview_image or {}).get("variants", {}).get("gif")
+        if gif_variant is not None:
+            # Also covers .gifv and other links whose preview is a GIF
+            return MediaType.GIF, self._pick_preview(
+                gif_variant, url if extension == ".gif" else None
+            )
+        if extension == ".gif":
+            return MediaType.GIF, url
+        if post_data.get("is_video") or post_data.get("post_hint") in (
+            "hosted:video",
+            "rich:video",
         ):
-            return MediaType.IMAGE
-        elif post.url.endswith(".gif"):
-            return MediaType.GIF
+            return MediaType.VIDEO, url
+        if extension in IMAGE_EXTENSIONS or post_data.get("post_hint") == "image":
+            if preview_image is None:
+                return MediaType.IMAGE, url
+            return MediaType.IMAGE, self._pick_preview(
+                preview_image, url if extension in IMAGE_EXTENSIONS else None
+            )
+        if preview_image is not None or post_data.get("post_hint") is not None:
+            # Links to articles and other pages
+            return MediaType.UNKNOWN, None
+        if urlsplit(url).hostname in (None, "reddit.com", "www.reddit.com"):
+            return MediaType.UNKNOWN, None
+        return None
+
+    def _resolve_gallery(
+        self, post_data: dict[str, Any]
+    ) -> tuple[MediaType, str | None]:
+        """
+        Resolves the first item of a gallery from its `media_metadata`.
+        """
+
+        gallery_items = (post_data.get("gallery_data") or {}).get("items") or []
+        media_metadata = post_data.get("media_metadata") or {}
+        if not gallery_items or gallery_items[0].get("media_id") not in media_metadata:
+            return MediaType.UNKNOWN, None
+
+        metadata = media_metadata[gallery_items[0]["media_id"]]
+        source = metadata.get("s") or {}
+        if metadata.get("status") != "valid":
+            return MediaType.UNKNOWN, None
+        if metadata.get("e") == "AnimatedImage" and "gif" in source:
+            return MediaType.GIF, html.unescape(source["gif"])
+        if metadata.get("e") == "Image" and "u" in source:
+            return MediaType.IMAGE, self._pick_preview(
+                {
+                    "source": {"url": source["u"], "width": source.get("x", 0)},
+                    "resolutions": [
+                        {"url": preview["u"], "width": preview.get("x", 0)}
+                        for preview in metadata.get("p", [])
+                    ],
+                }
+            )
+        return MediaType.UNKNOWN, None
+
+    def _pick_preview(
+        self, preview: dict[str, Any], original_url: str | None = None
+    ) -> str:
+        """
+        Picks the smallest preview resolution that is at least PREVIEW_TARGET_WIDTH wide.
+        When no resolution is smaller than the source, the original is used if there is one.
+        """
+
+        source = preview["source"]
+        if self.PREVIEW_TARGET_WIDTH is not None:
+            fitting = [
+                resolution
+                for resolution in preview.get("resolutions", [])
+                if self.PREVIEW_TARGET_WIDTH <= resolution["width"] < source["width"]
+            ]
+            if fitting:
+                smallest = min(fitting, key=lambda resolution: resolution["width"])
+                return html.unescape(smallest["url"])
+        return original_url or html.unescape(source["url"])
+
+    def _lead(
+        self,
+        subreddit: str,
+        picks: dict[MediaType, str],
+        kept: set[MediaType],
+        post_data: dict,
+        resolved: tuple[MediaType, str | None],
+    ) -> None:
+        """
+        Records the first post of every wanted media type as the pick the listing leads with, before
+        the history is checked. A media type whose pick is unchanged since its meme was published
+        is `kept`, the listing selects no candidates for it.
+        """
+
+        post_media_type, _ = resolved
+        if post_media_type in self.MEDIA_TYPES and post_media_type not in picks:
+            picks[post_media_type] = post_data["id"]
+            if self.pick_unchanged(
+                f"reddit/{subreddit}", post_media_type, post_data["id"]
+            ):
+                kept.add(post_media_type)
+
+    def _wants(
+        self,
+        selected_posts: dict[MediaType, list[tuple[dict, str, int | None]]],
+        resolved: tuple[MediaType, str | None],
+        kept: set[MediaType],
+    ) -> bool:
+        """
+        Whether a resolved listing post is a wanted media type that still needs candidates.
+        """
+
+        post_media_type, _ = resolved
+        return (
+            post_media_type in self.MEDIA_TYPES
+            and post_media_type not in kept
+            and len(selected_posts.get(post_media_type, ())) < self.CANDIDATE_COUNT
+        )
+
+    def _offer(
+        self,
+        selected_posts: dict[MediaType, list[tuple[dict, str, int | None]]],
+        post_data: dict,
+        resolved: tuple[MediaType, str | None],
+        perceptual_hash: int | None = None,
+    ) -> None:
+        """
+        Adds a wanted listing post to the candidates of its media type, in listing order.
+        """
+
+        post_media_type, media_url = resolved
+        selected_posts.setdefault(post_media_type, []).append(
+            (post_data, media_url, perceptual_hash)
+        )
+
+    def _selected_enough(
+        self,
+        selected_posts: dict[MediaType, list[tuple[dict, str, int | None]]],
+        scanned_posts: int,
+        kept: set[MediaType],
+    ) -> bool:
+        """
+        Whether the listing walk can stop: every wanted media type that is not `kept` has
+        CANDIDATE_COUNT candidates, or at least one at the end of a listing page, since fallbacks
+        aren't worth another request.
+        """
+
+        counts = [
+            len(selected_posts.get(media_type, ()))
+            for media_type in self.MEDIA_TYPES
+            if media_type not in kept
+        ]
+        fewest = min(counts, default=self.CANDIDATE_COUNT)
+        return fewest >= self.CANDIDATE_COUNT or (
+            fewest > 0 and scanned_posts % LISTING_PAGE_SIZE == 0
+        )
+
+    def _thumbnail_url(self, post_data: dict[str, Any]) -> str | None:
+        """
+        Smallest preview of the post at least THUMBNAIL_MIN_WIDTH wide, enough to compare its
+        picture with the history.
+        """
+
+        if post_data.get("is_gallery"):
+            gallery_items = (post_data.get("gallery_data") or {}).get("items") or []
+            media_metadata = post_data.get("media_metadata") or {}
+            metadata = (
+                media_metadata.get(gallery_items[0].get("media_id"), {})
+                if gallery_items
+                else {}
+            )
+            resolutions = [
+                {"url": preview["u"], "width": preview.get("x", 0)}
+                for preview in metadata.get("p") or []
+            ]
         else:
-            return MediaType.UNKNOWN
+            preview_images = (post_data.get("preview") or {}).get("images") or []
+            resolutions = (
+                preview_images[0].get("resolutions") or [] if preview_images else []
+            )
 
-    def fetch_meme(self, subreddit: str, time_filter: str) -> list[Meme]:
-        top_posts = self.reddit_client.subreddit(subreddit).top(
-            time_filter=time_filter, limit=500
+        if resolutions:
+            # Thumbnails of long images are only a few pixels tall, so skip the smallest ones
+            fitting = [
+                resolution
+                for resolution in resolutions
+                if resolution["width"] >= self.THUMBNAIL_MIN_WIDTH
+            ] or resolutions
+            smallest = min(fitting, key=lambda resolution: resolution["width"])
+            return html.unescape(smallest["url"])
+        thumbnail = post_data.get("thumbnail") or ""
+        return thumbnail if thumbnail.startswith("http") else None
+
+    def _check(
+        self, subreddit: str, media_url: str, thumbnail: bytes | None
+    ) -> tuple[bool, int | None]:
+        """
+        Checks a candidate against the history, comparing the picture of its thumbnail when there
+        is one. Nothing is claimed here, the pipeline claims the picks of every listing once they
+        are all in, see `pipeline._claim_listings`. Returns whether it is new and the perceptual
+        hash of the thumbnail.
+        """
+
+        perceptual_hash = try_perceptual_hash(thumbnail) if thumbnail else None
+        is_new = not self.history.is_duplicate(
+            media_url, f"reddit/{subreddit}", perceptual_hash
         )
-        selected_posts = []
+        return is_new, perceptual_hash
 
-        for media_type in self.MEDIA_TYPES:
-            selected_post = None
+    def _check_post(
+        self, subreddit: str, post_data: dict, media_url: str
+    ) -> tuple[bool, int | None]:
+        if self.history is None:
+            return True, None
+        thumbnail_url = self._thumbnail_url(post_data)
+        thumbnail = fetch_thumbnail(thumbnail_url) if thumbnail_url else None
+        return self._check(subreddit, media_url, thumbnail)
 
-            for post in top_posts:
-                post = self.reddit_client.submission(post)
-                post_media_type = self.get_media_type(post)
+    async def _check_post_async(
+        self,
+        session: "aiohttp.ClientSession",
+        subreddit: str,
+        post_data: dict,
+        media_url: str,
+    ) -> tuple[bool, int | None]:
+        if self.history is None:
+            return True, None
+        thumbnail_url = self._thumbnail_url(post_data)
+        thumbnail = (
+            await fetch_thumbnail_async(session, thumbnail_url)
+            if thumbnail_url
+            else None
+        )
+        return self._check(subreddit, media_url, thumbnail)
 
-                if post.over_18 is False and post_media_type == media_type:
-                    selected_post = post
-                    break
+    def _convert_selected(
+        self,
+        subreddit: str,
+        selected_posts: dict[MediaType, list[tuple[dict, str, int | None]]],
+        picks: dict[MediaType, str],
+    ) -> list[Meme]:
+        """
+        One meme per media type, the best candidate with the others as its fallbacks.
+        Every candidate carries the pick of its media type, see `_lead`.
+        """
 
-            if selected_post is not None:
-                selected_posts.append(selected_post)
+        converted_posts = []
+        for media_type in dict.fromkeys(self.MEDIA_TYPES):
+            if media_type not in selected_posts:
                 continue
 
-        converted_posts = []
-        for post in selected_posts:
-            converted_posts.append(
+            candidates = [
                 self.convert_to_object(
-                    title=post.title,
-                    media_url=post.url,
-                    media_type=self.get_media_type(post),
+                    title=post_data["title"],
+                    media_url=media_url,
+                    media_type=media_type,
                     source=f"reddit/{subreddit}",
+                    perceptual_hash=perceptual_hash,
                 )
-            )
+                for post_data, media_url, perceptual_hash in selected_posts[media_type]
+            ]
+            for candidate in candidates:
+                candidate.pick = picks.get(media_type)
+            candidates[0].fallbacks = candidates[1:]
+            converted_posts.append(candidates[0])
 
         return converted_posts
 
-    def fetch_and_download_memes(self) -> None:
-        for subreddit in self.SUBREDDITS:
-            memes = self.fetch_meme(subreddit, "day")
+    def _log_listing(self, subreddit: str, scanned_posts: int, api_calls: int) -> None:
+        instrumentation.count(
+            "reddit.api_calls", api_calls, source=f"reddit/{subreddit}"
+        )
+        instrumentation.count(
+            "reddit.posts_scanned", scanned_posts, source=f"reddit/{subreddit}"
+        )
+        logger.info(
+            "r/%s: scanned %d posts with %d API calls",
+            subreddit,
+            scanned_posts,
+            api_calls,
+        )
+
+    def fetch_meme(self, subreddit: str, time_filter: str) -> list[Meme]:
+        """
+        Walks the top listing once and picks the first SFW posts for every wanted media type,
+        up to CANDIDATE_COUNT each. Posts are classified from the listing payload, and paging
+        stops once every media type has its candidates, see `_selected_enough`.
+        """
+
+        reddit_client = self.reddit_client
+        requests_before = self._local.api_calls["requests"]
+        selected_posts: dict[MediaType, list[tuple[dict, str, int | None]]] = {}
+        picks: dict[MediaType, str] = {}
+        kept: set[MediaType] = set()
+
+        top_posts = reddit_client.subreddit(subreddit).top(
+            time_filter=time_filter, limit=self.LISTING_LIMIT
+        )
+        with (
+            instrumentation.tagged(source=f"reddit/{subreddit}"),
+            instrumentation.span("reddit.listing"),
+        ):
+            for post in top_posts:
+                post_data = vars(post)
+                if post_data.get("over_18") is False:
+                    resolved = self.resolve_media(post_data)
+                    self._lead(subreddit, picks, kept, post_data, resolved)
+                    if self._wants(selected_posts, resolved, kept):
+                        is_new, perceptual_hash = self._check_post(
+                            subreddit, post_data, resolved[1]
+                        )
+                        if is_new:
+                            self._offer(
+                                selected_posts, post_data, resolved, perceptual_hash
+                            )
+                if self._selected_enough(selected_posts, top_posts.yielded, kept):
+                    break
+
+        self._log_listing(
+            subreddit,
+            top_posts.yielded,
+            self._local.api_calls["requests"] - requests_before,
+        )
+        return self._convert_selected(subreddit, selected_posts, picks)
+
+    async def _access_token_async(
+        self, session: "aiohttp.ClientSession", lock: asyncio.Lock
+    ) -> str:
+        """
+        Application-only OAuth token for the JSON API, shared by all listings and renewed when expired.
+        """
+
+        async with lock:
+            if self._access_token is None or self._access_token[1] <= time.monotonic():
+                async with await self._request_async(
+                    session,
+                    "POST",
+                    REDDIT_TOKEN_URL,
+                    data={"grant_type": "client_credentials"},
+                    headers={
+                        **self._async_headers(),
+                        "Authorization": _basic_authorization(
+                            os.environ.get("REDDIT_CLIENT_ID", ""),
+                            os.environ.get("REDDIT_CLIENT_SECRET", ""),
+                        ),
+                    },
+                ) as response:
+                    response.raise_for_status()
+                    token = await response.json()
+                self._access_token = (
+                    token["access_token"],
+                    # Renew a minute early
+                    time.monotonic() + token["expires_in"] - 60,
+                )
+            return self._access_token[0]
+
+    async def _request_async(
+        self,
+        session: "aiohttp.ClientSession",
+        method: str,
+        url: str,
+        calls: Counter | None = None,
+        **kwargs,
+    ) -> "aiohttp.ClientResponse":
+        """
+        Async counterpart of `CountingRequestor.request`: paces every attempt with the shared
+        rate limiter and counts it, also in `calls` when given. A 429 pauses every request and is
+        retried, see `_observe_rate_limit`, other failures are retried by `request_with_retries`.
+        Use the response as `async with` so it is released.
+        """
+
+        for attempt in itertools.count():
+            await self.rate_limiter.acquire_async()
+            self._async_api_calls["requests"] += 1
+            if calls is not None:
+                calls["requests"] += 1
+            response = await request_with_retries(
+                session,
+                method,
+                url,
+                # 429s pause the shared limiter instead of only this request
+                retry_statuses=RETRY_STATUSES,
+                **kwargs,
+            )
+            if not self._observe_rate_limit(response.status, response.headers, attempt):
+                return response
+            response.release()
+
+    def _async_headers(self, access_token: str | None = None) -> dict[str, str]:
+        headers = {"User-Agent": os.environ.get("REDDIT_USER_AGENT", "python-memer")}
+        if access_token is not None:
+            headers["Authorization"] = f"bearer {access_token}"
+        return headers
+
+    async def _iter_top_async(
+        self,
+        session: "aiohttp.ClientSession",
+        token_lock: asyncio.Lock,
+        subreddit: str,
+        time_filter: str,
+        listing_calls: Counter,
+    ) -> AsyncIterator[dict]:
+        """
+        Pages through the top listing of the JSON API like PRAW's ListingGenerator, up to LISTING_LIMIT posts.
+        Listing requests are also counted in listing_calls.
+        """
+
+        yielded = 0
+        after = None
+        while yielded < self.LISTING_LIMIT:
+            params = {
+                "t": time_filter,
+                "limit": str(min(LISTING_PAGE_SIZE, self.LISTING_LIMIT - yielded)),
+                "raw_json": "1",
+            }
+            if after is not None:
+                params["after"] = after
+
+            access_token = await self._access_token_async(session, token_lock)
+            async with await self._request_async(
+                session,
+                "GET",
+                f"{REDDIT_OAUTH_URL}/r/{subreddit}/top",
+                listing_calls,
+                params=params,
+                headers=self._async_headers(access_token),
+            ) as response:
+                response.raise_for_status()
+                listing = (await response.json())["data"]
+
+            for child in listing["children"]:
+                yield child["data"]
+                yielded += 1
+            after = listing.get("after")
+            if not listing["children"] or after is None:
+                return
+
+    async def fetch_meme_async(
+        self,
+        session: "aiohttp.ClientSession",
+        token_lock: asyncio.Lock,
+        subreddit: str,
+        time_filter: str,
+    ) -> list[Meme]:
+        """
+        Async variant of `fetch_meme` on Reddit's JSON API instead of PRAW.
+        """
+
+        listing_calls = Counter()
+        scanned_posts = 0
+        selected_posts: dict[MediaType, list[tuple[dict, str, int | None]]] = {}
+        picks: dict[MediaType, str] = {}
+        kept: set[MediaType] = set()
+
+        with (
+            instrumentation.tagged(source=f"reddit/{subreddit}"),
+            instrumentation.span("reddit.listing"),
+        ):
+            async with contextlib.aclosing(
+                self._iter_top_async(
+                    session, token_lock, subreddit, time_filter, listing_calls
+                )
+            ) as top_posts:
+                async for post_data in top_posts:
+                    scanned_posts += 1
+                    if post_data.get("over_18") is False:
+                        resolved = await self.resolve_media_async(session, post_data)
+                        self._lead(subreddit, picks, kept, post_data, resolved)
+                        if self._wants(selected_posts, resolved, kept):
+                            is_new, perceptual_hash = await self._check_post_async(
+                                session, subreddit, post_data, resolved[1]
+                            )
+                            if is_new:
+                                self._offer(
+                                    selected_posts, post_data, resolved, perceptual_hash
+                                )
+                    if self._selected_enough(selected_posts, scanned_posts, kept):
+                        break
+
+        self._log_listing(subreddit, scanned_posts, listing_calls["requests"])
+        return self._convert_selected(subreddit, selected_posts, picks)
+
+    def feeds(self) -> list[str]:
+        return [f"reddit/{subreddit}" for subreddit in self.SUBREDDITS]
+
+    def fetch_jobs(self) -> list[Callable[[], list[Meme]]]:
+        return [
+            partial(self.fetch_meme, subreddit, self.time_filter)
+            for subreddit in self.subreddits_by_age()
+            if self.is_due(f"reddit/{subreddit}")
+        ]
+
+    def fetch_jobs_async(
+        self, session: "aiohttp.ClientSession"
+    ) -> list[Awaitable[list[Meme]]]:
+        # One lock per event loop, so concurrent listings request a single token
+        token_lock = asyncio.Lock()
+        return [
+            self.fetch_meme_async(session, token_lock, subreddit, self.time_filter)
+            for subreddit in self.subreddits_by_age()
+            if self.is_due(f"reddit/{subreddit}")
+        ]
 
-            for meme in memes:
-                meme.download_image_and_convert()
+    def log_stats(self) -> None:
+        logger.info("Reddit: %d API calls in total", self.api_calls)
@@ -0,0 +1,92 @@
+import importlib
+import tomllib
+from typing import Any
+
+from image.generator import ENCODING_PROFILES, Rendition
+from sources.base import MemeBase
+
+# Built-in sources as "module:Class", imported only when selected
+SOURCES = {
+    "reddit": "sources.reddit:RedditMeme",
+    "programmerhumor": "sources.programmerhumor:ProgrammerHumorMeme",
+}
+
+
+def load_source_class(name: str, class_path: str | None = None) -> type[MemeBase]:
+    """
+    Imports the `MemeBase` implementation registered under name, or the one at class_path.
+    """
+
+    class_path = class_path or SOURCES.get(name)
+    if class_path is None:
+        raise ValueError(
+            f"Unknown source {name!r}, expected one of {', '.join(SOURCES)} "
+            "or a `class` option"
+        )
+
+    module_name, _, class_name = class_path.partition(":")
+    source_class = getattr(importlib.import_module(module_name), class_name)
+    if not issubclass(source_class, MemeBase):
+        raise TypeError(f"{class_path} is not a MemeBase")
+    return source_class
+
+
+def load_config(path: str) -> dict[str, Any]:
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def render_options_from_config(config: dict[str, Any]) -> dict[str, Any]:
+    """
+    Options for `add_title_above_file` from the `[render]` table.
+    """
+
+    render_options = dict(config.get("render", {}))
+    encoding = render_options.get("encoding")
+    if encoding is not None and encoding not in ENCODING_PROFILES:
+        raise ValueError(
+            f"Unknown encoding {encoding!r}, expected one of {', '.join(ENCODING_PROFILES)}"
+        )
+    if "renditions" in render_options:
+        render_options["renditions"] = tuple(
+            Rendition(**rendition) for rendition in render_options["renditions"]
+        )
+    return render_options
+
+
+def build_sources(
+    config: dict[str, Any], selected: list[str] | None = None
+) -> dict[str, MemeBase]:
+    """
+    Builds the sources of the `[sources.<name>]` tables, only importing the selected ones.
+    Without a selection every source that is not `enabled = false` is built.
+    The `[render]` and `[schedule]` tables apply to every source, and a source's own
+    `[sources.<name>.render]` and `[sources.<name>.schedule]` tables override them.
+    """
+
+    source_configs: dict[str, dict[str, Any]] = config.get("sources", {})
+    unknown = set(selected or ()) - set(source_configs)
+    if unknown:
+        raise ValueError(f"Sources not in the config: {', '.join(sorted(unknown))}")
+
+    sources = {}
+    for name, options in source_configs.items():
+        options = dict(options)
+        enabled = options.pop("enabled", True)
+        class_path = options.pop("class", None)
+        # A [sources.<name>.render] table overrides the [render] options for this source
+        render_overrides = options.pop("render", {})
+        schedule_overrides = options.pop("schedule", {})
+        if (selected and name not in selected) or (not selected and not enabled):
+            continue
+
+        source = load_source_class(name, class_path).from_config(options)
+        source.render_options = render_options_from_config(
+            {"render": {**config.get("render", {}), **render_overrides}}
+        )
+        source.schedule_options = {
+            **config.get("schedule", {}),
+            **schedule_overrides,
+        }
+        sources[name] = source
+    return sources
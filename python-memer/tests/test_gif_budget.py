@@ -0,0 +1,50 @@
+import logging
+
+from image.generator import GIF_BUDGET_STEPS, add_title_above_file
+from PIL import Image, ImageDraw
+
+
+def _transparent_gif(path: str, frame_count: int = 8) -> None:
+    frames = []
+    for i in range(frame_count):
+        frame = Image.new("P", (60, 40), 0)
+        frame.putpalette([c for k in range(16) for c in (k * 16, 255 - k * 16, 80)])
+        ImageDraw.Draw(frame).rectangle((i * 5, 5, i * 5 + 10, 20), fill=1 + i)
+        frames.append(frame)
+    frames[0].save(
+        path,
+        save_all=True,
+        append_images=frames[1:],
+        duration=50,
+        loop=0,
+        transparency=0,
+        disposal=2,
+    )
+
+
+def test_transparent_gif_only_tries_frame_steps_with_its_own_palette(tmp_path, caplog):
+    input_path = str(tmp_path / "transparent.gif")
+    output_path = str(tmp_path / "todays_gif.gif")
+    _transparent_gif(input_path)
+    with Image.open(input_path) as input_img:
+        source_colors = len(input_img.getpalette()) // 3
+
+    with caplog.at_level(logging.INFO, logger="image.generator"):
+        file_sizes = add_title_above_file(
+            input_path, "A transparent GIF", output_path, gif_max_bytes=1
+        )
+
+    frame_steps = list(dict.fromkeys(step for _, step in GIF_BUDGET_STEPS))
+    assert [
+        record.getMessage()
+        for record in caplog.records
+        if record.levelno == logging.INFO and " is over " in record.getMessage()
+    ] == [
+        f"{output_path} is over 1 bytes with {source_colors} colors and every {step}. frame"
+        for step in frame_steps
+    ]
+    assert file_sizes.encodings[output_path].settings == (
+        f"GIF {source_colors} colors, every {frame_steps[-1]}. frame"
+    )
+    with Image.open(output_path) as rendered:
+        assert rendered.info["transparency"] is not None
@@ -0,0 +1,121 @@
+import weakref
+
+import image.generator
+import pytest
+from image.generator import add_title_above_file
+from PIL import Image, ImageDraw, ImageSequence
+
+FRAME_COUNTS = (10, 100, 400)
+
+
+def _synthetic_gif(path: str, frame_count: int) -> None:
+    """
+    A GIF whose every frame differs, so none of them is collapsed as a duplicate.
+    """
+
+    frames = []
+    for i in range(frame_count):
+        frame = Image.new("RGB", (160, 120), (i % 256, 80, 160))
+        x, y = i * 7 % 140, i % 100
+        ImageDraw.Draw(frame).rectangle(
+            (x, y, x + 20, y + 20), fill=(255, 255 - i % 256, 0)
+        )
+        frames.append(frame)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=40, loop=0)
+
+
+def _decoded_frames(path: str) -> list[tuple[bytes, int]]:
+    with Image.open(path) as gif:
+        return [
+            (frame.convert("RGBA").tobytes(), frame.info["duration"])
+            for frame in ImageSequence.Iterator(gif)
+        ]
+
+
+@pytest.fixture(scope="module")
+def gifs(tmp_path_factory) -> dict[int, str]:
+    directory = tmp_path_factory.mktemp("gifs")
+    paths = {}
+    for frame_count in FRAME_COUNTS:
+        paths[frame_count] = str(directory / f"{frame_count}.gif")
+        _synthetic_gif(paths[frame_count], frame_count)
+    return paths
+
+
+@pytest.fixture
+def frames_alive(monkeypatch) -> list[int]:
+    """
+    Tracks every frame given to `_write_gif` with a weak reference, and records how many of them
+    were still alive each time it took the next one.
+    """
+
+    alive_counts = []
+    write_gif = image.generator._write_gif
+
+    def counting_write_gif(fp, frames, **options):
+        alive = 0
+        references = []
+
+        def released(_reference):
+            nonlocal alive
+            alive -= 1
+
+        def counted_frames():
+            nonlocal alive
+            for frame, duration_ms in frames:
+                references.append(weakref.ref(frame, released))
+                alive += 1
+                alive_counts.append(alive)
+                yield frame, duration_ms
+
+        write_gif(fp, counted_frames(), **options)
+
+    monkeypatch.setattr(image.generator, "_write_gif", counting_write_gif)
+    return alive_counts
+
+
+def test_gif_frames_alive_do_not_grow_with_frame_count(gifs, tmp_path, frames_alive):
+    """
+    Frames are rendered and encoded one at a time, so the same few are alive whatever the
+    length of the GIF.
+    """
+
+    output_path = str(tmp_path / "todays_gif.gif")
+    peaks = {}
+    for frame_count, path in gifs.items():
+        frames_alive.clear()
+        add_title_above_file(path, "A title above a synthetic GIF", output_path)
+        assert len(frames_alive) == frame_count
+        peaks[frame_count] = max(frames_alive)
+        with Image.open(output_path) as rendered:
+            assert rendered.n_frames == frame_count
+
+    assert peaks[10] <= 3, peaks
+    assert peaks[100] == peaks[10], peaks
+    assert peaks[400] == peaks[10], peaks
+
+
+def test_save_all_fallback_writes_the_same_frames(gifs, tmp_path, monkeypatch):
+    streamed_path = str(tmp_path / "streamed.gif")
+    saved_path = str(tmp_path / "saved.gif")
+    add_title_above_file(gifs[10], "A title above a synthetic GIF", streamed_path)
+
+    # As on a Pillow without the private frame encoder
+    monkeypatch.setattr(image.generator, "_gif_frame_writer", lambda: None)
+    add_title_above_file(gifs[10], "A title above a synthetic GIF", saved_path)
+
+    assert _decoded_frames(saved_path) == _decoded_frames(streamed_path)
+
+
+def test_save_all_fallback_keeps_to_the_budget(gifs, tmp_path, monkeypatch):
+    monkeypatch.setattr(image.generator, "_gif_frame_writer", lambda: None)
+    output_path = str(tmp_path / "todays_gif.gif")
+
+    file_sizes = add_title_above_file(
+        gifs[100], "A title above a synthetic GIF", output_path, gif_max_bytes=20_000
+    )
+
+    assert file_sizes[output_path] <= 20_000
+    assert (
+        file_sizes.encodings[output_path].settings != "GIF 256 colors, every 1. frame"
+    )
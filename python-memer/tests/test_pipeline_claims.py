@@ -0,0 +1,116 @@
+import asyncio
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from history import HistoryIndex, url_hash
+from PIL import Image, ImageDraw
+from pipeline import Executors, PipelineConfig, run_pipeline, run_pipeline_async
+from sources.base import MediaType, MemeBase
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def media_url(tmp_path):
+    """
+    Serves a picture with a diagonal line and one with a grid, returns the url of a file name.
+    """
+
+    www = tmp_path / "www"
+    www.mkdir()
+    line = Image.new("RGB", (240, 180), "white")
+    ImageDraw.Draw(line).line((0, 0, 240, 180), fill="black", width=30)
+    line.save(www / "shared.png")
+    grid = Image.new("RGB", (240, 180), "black")
+    for x in range(0, 240, 40):
+        ImageDraw.Draw(grid).rectangle((x, 0, x + 19, 180), fill="white")
+    grid.save(www / "other.png")
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(www))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield lambda name: f"http://127.0.0.1:{server.server_port}/{name}"
+    server.shutdown()
+    thread.join()
+
+
+class ListingSource(MemeBase):
+    """
+    One feed whose listing returns a meme of the first url with the others as its fallbacks,
+    once `wait_for` is set.
+    """
+
+    def __init__(self, name: str, urls: list[str]):
+        self.name = name
+        self.urls = urls
+        self.wait_for: threading.Event | None = None
+        self.listed = threading.Event()
+
+    def feeds(self) -> list[str]:
+        return [self.name]
+
+    def fetch_jobs(self):
+        return [self.fetch_meme]
+
+    def fetch_meme(self):
+        if self.wait_for is not None:
+            assert self.wait_for.wait(10)
+        candidates = [
+            self.convert_to_object(url, MediaType.IMAGE, self.name, f"{self.name} meme")
+            for url in self.urls
+        ]
+        candidates[0].fallbacks = candidates[1:]
+        self.listed.set()
+        return candidates[:1]
+
+
+@pytest.mark.parametrize("use_asyncio", [False, True], ids=["threads", "asyncio"])
+@pytest.mark.parametrize("reverse", [False, True], ids=["in order", "reversed"])
+def test_shared_meme_goes_to_the_first_source_whatever_fetch_finishes_first(
+    tmp_path, monkeypatch, media_url, use_asyncio, reverse
+):
+    monkeypatch.chdir(tmp_path)
+    first = ListingSource("first", [media_url("shared.png")])
+    second = ListingSource("second", [media_url("shared.png"), media_url("other.png")])
+    if reverse:
+        first.wait_for = second.listed
+    else:
+        second.wait_for = first.listed
+    history = HistoryIndex(str(tmp_path / "history.jsonl"))
+    config = PipelineConfig(render_workers=1)
+
+    with Executors(
+        fetch=ThreadPoolExecutor(2),
+        download=ThreadPoolExecutor(2),
+        new_render_pool=lambda: ThreadPoolExecutor(1),
+    ) as executors:
+        if use_asyncio:
+            asyncio.run(
+                run_pipeline_async(
+                    [first, second], config, history=history, executors=executors
+                )
+            )
+        else:
+            run_pipeline([first, second], config, history=history, executors=executors)
+
+    published = {}
+    for source in ("first", "second"):
+        with open(f"memes/{source}/original_todays_png.json", encoding="utf-8") as f:
+            published[source] = json.load(f)["media_url"]
+    assert published == {
+        "first": media_url("shared.png"),
+        "second": media_url("other.png"),
+    }
+    assert sorted((record.source, record.url) for record in history.records) == [
+        ("first", url_hash(media_url("shared.png"))),
+        ("second", url_hash(media_url("other.png"))),
+    ]
@@ -0,0 +1,291 @@
+import asyncio
+import contextlib
+import functools
+import math
+import time
+from collections import Counter
+from collections.abc import AsyncIterator
+
+import praw
+import pytest
+import sources.reddit
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+from cache import CacheEntry, CacheManifest
+from ratelimit import TokenBucket
+from sources.base import MediaType
+from sources.reddit import RedditMeme
+
+TOKEN_PATH = "/api/v1/access_token"
+
+
+class FakeReddit:
+    """
+    Reddit's token and top listing endpoints behind a limit of `limit` requests per fixed window
+    of `window` seconds, with the X-Ratelimit-* headers Reddit sends. Requests over the limit get
+    a 429 with Retry-After until the window resets, and every one after the first is a violation,
+    the client was already told to wait. With `throttled_for`, request number `throttled_at` finds
+    a window that is already used up for that long and unreported. Listings have `pages` pages of
+    one post each.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        window: float = 60.0,
+        throttled_for: float = 0.0,
+        throttled_at: int = 0,
+        pages: int = 1,
+    ):
+        self.limit = limit
+        self.window = window
+        self.pages = pages
+        self.throttled_for = throttled_for
+        self.throttled_at = throttled_at
+        self.used = 0
+        self.window_end = 0.0
+        self.told_to_wait = False
+        self.requests: list[tuple[str, float]] = []
+        self.throttled = 0
+        self.violations = 0
+        self.authorizations: list[str] = []
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(TOKEN_PATH, self.access_token)
+        app.router.add_get("/r/{subreddit}/top", self.top)
+        return app
+
+    def paths(self) -> list[str]:
+        return [path for path, _ in self.requests]
+
+    def _rate_limit(self, request: web.Request) -> tuple[web.Response | None, dict]:
+        now = time.monotonic()
+        if self.throttled_for and len(self.requests) == self.throttled_at:
+            self.window_end, self.used = now + self.throttled_for, self.limit
+        self.requests.append((request.path, now))
+        if now >= self.window_end:
+            self.window_end, self.used, self.told_to_wait = now + self.window, 0, False
+        self.used += 1
+        reset = max(1, math.ceil(round(self.window_end - now, 6)))
+        headers = {
+            "X-Ratelimit-Used": str(self.used),
+            "X-Ratelimit-Remaining": str(max(self.limit - self.used, 0)),
+            "X-Ratelimit-Reset": str(reset),
+        }
+        if self.used <= self.limit:
+            return None, headers
+
+        self.throttled += 1
+        if self.told_to_wait:
+            self.violations += 1
+        self.told_to_wait = True
+        return web.json_response(
+            {"message": "Too Many Requests", "error": 429},
+            status=429,
+            headers={**headers, "Retry-After": str(reset)},
+        ), headers
+
+    async def access_token(self, request: web.Request) -> web.Response:
+        throttled, headers = self._rate_limit(request)
+        if throttled is not None:
+            return throttled
+        self.authorizations.append(request.headers.get("Authorization", ""))
+        return web.json_response(
+            {"access_token": "token", "expires_in": 3600, "scope": "*"}, headers=headers
+        )
+
+    async def top(self, request: web.Request) -> web.Response:
+        throttled, headers = self._rate_limit(request)
+        if throttled is not None:
+            return throttled
+        page = int(request.query.get("after", "-1")) + 1
+        subreddit = request.match_info["subreddit"]
+        return web.json_response(
+            {
+                "kind": "Listing",
+                "data": {
+                    "children": [
+                        {
+                            "kind": "t3",
+                            "data": {"id": f"{subreddit}{page}", "title": "A meme"},
+                        }
+                    ],
+                    "after": str(page) if page + 1 < self.pages else None,
+                },
+            },
+            headers=headers,
+        )
+
+
+@contextlib.asynccontextmanager
+async def _serve(fake: FakeReddit, monkeypatch) -> AsyncIterator[str]:
+    """
+    Serves `fake` and points the async client at it, yields its base url.
+    """
+
+    async with TestServer(fake.app()) as server:
+        base_url = str(server.make_url("")).rstrip("/")
+        monkeypatch.setattr(sources.reddit, "REDDIT_TOKEN_URL", base_url + TOKEN_PATH)
+        monkeypatch.setattr(sources.reddit, "REDDIT_OAUTH_URL", base_url)
+        yield base_url
+
+
+async def _list_top(
+    reddit: RedditMeme, fake: FakeReddit, monkeypatch, *subreddits: str
+) -> list[list[dict]]:
+    """
+    Walks the top listings of `subreddits` concurrently, as `fetch_jobs_async` does.
+    """
+
+    token_lock = asyncio.Lock()
+
+    async def list_top(session: ClientSession, subreddit: str) -> list[dict]:
+        return [
+            post
+            async for post in reddit._iter_top_async(
+                session, token_lock, subreddit, "day", Counter()
+            )
+        ]
+
+    async with _serve(fake, monkeypatch), ClientSession() as session:
+        return await asyncio.gather(
+            *(list_top(session, subreddit) for subreddit in subreddits)
+        )
+
+
+def test_throttled_token_request_waits_for_retry_after(monkeypatch):
+    reddit = RedditMeme(["memes"], [MediaType.IMAGE])
+    fake = FakeReddit(limit=7, window=60, throttled_for=1)
+
+    [posts] = asyncio.run(_list_top(reddit, fake, monkeypatch, "memes"))
+
+    assert [post["id"] for post in posts] == ["memes0"]
+    assert fake.paths() == [TOKEN_PATH, TOKEN_PATH, "/r/memes/top"]
+    assert (fake.throttled, fake.violations) == (1, 0)
+    (_, throttled_at), (_, retried_at), _ = fake.requests
+    assert retried_at - throttled_at >= 1
+    assert fake.authorizations[0].startswith("Basic ")
+    # The remaining 5 requests are spread over the 60 seconds left in the window
+    assert reddit.rate_limiter.rate == pytest.approx(5 / 60)
+    assert reddit.api_calls == 3
+
+
+def test_429_on_a_listing_slows_the_bucket_and_the_retry_succeeds(monkeypatch):
+    reddit = RedditMeme(["memes"], [MediaType.IMAGE])
+    fake = FakeReddit(limit=7, window=60, throttled_for=1, throttled_at=1)
+
+    [posts] = asyncio.run(_list_top(reddit, fake, monkeypatch, "memes"))
+
+    assert [post["id"] for post in posts] == ["memes0"]
+    assert fake.paths() == [TOKEN_PATH, "/r/memes/top", "/r/memes/top"]
+    assert (fake.throttled, fake.violations) == (1, 0)
+    assert fake.requests[2][1] - fake.requests[1][1] >= 1
+    assert reddit.rate_limiter.rate == pytest.approx(6 / 60)
+    assert reddit.rate_limiter.rate < reddit.rate_limiter.base_rate
+
+
+def test_nothing_remaining_waits_for_the_reset_without_a_429(monkeypatch):
+    reddit = RedditMeme(["memes"], [MediaType.IMAGE])
+    fake = FakeReddit(limit=2, window=1, pages=2)
+
+    [posts] = asyncio.run(_list_top(reddit, fake, monkeypatch, "memes"))
+
+    # The first page used up the window, so the second one waited for the next
+    assert [post["id"] for post in posts] == ["memes0", "memes1"]
+    assert fake.paths() == [TOKEN_PATH] + ["/r/memes/top"] * 2
+    assert fake.throttled == 0
+    assert fake.requests[2][1] - fake.requests[1][1] >= 0.5
+
+
+def test_praw_requests_wait_out_a_429(monkeypatch):
+    reddit = RedditMeme(["memes"], [MediaType.IMAGE])
+    fake = FakeReddit(limit=7, window=60, throttled_for=1, throttled_at=1, pages=2)
+
+    def list_top() -> list[str]:
+        top_posts = reddit.reddit_client.subreddit("memes").top(
+            time_filter="day", limit=10
+        )
+        return [post.id for post in top_posts]
+
+    async def run() -> list[str]:
+        async with _serve(fake, monkeypatch) as base_url:
+            monkeypatch.setattr(
+                praw,
+                "Reddit",
+                functools.partial(
+                    praw.Reddit,
+                    oauth_url=base_url,
+                    reddit_url=base_url,
+                    check_for_updates=False,
+                ),
+            )
+            monkeypatch.setenv("REDDIT_CLIENT_ID", "client")
+            monkeypatch.setenv("REDDIT_CLIENT_SECRET", "secret")
+            monkeypatch.setenv("REDDIT_USER_AGENT", "python-memer tests")
+            # PRAW blocks, so it runs in a thread while the server answers
+            return await asyncio.to_thread(list_top)
+
+    assert asyncio.run(run()) == ["memes0", "memes1"]
+    assert fake.paths() == [TOKEN_PATH] + ["/r/memes/top"] * 3
+    assert (fake.throttled, fake.violations) == (1, 0)
+    assert fake.requests[2][1] - fake.requests[1][1] >= 1
+    assert reddit.api_calls == 4
+    assert reddit.rate_limiter.rate < reddit.rate_limiter.base_rate
+
+
+def test_concurrent_listings_share_one_bucket_and_stay_under_the_limit(monkeypatch):
+    subreddits = ("memes", "dankmemes", "wholesomememes")
+    reddit = RedditMeme(list(subreddits), [MediaType.IMAGE])
+    # At most 2 + 2 requests a second in total, a bucket per listing would allow three times that
+    reddit.rate_limiter = TokenBucket(2, 2)
+    fake = FakeReddit(limit=5, window=1, pages=2)
+
+    listings = asyncio.run(_list_top(reddit, fake, monkeypatch, *subreddits))
+
+    assert [[post["id"] for post in posts] for posts in listings] == [
+        [f"{subreddit}0", f"{subreddit}1"] for subreddit in subreddits
+    ]
+    assert fake.paths().count(TOKEN_PATH) == 1
+    assert len(fake.requests) == 7
+    assert fake.throttled == 0
+    assert reddit.api_calls == 7
+
+
+def test_subreddits_that_published_longest_ago_are_listed_first(monkeypatch):
+    reddit = RedditMeme(
+        ["memes", "dankmemes", "wholesomememes", "me_irl"], [MediaType.IMAGE]
+    )
+    reddit.cache = CacheManifest(
+        "manifest.json",
+        {
+            f"https://i.redd.it/{subreddit}.png": CacheEntry(
+                f"./memes/reddit/{subreddit}/original_todays_image.png",
+                f"./memes/reddit/{subreddit}/todays_image.png",
+                published_at=published_at,
+            )
+            for subreddit, published_at in {
+                "memes": 300.0,
+                "dankmemes": 100.0,
+                "wholesomememes": 200.0,
+            }.items()
+        },
+    )
+    # One request at a time, so the server sees them in the order they were asked for
+    reddit.rate_limiter = TokenBucket(20, 1)
+    fake = FakeReddit(limit=1200)
+
+    async def fetch() -> list[list]:
+        async with _serve(fake, monkeypatch), ClientSession() as session:
+            return await asyncio.gather(*reddit.fetch_jobs_async(session))
+
+    asyncio.run(fetch())
+
+    # me_irl never published
+    assert fake.paths() == [
+        TOKEN_PATH,
+        "/r/me_irl/top",
+        "/r/dankmemes/top",
+        "/r/wholesomememes/top",
+        "/r/memes/top",
+    ]
@@ -0,0 +1,57 @@
+import json
+import os
+
+from rerender import find_jobs, job_render_options
+
+CONFIG = {
+    "render": {"encoding": "balanced", "max_dimension": 1080},
+    "sources": {
+        "reddit": {
+            "subreddits": ["memes"],
+            "media_types": ["IMAGE"],
+            "render": {"encoding": "smallest"},
+        },
+        "programmerhumor": {},
+    },
+}
+
+
+def _original(root, source: str, sidecar: dict | None = None) -> None:
+    directory = root / source
+    directory.mkdir(parents=True)
+    (directory / "original_todays_png.png").write_bytes(b"")
+    if sidecar is not None:
+        (directory / "original_todays_png.json").write_text(json.dumps(sidecar))
+
+
+def test_jobs_render_with_the_options_of_their_source(tmp_path):
+    _original(tmp_path, "reddit/memes", {"title": "Memes", "source": "reddit/memes"})
+    # A subreddit that was removed from the config still belongs to reddit
+    _original(tmp_path, "reddit/funny", {"title": "Funny", "source": "reddit/funny"})
+    _original(
+        tmp_path,
+        "programmerhumorio",
+        {"title": "Humor", "source": "programmerhumorio"},
+    )
+    # Without a sidecar the source is the directory
+    _original(tmp_path, "reddit/gifs")
+    _original(tmp_path, "elsewhere", {"title": "Elsewhere", "source": "elsewhere"})
+
+    jobs, missing = find_jobs(str(tmp_path), default_title="Default")
+    render_options = job_render_options(CONFIG)
+
+    assert missing == []
+    assert {
+        job.source: (job.title, render_options(job)["encoding"]) for job in jobs
+    } == {
+        "elsewhere": ("Elsewhere", "balanced"),
+        "programmerhumorio": ("Humor", "balanced"),
+        "reddit/funny": ("Funny", "smallest"),
+        "reddit/gifs": ("Default", "smallest"),
+        "reddit/memes": ("Memes", "smallest"),
+    }
+    assert all(render_options(job)["max_dimension"] == 1080 for job in jobs)
+    assert all(
+        job.edited_path == os.path.join(os.path.dirname(job.og_path), "todays_png.png")
+        for job in jobs
+    )
@@ -0,0 +1,135 @@
+import threading
+
+from scheduler import Clock, Scheduler
+from sources.base import MediaType, MemeBase
+
+FEED = "scripted"
+
+
+class FakeClock(Clock):
+    def __init__(self):
+        self.time = 0.0
+
+    def now(self) -> float:
+        return self.time
+
+    def sleep(self, seconds: float, stop: threading.Event) -> bool:
+        self.time += seconds
+        return stop.is_set()
+
+
+class ScriptedSource(MemeBase):
+    """
+    One feed whose every listing leads with the next posts of `listings`, by media type.
+    """
+
+    def __init__(self, listings: list[dict[MediaType, str]]):
+        self.listings = listings
+        self.fetched: list[dict[MediaType, str]] = []
+        self.schedule_options = {
+            "interval": 60,
+            "min_interval": 30,
+            "max_interval": 240,
+        }
+
+    def feeds(self) -> list[str]:
+        return [FEED]
+
+    def fetch_jobs(self):
+        return [self.fetch_meme] if self.is_due(FEED) else []
+
+    def fetch_meme(self):
+        listing = self.listings[len(self.fetched)]
+        self.fetched.append(listing)
+        memes = []
+        for media_type, post in listing.items():
+            if self.pick_unchanged(FEED, media_type, post):
+                continue
+            meme = self.convert_to_object(
+                f"https://example.com/{post}{media_type.value}", media_type, FEED, post
+            )
+            meme.pick = post
+            memes.append(meme)
+        return memes
+
+
+def pipeline(published: list[str], failing: set[str] | None = None):
+    """
+    Stands in for `run_pipeline`: publishes every fetched meme unless it is `failing`, which
+    fails once, and only then reports it to its source.
+    """
+
+    failing = set(failing or ())
+
+    def run(sources: list[MemeBase]) -> None:
+        for source in sources:
+            for job in source.fetch_jobs():
+                for meme in job():
+                    if meme.title in failing:
+                        failing.discard(meme.title)
+                        continue
+                    published.append(meme.title)
+                    source.published(meme)
+
+    return run
+
+
+def test_publishes_only_changed_picks_over_two_intervals():
+    source = ScriptedSource(
+        [
+            {MediaType.IMAGE: "cat", MediaType.GIF: "dog"},
+            {MediaType.IMAGE: "cat", MediaType.GIF: "dog"},
+            {MediaType.IMAGE: "cat", MediaType.GIF: "owl"},
+        ]
+    )
+    published = []
+    clock = FakeClock()
+    scheduler = Scheduler({"scripted": source}, pipeline(published), clock)
+
+    assert scheduler.run_due() == 60
+    assert published == ["cat", "dog"]
+
+    # Not due yet
+    clock.time += 59
+    assert scheduler.run_due() == 1
+    assert len(source.fetched) == 1
+
+    # First interval: nothing changed, so nothing is published and the interval doubles
+    clock.time += 1
+    assert scheduler.run_due() == 120
+    assert len(source.fetched) == 2
+    assert published == ["cat", "dog"]
+
+    # Second interval: only the GIF changed, it is published and the interval halves
+    clock.time += 120
+    assert scheduler.run_due() == 60
+    assert len(source.fetched) == 3
+    assert published == ["cat", "dog", "owl"]
+    assert source.published_picks == {
+        FEED: {MediaType.IMAGE: "cat", MediaType.GIF: "owl"}
+    }
+
+
+def test_retries_a_pick_that_failed_to_publish():
+    source = ScriptedSource(
+        [{MediaType.IMAGE: "cat"}, {MediaType.IMAGE: "owl"}, {MediaType.IMAGE: "owl"}]
+    )
+    published = []
+    clock = FakeClock()
+    scheduler = Scheduler({"scripted": source}, pipeline(published, {"owl"}), clock)
+
+    scheduler.run_due()
+    clock.time += 60
+    # The new pick fails, so the published meme and the picks are unchanged
+    assert scheduler.run_due() == 120
+    assert published == ["cat"]
+    assert source.published_picks == {FEED: {MediaType.IMAGE: "cat"}}
+
+    clock.time += 120
+    scheduler.run_due()
+    assert [listing[MediaType.IMAGE] for listing in source.fetched] == [
+        "cat",
+        "owl",
+        "owl",
+    ]
+    assert published == ["cat", "owl"]
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+from image.generator import _measure, _wrap
+from PIL import Image, ImageDraw, ImageFont
+
+DEJAVU_SANS = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# (title, font size, max width, expected lines) with DejaVu Sans, the lines the title wrapped to
+# when every candidate line was measured in full
+CORPUS = [
+    (
+        "When the code works on the first try and you don't know why",
+        32,
+        600,
+        ["When the code works on the first try", "and you don't know why"],
+    ),
+    (
+        "Me explaining to my manager why the 'quick fix' took three sprints",
+        28,
+        480,
+        ["Me explaining to my manager", "why the 'quick fix' took three", "sprints"],
+    ),
+    ("It works on my machine", 40, 300, ["It works on my", "machine"]),
+    (
+        "Senior developers reviewing a one-line change for three hours",
+        20,
+        320,
+        ["Senior developers reviewing a", "one-line change for three hours"],
+    ),
+    (
+        "https://example.com/a/very/long/url/that/does/not/fit/on/one/line",
+        24,
+        300,
+        ["https://example.com/a/v", "ery/long/url/that/does/no", "t/fit/on/one/line"],
+    ),
+    (
+        "Supercalifragilisticexpialidocious",
+        48,
+        250,
+        ["Supercalif", "ragilistice", "xpialidoci", "ous"],
+    ),
+    (
+        "  Leading,   repeated   and trailing   spaces  ",
+        30,
+        260,
+        ["Leading,", "repeated and", "trailing spaces"],
+    ),
+    (
+        "Café déjà vu: naïve Ünïcödé títles wrap too",
+        30,
+        300,
+        ["Café déjà vu: naïve", "Ünïcödé títles wrap", "too"],
+    ),
+    (
+        "WWWWWWWWWW iiiiiiiiii WWWWWWWWWW iiiiiiiiii",
+        26,
+        220,
+        ["WWWWWWWW", "WW iiiiiiiiii", "WWWWWWWW", "WW iiiiiiiiii"],
+    ),
+    ("Short", 30, 600, ["Short"]),
+    ("", 30, 600, [""]),
+]
+
+
+@pytest.fixture(scope="module")
+def draw_ctx() -> ImageDraw.ImageDraw:
+    return ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+
+@pytest.mark.skipif(not os.path.exists(DEJAVU_SANS), reason="DejaVu Sans is missing")
+@pytest.mark.parametrize(("title", "font_px", "max_width_px", "expected"), CORPUS)
+def test_wrap_reproduces_the_measured_line_breaks(
+    draw_ctx, title, font_px, max_width_px, expected
+):
+    font = ImageFont.truetype(DEJAVU_SANS, font_px)
+
+    assert _wrap(draw_ctx, title, font, max_width_px).split("\n") == expected
+
+
+@pytest.mark.parametrize(("title", "font_px", "max_width_px", "expected"), CORPUS)
+def test_wrapped_lines_fit(draw_ctx, title, font_px, max_width_px, expected):
+    """
+    With Pillow's bundled font, so it runs without DejaVu Sans: only a single character may be
+    wider than the line.
+    """
+
+    font = ImageFont.load_default(font_px)
+
+    for line in _wrap(draw_ctx, title, font, max_width_px).split("\n"):
+        assert len(line) <= 1 or _measure(draw_ctx, line, font)[0] <= max_width_px